@@ -102,6 +102,12 @@ MEM_0 = 0
 MEM_1 = 1
 MEM_2 = 2
 MEM_3 = 3
+MEM_AUTO = 4
+
+# Compression of the .par files
+PAR_COMPRESS_NONE = 0
+PAR_COMPRESS_GZIP = 1
+PAR_COMPRESS_ZSTD = 2
 
 # Interpolation
 INTERPOLATION_0 = 0
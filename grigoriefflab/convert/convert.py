@@ -30,11 +30,21 @@ This module contains converter functions that will serve to:
 """
 
 import os
+import io
 import re
-from itertools import izip
+import gzip
+import shutil
+from os.path import exists, getmtime
+from bisect import bisect_left
+from itertools import izip, islice
 from collections import OrderedDict
 import numpy as np
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # .par files can only be compressed with gzip
+
 #from numpy import rad2deg, deg2rad
 #from np.linalg import inv
 
@@ -47,11 +57,204 @@ HEADER_COLUMNS = ['INDEX', 'PSI', 'THETA', 'PHI', 'SHX', 'SHY', 'MAG',
                   'FILM', 'DF1', 'DF2', 'ANGAST', 'OCC',
                   '-LogP', 'SIGMA', 'SCORE', 'CHANGE']
 
+PAR_HEADER = ("C           PSI   THETA     PHI       SHX       SHY     MAG  FILM      DF1"
+              "      DF2  ANGAST     OCC     -LogP      SIGMA   SCORE  CHANGE\n")
+
+# Columns given when writing an initial .par file and their format,
+# the remaining columns are filled with default values
+PAR_ANGLES_COLUMNS = HEADER_COLUMNS[:11]
+PAR_ANGLES_LINE = ("%7d %7.2f %7.2f %7.2f %9.2f %9.2f %7.0f %5d %8.1f %8.1f %7.2f"
+                   "  100.00      0000     0.5000   00.00   00.00\n")
+
+# Columns stored as integers when reading a .par file into an array,
+# all the others are read as float64
+INT_COLUMNS = ['INDEX', 'FILM']
+
+# Extension of the binary copy of a .par file used for memory-mapping
+PAR_SIDECAR_EXT = '.npy'
+
+# Extensions of the compressed .par files (see compressParFile)
+PAR_GZIP_EXT = '.gz'
+PAR_ZSTD_EXT = '.zst'
+PAR_COMPRESSED_EXTS = [PAR_ZSTD_EXT, PAR_GZIP_EXT]
+
+# Number of lines parsed at once when reading a .par file into an array
+PAR_CHUNK_LINES = 100000
+
+# Buffer sizes used when merging .par files
+PAR_COPY_BYTES = 4 * 1024 * 1024
+PAR_TAIL_BYTES = 64 * 1024
+
+# Columns of the FSC table written by Frealign at the end of the
+# reconstruction .par file (after the first 'C' of each line)
+FSC_RESOLUTION = 1
+FSC_FSC = 4
+FSC_REC_SSNR = 7
+FSC_THRESHOLD = 0.143
+
+# MRC header (1024 bytes, little-endian) used to write particle stacks
+MRC_HEADER_BYTES = 1024
+MRC_MODE_FLOAT = 2
+MRC_EXTENSIONS = ['.mrc', '.mrcs', '.st']
+# Number of images resized at once when binning a stack
+MRC_CHUNK_IMAGES = 256
+MRC_HEADER_DTYPE = np.dtype([('nx', '<i4'), ('ny', '<i4'), ('nz', '<i4'),
+                             ('mode', '<i4'), ('start', '<i4', 3),
+                             ('mx', '<i4'), ('my', '<i4'), ('mz', '<i4'),
+                             ('cella', '<f4', 3), ('cellb', '<f4', 3),
+                             ('axis', '<i4', 3), ('dmin', '<f4'),
+                             ('dmax', '<f4'), ('dmean', '<f4'),
+                             ('ispg', '<i4'), ('nsymbt', '<i4'),
+                             ('extra', 'V100'), ('origin', '<f4', 3),
+                             ('map', 'S4'), ('machst', 'u1', 4),
+                             ('rms', '<f4'), ('nlabl', '<i4'),
+                             ('label', 'S80', 10)])
+
+
+def findParFile(filename):
+    """ Return the name of a .par file if it exists, or the name of its
+    compressed copy (see compressParFile) if only that one exists.
+    Return None if none of them exists.
+    """
+    if exists(filename):
+        return filename
+    for ext in PAR_COMPRESSED_EXTS:
+        if exists(filename + ext):
+            return filename + ext
+    return None
+
+
+def isCompressedParFile(filename):
+    return any(filename.endswith(ext) for ext in PAR_COMPRESSED_EXTS)
+
+
+def isZstdAvailable():
+    return zstandard is not None
+
+
+class _ZstdReader(io.RawIOBase):
+    """ Raw stream that decompresses a zstd file while reading it. """
+    def __init__(self, filename):
+        self.name = filename
+        self._file = open(filename, 'rb')
+        self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            data = self._file.read(PAR_COPY_BYTES)
+            if not data:
+                return 0
+            self._buffer = self._decompressor.decompress(data)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        io.RawIOBase.close(self)
+
+
+class _ZstdWriter(io.RawIOBase):
+    """ Raw stream that compresses with zstd the data written. """
+    def __init__(self, filename):
+        self.name = filename
+        self._file = open(filename, 'wb')
+        self._compressor = zstandard.ZstdCompressor().compressobj()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._file.write(self._compressor.compress(memoryview(b).tobytes()))
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            self._file.write(self._compressor.flush())
+            self._file.close()
+        io.RawIOBase.close(self)
+
+
+def openParFile(filename, mode='r'):
+    """ Open a .par file. When reading, its compressed copy is opened if
+    the file itself does not exist (see findParFile). Files with a
+    compressed extension (gzip or zstd) are decompressed, or compressed
+    when writing, on the fly.
+    """
+    if 'r' in mode:
+        filename = findParFile(filename) or filename
+    if filename.endswith(PAR_GZIP_EXT):
+        return gzip.open(filename, mode.replace('b', '') + 'b')
+    if filename.endswith(PAR_ZSTD_EXT):
+        if zstandard is None:
+            raise Exception("Can not open %s, the zstandard module is "
+                            "not installed." % filename)
+        if 'r' in mode:
+            return io.BufferedReader(_ZstdReader(filename), PAR_COPY_BYTES)
+        return io.BufferedWriter(_ZstdWriter(filename), PAR_COPY_BYTES)
+    return open(filename, mode)
+
+
+def removeParFile(filename):
+    """ Remove a .par file and all its compressed copies. """
+    for fn in [filename] + [filename + ext for ext in PAR_COMPRESSED_EXTS]:
+        if exists(fn):
+            os.remove(fn)
+
+
+def compressParFile(filename, ext=PAR_GZIP_EXT):
+    """ Replace a .par file by its compressed copy (with the extension
+    of the compression, PAR_GZIP_EXT or PAR_ZSTD_EXT) and return the
+    name of the copy.
+    """
+    compressedFn = filename + ext
+    tmpFn = filename + '.tmp' + ext
+    with open(filename, 'rb') as f1:
+        f2 = openParFile(tmpFn, 'wb')
+        shutil.copyfileobj(f1, f2, PAR_COPY_BYTES)
+        f2.close()
+    os.rename(tmpFn, compressedFn)
+    os.remove(filename)
+    return compressedFn
+
+
+def copyParFile(parFn, outputFn):
+    """ Copy a .par file, that can be compressed (see findParFile), to
+    outputFn, that is compressed if it has a compressed extension.
+    """
+    f1 = openParFile(parFn, 'rb')
+    f2 = openParFile(outputFn, 'wb')
+    shutil.copyfileobj(f1, f2, PAR_COPY_BYTES)
+    f2.close()
+    f1.close()
+
+
+def uncompressedParFile(parFn, scratchDir):
+    """ Return the name of an uncompressed copy of a .par file, that
+    can be given to the Frealign programs. If the file is compressed, it
+    is decompressed to scratchDir, and the copy should be removed after
+    using it. Otherwise the file itself is returned.
+    """
+    filename = findParFile(parFn) or parFn
+    if not isCompressedParFile(filename):
+        return filename
+    if not exists(scratchDir):
+        os.makedirs(scratchDir)
+    outputFn = os.path.join(scratchDir, os.path.basename(parFn))
+    copyParFile(filename, outputFn)
+    return outputFn
+
 
 class FrealignParFile(object):
     """ Handler class to read/write frealign metadata."""
     def __init__(self, filename, mode='r'):
-        self._file = open(filename, mode)
+        self._file = openParFile(filename, mode)
         self._count = 0
 
     def __iter__(self):
@@ -63,10 +266,251 @@ class FrealignParFile(object):
                 row = OrderedDict(zip(HEADER_COLUMNS, line.split()))
                 yield row
 
+    def readArray(self):
+        """ Read all remaining particle lines at once and return them
+        as a NumPy structured array with one field per column
+        (named as in HEADER_COLUMNS). Comment and statistics lines
+        (starting with 'C') are skipped.
+        """
+        chunks = []
+        numberOfColumns = None
+
+        while True:
+            lines = list(islice(self._file, PAR_CHUNK_LINES))
+            if not lines:
+                break
+            lines = [l for l in lines if not l.startswith('C')]
+            if not lines:
+                continue
+            if numberOfColumns is None:
+                numberOfColumns = len(lines[0].split())
+            values = np.fromstring(''.join(lines), sep=' ')
+            if values.size % numberOfColumns:
+                raise Exception("Wrong number of values in .par file %s"
+                                % self._file.name)
+            chunks.append(values.reshape(-1, numberOfColumns))
+
+        names = HEADER_COLUMNS[:numberOfColumns or len(HEADER_COLUMNS)]
+        dtype = [(n, np.int32 if n in INT_COLUMNS else np.float64)
+                 for n in names]
+
+        if chunks:
+            values = np.concatenate(chunks)
+        else:
+            values = np.empty((0, len(names)))
+
+        parData = np.empty(len(values), dtype=dtype)
+        for i, name in enumerate(names):
+            parData[name] = values[:, i]
+        return parData
+
     def close(self):
         self._file.close()
 
 
+def readParArray(filename, mmap=False):
+    """ Read all particle records of a Frealign .par file as a
+    NumPy structured array (see FrealignParFile.readArray).
+    If mmap is True, a binary copy of the array is stored next to the
+    .par file and memory-mapped, it will be reused in later calls while
+    it is newer than the .par file.
+    """
+    sidecar = filename + PAR_SIDECAR_EXT
+
+    if mmap and exists(sidecar) and getmtime(sidecar) >= getmtime(findParFile(filename) or filename):
+        return np.load(sidecar, mmap_mode='r')
+
+    parFile = FrealignParFile(filename)
+    parData = parFile.readArray()
+    parFile.close()
+
+    if mmap:
+        np.save(sidecar, parData)
+        return np.load(sidecar, mmap_mode='r')
+
+    return parData
+
+
+def splitParFile(parFn, blockFiles, header=None):
+    """ Split a .par file into several block files reading it only once.
+    Params:
+        parFn: input .par file, with particles sorted by number.
+        blockFiles: list of tuples (filename, initPart, finalPart) with
+            the particle range of each block, sorted by range.
+        header: optional text to write at the beginning of each block.
+    The comment lines at the top of the input file are written to
+    every block and each particle line only to the block whose range
+    contains its particle number.
+    """
+    finalParts = [finalPart for _, _, finalPart in blockFiles]
+    outputs = [openParFile(fn, 'w') for fn, _, _ in blockFiles]
+
+    if header:
+        for f in outputs:
+            f.write(header)
+
+    block = 0
+    inHeader = True
+    initPart, finalPart = blockFiles[0][1:]
+    f1 = openParFile(parFn)
+
+    for line in f1:
+        if line.startswith('C'):
+            if inHeader:
+                for f in outputs:
+                    f.write(line)
+            continue
+
+        inHeader = False
+        numPart = int(line.split(None, 1)[0])
+
+        if not initPart <= numPart <= finalPart:
+            block = bisect_left(finalParts, numPart)
+            if block == len(blockFiles):
+                continue
+            initPart, finalPart = blockFiles[block][1:]
+            if numPart < initPart:
+                continue
+
+        outputs[block].write(line)
+
+    f1.close()
+    for f in outputs:
+        f.close()
+
+
+def _parDataRange(f):
+    """ Return the byte range (start, end) of the particle lines of an
+    opened .par file together with the first and last particle lines.
+    The comment lines at the top (header) and at the bottom (statistics)
+    are left out of the range.
+    """
+    f.seek(0)
+    start = 0
+    firstLine = None
+    for line in iter(f.readline, ''):
+        if not line.startswith('C') and line.strip():
+            firstLine = line
+            break
+        start += len(line)
+
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if firstLine is None:
+        return size, size, None, None
+
+    # Walk backwards from the end skipping the statistics lines,
+    # reading a bigger tail if all its lines are comments
+    tailSize = PAR_TAIL_BYTES
+    while True:
+        tailStart = max(start, size - tailSize)
+        f.seek(tailStart)
+        lines = f.read(size - tailStart).splitlines(True)
+        end = size
+        while lines and (lines[-1].startswith('C') or not lines[-1].strip()):
+            end -= len(lines.pop())
+        if len(lines) > 1 or tailStart == start:
+            return start, end, firstLine, lines[-1]
+        tailSize *= 2
+
+
+def mergeParFiles(inputFiles, outputFn, header=None):
+    """ Concatenate the particle lines of several .par files into a single
+    one. The comment lines of each input file are skipped by locating
+    where its data starts and ends, and the data in between is copied
+    in bulk without parsing it line by line.
+    The particle numbering is checked to be contiguous between
+    consecutive files, using only the first and last lines of each one.
+    Compressed input files (see findParFile) are read line by line, and
+    the output file is compressed if it has a compressed extension.
+    """
+    f2 = openParFile(outputFn, 'wb')
+    if header:
+        f2.write(header)
+
+    lastPart = None
+    for parFn in inputFiles:
+        compressed = isCompressedParFile(findParFile(parFn) or parFn)
+        f1 = openParFile(parFn, 'rb')
+        if compressed:
+            # Compressed files can not be read backwards
+            lines = [l for l in f1 if not l.startswith('C') and l.strip()]
+            firstLine = lines[0] if lines else None
+            lastLine = lines[-1] if lines else None
+        else:
+            start, end, firstLine, lastLine = _parDataRange(f1)
+
+        if firstLine is not None:
+            firstPart = int(firstLine.split(None, 1)[0])
+            if lastPart is not None and firstPart != lastPart + 1:
+                raise Exception("Error: particles in %s start at %d, but the "
+                                "previous file ends at %d"
+                                % (parFn, firstPart, lastPart))
+            lastPart = int(lastLine.split(None, 1)[0])
+
+            if compressed:
+                f2.writelines(lines)
+            else:
+                f1.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    data = f1.read(min(PAR_COPY_BYTES, remaining))
+                    if not data:
+                        break
+                    f2.write(data)
+                    remaining -= len(data)
+        f1.close()
+
+    f2.close()
+
+
+def readParRange(parFn):
+    """ Return the number of particles of a .par file and the
+    first and last particle numbers (None if there are no particles).
+    """
+    count, first, last = 0, None, None
+    with openParFile(parFn) as f:
+        for line in f:
+            if line.startswith('C') or not line.strip():
+                continue
+            last = int(line.split(None, 1)[0])
+            if first is None:
+                first = last
+            count += 1
+    return count, first, last
+
+
+def readParClasses(parFiles):
+    """ Join the .par files of a multi-reference refinement (one file
+    per class, with the same particles in the same order) and assign
+    each particle to the class with the highest occupancy (OCC).
+    Files are read one at a time, so only the result and a single
+    class are kept in memory.
+    Return a tuple (classIds, parData) with the (1-based) class
+    of each particle and the .par values from that class.
+    """
+    classIds = bestOcc = parData = None
+
+    for classNum, parFn in enumerate(parFiles, 1):
+        classData = readParArray(parFn)
+
+        if parData is None:
+            parData = classData
+            bestOcc = classData['OCC'].copy()
+            classIds = np.ones(len(classData), dtype=np.int32)
+        else:
+            if len(classData) != len(parData):
+                raise Exception("Number of particles in %s (%d) differs "
+                                "from previous classes (%d)"
+                                % (parFn, len(classData), len(parData)))
+            better = classData['OCC'] > bestOcc
+            parData[better] = classData[better]
+            bestOcc[better] = classData['OCC'][better]
+            classIds[better] = classNum
+
+    return classIds, parData
+
+
 def readSetOfParticles(inputSet, outputSet, parFileName):
     """
      Iterate through the inputSet and the parFile lines
@@ -78,11 +522,14 @@ def readSetOfParticles(inputSet, outputSet, parFileName):
     """
     #create dictionary that matches input particles with param file
     samplingRate = inputSet.getSamplingRate()
-    parFile = FrealignParFile(parFileName)
+    parData = readParArray(parFileName)
+    matrices = matricesFromParArray(parData, samplingRate)
     partIter = iter(inputSet.iterItems(orderBy=['_micId', 'id'], direction='ASC'))
-     
-    for particle, row in izip(partIter, parFile):        
-        particle.setTransform(rowToAlignment(row, samplingRate))
+
+    for particle, row, matrix in izip(partIter, parData, matrices):
+        alignment = em.Transform()
+        alignment.setMatrix(matrix)
+        particle.setTransform(alignment)
         # We assume that each particle have ctfModel
         # in order to be processed in Frealign
         # JMRT: Since the CTF will be set, we can setup
@@ -133,10 +580,133 @@ def matrixFromGeometry(shifts, angles):
     return M
 
 
+def matricesFromGeometry(shifts, angles):
+    """ Vectorized version of matrixFromGeometry.
+    Params:
+        shifts: N x 2 (or N x 3) array with the shifts in pixels.
+        angles: N x 3 array with the euler angles (PSI, THETA, PHI)
+            in degrees.
+    Return a N x 4 x 4 array with the (inverse) transformation matrix
+    of each particle. Since the transformation is rigid, the inverse
+    is computed in closed form instead of calling np.linalg.inv.
+    """
+    angles = np.deg2rad(np.asarray(angles, dtype=np.float64).reshape(-1, 3))
+    shifts = np.asarray(shifts, dtype=np.float64).reshape(len(angles), -1)
+    n = len(angles)
+
+    # Same as transformations.euler_matrix(-psi, -theta, -phi, 'szyz')
+    si, sj, sk = np.sin(angles.T)
+    ci, cj, ck = np.cos(angles.T)
+    cc, cs = ci * ck, ci * sk
+    sc, ss = si * ck, si * sk
+
+    R = np.empty((n, 3, 3))
+    R[:, 2, 2] = cj
+    R[:, 2, 1] = sj * si
+    R[:, 2, 0] = sj * ci
+    R[:, 1, 2] = sj * sk
+    R[:, 1, 1] = -cj * ss + cc
+    R[:, 1, 0] = -cj * cs - sc
+    R[:, 0, 2] = -sj * ck
+    R[:, 0, 1] = cj * sc + cs
+    R[:, 0, 0] = cj * cc - ss
+
+    # The forward matrix is [R | -shifts], so its inverse is [R^T | R^T shifts]
+    shifts3 = np.zeros((n, 3))
+    shifts3[:, :shifts.shape[1]] = shifts[:, :3]
+
+    M = np.zeros((n, 4, 4))
+    M[:, :3, :3] = R.transpose(0, 2, 1)
+    M[:, :3, 3] = np.einsum('nji,nj->ni', R, shifts3)
+    M[:, 3, 3] = 1.0
+
+    return M
+
+
+def matricesFromParArray(parData, samplingRate):
+    """ Return a N x 4 x 4 array with the alignment matrix of each
+    particle of a .par file read with readParArray.
+    """
+    angles = np.column_stack((parData['PSI'], parData['THETA'], parData['PHI']))
+    shifts = np.column_stack((parData['SHX'], parData['SHY'])) / samplingRate
+
+    return matricesFromGeometry(shifts, angles)
+
+
+def readParFscTable(parFn):
+    """ Read the FSC table (the lines between 'NO.  RESOL' and
+    'Average') of a reconstruction .par file.
+    Return a 2D array with one row per shell (see the FSC_* columns).
+    """
+    rows = []
+    readLines = False
+    with openParFile(parFn) as f:
+        for line in f:
+            if "C  Average" in line:
+                readLines = False
+            if readLines:
+                rows.append(line.split()[1:])
+            if "NO.  RESOL" in line:
+                readLines = True
+
+    if not rows:
+        return np.zeros((0, FSC_REC_SSNR + 1))
+    ncols = min(len(row) for row in rows)
+    return np.array([row[:ncols] for row in rows], dtype=np.float64)
+
+
+def fscResolution(fscTable, threshold=FSC_THRESHOLD):
+    """ Return the resolution (in A) of the last shell before the FSC
+    drops below threshold, or None if the table is empty.
+    """
+    if len(fscTable) == 0:
+        return None
+    below = np.flatnonzero(fscTable[:, FSC_FSC] < threshold)
+    last = below[0] - 1 if len(below) else len(fscTable) - 1
+    return float(fscTable[max(last, 0), FSC_RESOLUTION])
+
+
+def parAngularChange(parData1, parData2):
+    """ Return the mean angle (in degrees) between the orientations of
+    the same particles in two .par arrays (read with readParArray),
+    or None if they do not have the same particles.
+    Symmetry related orientations are counted as a change.
+    """
+    if len(parData1) != len(parData2) or len(parData1) == 0:
+        return None
+    R1 = matricesFromParArray(parData1, 1.)[:, :3, :3]
+    R2 = matricesFromParArray(parData2, 1.)[:, :3, :3]
+    # trace(R1^T R2) = 1 + 2 cos(angle)
+    trace = np.einsum('nij,nij->n', R1, R2)
+    angles = np.arccos(np.clip((trace - 1.) / 2., -1., 1.))
+    return float(np.rad2deg(angles).mean())
+
+
+def parIterStats(parFn, volParFn, prevParFn=None):
+    """ Return a dict with the statistics of an iteration: mean 'change',
+    'score' and 'logP' of the particles, 'resolution' from the FSC and
+    'angularChange' from the previous iteration (None if unknown).
+    Params:
+        parFn: .par file with the particles of the iteration.
+        volParFn: .par file written by the reconstruction (FSC table).
+        prevParFn: .par file with the particles of the previous iteration.
+    """
+    parData = readParArray(parFn)
+    stats = {'change': float(parData['CHANGE'].mean()),
+             'score': float(parData['SCORE'].mean()),
+             'logP': float(parData['-LogP'].mean()),
+             'resolution': fscResolution(readParFscTable(volParFn)),
+             'angularChange': None}
+    if prevParFn is not None and findParFile(prevParFn):
+        stats['angularChange'] = parAngularChange(readParArray(prevParFn),
+                                                  parData)
+    return stats
+
+
 def rowToCtfModel(ctfRow, ctfModel):
-    defocusU = float(ctfRow.get('DF1'))
-    defocusV = float(ctfRow.get('DF2'))
-    defocusAngle = float(ctfRow.get('ANGAST'))
+    defocusU = float(ctfRow['DF1'])
+    defocusV = float(ctfRow['DF2'])
+    defocusAngle = float(ctfRow['ANGAST'])
     ctfModel.setStandardDefocus(defocusU, defocusV, defocusAngle)
 
 
@@ -254,6 +824,234 @@ def geometryFromMatrix(matrix, inverseTransform=True):
     return shifts, angles
 
 
+def geometryFromMatrices(matrices, inverseTransform=True):
+    """ Vectorized version of geometryFromMatrix.
+    Take a N x 4 x 4 array of transformation matrices and return
+    two N x 3 arrays with the shifts and the euler angles (degrees).
+    """
+    matrices = np.asarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+
+    if inverseTransform:
+        matrices = np.linalg.inv(matrices)
+        shifts = -matrices[:, :3, 3]
+    else:
+        shifts = matrices[:, :3, 3].copy()
+
+    # Same as transformations.euler_from_matrix(M, axes='szyz')
+    M = matrices[:, :3, :3]
+    sy = np.sqrt(M[:, 2, 1] ** 2 + M[:, 2, 0] ** 2)
+    singular = sy <= np.finfo(float).eps * 4.0
+
+    ax = np.where(singular, np.arctan2(-M[:, 1, 0], M[:, 1, 1]),
+                  np.arctan2(M[:, 2, 1], M[:, 2, 0]))
+    ay = np.arctan2(sy, M[:, 2, 2])
+    az = np.where(singular, 0.0, np.arctan2(M[:, 1, 2], -M[:, 0, 2]))
+    # euler_from_matrix negates the angles for 'szyz' and then
+    # geometryFromMatrix negates them again
+    angles = np.rad2deg(np.column_stack((ax, ay, az)))
+
+    return shifts, angles
+
+
+def writeParAngles(f, parData):
+    """ Write particle lines of an initial .par file at once.
+    Params:
+        f: file object opened for writing.
+        parData: structured array with (at least) the PAR_ANGLES_COLUMNS.
+    """
+    rows = izip(*[parData[c].tolist() for c in PAR_ANGLES_COLUMNS])
+    f.writelines(PAR_ANGLES_LINE % row for row in rows)
+
+
+def readMrcHeader(filename):
+    """ Return the MRC header of a file as a numpy record,
+    or None if the file is not a little-endian MRC file.
+    """
+    header = np.fromfile(filename, dtype=MRC_HEADER_DTYPE, count=1)
+    if len(header) == 0 or header['map'][0] != b'MAP ':
+        return None
+    return header[0]
+
+
+def isMrcStack(filename, numberOfImages):
+    """ Return True if filename is a float MRC stack (without extended
+    header) with exactly numberOfImages images, so it can be given
+    to Frealign as it is.
+    """
+    if os.path.splitext(filename)[1] not in MRC_EXTENSIONS:
+        return False
+    header = readMrcHeader(filename)
+    return (header is not None
+            and header['mode'] == MRC_MODE_FLOAT
+            and header['nsymbt'] == 0
+            and header['nz'] == numberOfImages)
+
+
+def writeMrcStack(images, filename, dims, samplingRate=1., invert=False):
+    """ Write a float MRC stack in a single pass. The file is mapped
+    in memory and every image is copied (and inverted if needed) into
+    its place, without a temporary stack.
+    Params:
+        images: iterable of 2D arrays (ydim, xdim), in the stack order.
+        filename: output MRC file.
+        dims: (xdim, ydim, numberOfImages) of the stack.
+        samplingRate: pixel size, stored in the header cell dimensions.
+        invert: if True, multiply the images by -1.
+    """
+    xdim, ydim, n = dims
+    header = np.zeros(1, dtype=MRC_HEADER_DTYPE)
+    header['nx'], header['ny'], header['nz'] = xdim, ydim, n
+    header['mode'] = MRC_MODE_FLOAT
+    header['mx'], header['my'], header['mz'] = xdim, ydim, n
+    header['cella'] = (xdim * samplingRate, ydim * samplingRate,
+                       n * samplingRate)
+    header['cellb'] = (90., 90., 90.)
+    header['axis'] = (1, 2, 3)
+    header['map'] = b'MAP '
+    header['machst'] = (0x44, 0x44, 0, 0)
+
+    with open(filename, 'wb') as f:
+        header.tofile(f)
+        f.truncate(MRC_HEADER_BYTES + n * ydim * xdim * 4)
+
+    stack = np.memmap(filename, dtype='<f4', mode='r+',
+                      offset=MRC_HEADER_BYTES, shape=(n, ydim, xdim))
+    dmin, dmax, total, total2 = np.inf, -np.inf, 0., 0.
+    written = 0
+    for i, data in enumerate(images):
+        img = stack[i]
+        img[:] = np.reshape(data, (ydim, xdim))
+        if invert:
+            np.negative(img, out=img)
+        dmin = min(dmin, img.min())
+        dmax = max(dmax, img.max())
+        total += img.sum(dtype=np.float64)
+        total2 += np.square(img, dtype=np.float64).sum()
+        written += 1
+    stack.flush()
+    del stack
+
+    if written != n:
+        raise Exception("Expected %d images to write %s, but got %d"
+                        % (n, filename, written))
+
+    if n:
+        size = float(n * ydim * xdim)
+        mean = total / size
+        header['dmin'], header['dmax'], header['dmean'] = dmin, dmax, mean
+        header['rms'] = np.sqrt(max(total2 / size - mean * mean, 0.))
+        with open(filename, 'r+b') as f:
+            header.tofile(f)
+
+
+def readMrcData(filename):
+    """ Return a read-only memory map (nz x ny x nx) of a float MRC file
+    and its sampling rate (from the header, 1 if it is not set).
+    """
+    header = readMrcHeader(filename)
+    if header is None or header['mode'] != MRC_MODE_FLOAT:
+        raise Exception("%s is not a float MRC file" % filename)
+    nx, ny, nz = header['nx'], header['ny'], header['nz']
+    data = np.memmap(filename, dtype='<f4', mode='r',
+                     offset=MRC_HEADER_BYTES + header['nsymbt'],
+                     shape=(nz, ny, nx))
+    samplingRate = float(header['cella'][0]) / nx or 1.
+    return data, samplingRate
+
+
+def fourierResize(data, size, ndim=2):
+    """ Resize the last ndim (square) axes of data to size pixels, by
+    cropping (or padding with zeros) its centered Fourier transform.
+    The leading axes, if any, are a batch of images.
+    Return a float32 array with the same mean values as data.
+    """
+    data = np.asarray(data, dtype=np.float32)
+    oldSize = data.shape[-1]
+    if size == oldSize:
+        return data
+    axes = tuple(range(data.ndim - ndim, data.ndim))
+    batch = data.shape[:data.ndim - ndim]
+    lead = (slice(None),) * len(batch)
+
+    ft = np.fft.fftshift(np.fft.fftn(data, axes=axes), axes=axes)
+    n = min(size, oldSize)
+    src = slice(oldSize // 2 - n // 2, oldSize // 2 - n // 2 + n)
+    dst = slice(size // 2 - n // 2, size // 2 - n // 2 + n)
+    resized = np.zeros(batch + (size,) * ndim, dtype=ft.dtype)
+    resized[lead + (dst,) * ndim] = ft[lead + (src,) * ndim]
+    del ft
+
+    result = np.fft.ifftn(np.fft.ifftshift(resized, axes=axes), axes=axes).real
+    result *= (float(size) / oldSize) ** ndim
+    return result.astype(np.float32)
+
+
+def resizeMrcStack(inputFn, outputFn, size):
+    """ Write a copy of a float MRC stack with the images resized to
+    size x size pixels in Fourier space (see fourierResize).
+    """
+    data, samplingRate = readMrcData(inputFn)
+    n, _, xdim = data.shape
+
+    def images():
+        for first in range(0, n, MRC_CHUNK_IMAGES):
+            for img in fourierResize(data[first:first + MRC_CHUNK_IMAGES], size):
+                yield img
+
+    writeMrcStack(images(), outputFn, (size, size, n),
+                  samplingRate * xdim / float(size))
+
+
+def selectMrcStack(inputFn, outputFn, indexes):
+    """ Write a float MRC stack with the images of inputFn at the
+    given (0-based) indexes, in that order.
+    """
+    data, samplingRate = readMrcData(inputFn)
+    _, ydim, xdim = data.shape
+    writeMrcStack((data[i] for i in indexes), outputFn,
+                  (xdim, ydim, len(indexes)), samplingRate)
+
+
+def resizeMrcVolume(inputFn, outputFn, size):
+    """ Write a copy of a float MRC volume resized to size^3 voxels
+    in Fourier space (see fourierResize).
+    """
+    data, samplingRate = readMrcData(inputFn)
+    xdim = data.shape[-1]
+    volume = fourierResize(data, size, ndim=3)
+    writeMrcStack(volume, outputFn, (size, size, size),
+                  samplingRate * xdim / float(size))
+
+
+def expandParSubset(subsetParFn, outputFn, parData, positions):
+    """ Write a .par file with all the particles of parData, where the
+    particles at the given (0-based) positions take the lines of a .par
+    file refined from this subset, renumbered back.
+    Params:
+        subsetParFn: .par file of the subset, numbered from 1.
+        outputFn: output .par file.
+        parData: structured array with (at least) the PAR_ANGLES_COLUMNS
+            of all particles, used for the ones not in the subset.
+        positions: sorted positions in parData of the subset particles.
+    """
+    with openParFile(subsetParFn) as f:
+        lines = [line for line in f if not line.startswith('C')]
+    if len(lines) != len(positions):
+        raise Exception("%s has %d particles, but the subset has %d"
+                        % (subsetParFn, len(lines), len(positions)))
+
+    rows = izip(*[parData[c].tolist() for c in PAR_ANGLES_COLUMNS])
+    subset = dict(izip(positions.tolist(), lines))
+    with open(outputFn, 'w') as f:
+        f.write(PAR_HEADER)
+        for i, row in enumerate(rows):
+            if i in subset:
+                # The particle number takes the first 7 characters
+                f.write('%7d%s' % (row[0], subset[i][7:]))
+            else:
+                f.write(PAR_ANGLES_LINE % row)
+
+
 def geometryFromAligment(alignment):
     shifts, angles = geometryFromMatrix(alignment.getMatrix(), True)
 
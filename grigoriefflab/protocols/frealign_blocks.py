@@ -0,0 +1,255 @@
+# **************************************************************************
+# *
+# * Authors:     Josue Gomez Blanco (josue.gomez-blanco@mcgill.ca)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+This module contains helper classes to split the particles processed
+by Frealign protocols into blocks that run in parallel.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from os.path import exists, getsize, getmtime
+from bisect import bisect_left
+
+import numpy as np
+
+
+def balancedParticlesPerBlock(micCounts, numberOfBlocks):
+    """ Split a list of micrographs into numberOfBlocks groups of
+    contiguous micrographs (Frealign FILM numbering requires it) with
+    a number of particles as similar as possible.
+    In a given run all particles have the same box size and are refined
+    with the same search mode, so the cost of a block is proportional
+    to its number of particles.
+    Params:
+        micCounts: number of particles of each micrograph, in order.
+        numberOfBlocks: number of blocks, at most len(micCounts).
+    Return a list with the number of particles of each block.
+    """
+    numberOfMics = len(micCounts)
+    numberOfBlocks = min(numberOfBlocks, numberOfMics)
+    offsets = [0]
+    for count in micCounts:
+        offsets.append(offsets[-1] + count)
+    total = offsets[-1]
+
+    particlesPerBlock = []
+    lastMic = 0  # index of the first micrograph of the current block
+    for block in range(1, numberOfBlocks):
+        target = total * block / float(numberOfBlocks)
+        # Cut at the micrograph boundary closest to the target, leaving
+        # at least one micrograph for this block and each remaining one
+        cut = bisect_left(offsets, target)
+        if cut > 0 and target - offsets[cut - 1] <= offsets[min(cut, numberOfMics)] - target:
+            cut -= 1
+        cut = max(cut, lastMic + 1)
+        cut = min(cut, numberOfMics - (numberOfBlocks - block))
+        particlesPerBlock.append(offsets[cut] - offsets[lastMic])
+        lastMic = cut
+    particlesPerBlock.append(total - offsets[lastMic])
+
+    return particlesPerBlock
+
+
+def stratifiedSubset(micCounts, fraction, seed=0):
+    """ Select a random subset with a fraction of the particles of each
+    micrograph (at least one), so it has the same micrographs and
+    defocus distribution as the whole set.
+    Params:
+        micCounts: number of particles of each micrograph, in order.
+        fraction: fraction of particles to select (0 to 1).
+        seed: seed of the random generator, so the same subset is
+            obtained each time.
+    Return a sorted array with the (0-based) positions of the selected
+    particles and a list with the selected count of each micrograph.
+    """
+    random = np.random.RandomState(seed)
+    positions = []
+    subsetCounts = []
+    offset = 0
+    for count in micCounts:
+        n = min(count, max(1, int(round(count * fraction))))
+        selected = np.sort(random.choice(count, n, replace=False))
+        positions.append(selected + offset)
+        subsetCounts.append(n)
+        offset += count
+
+    if not positions:
+        return np.zeros(0, dtype=int), subsetCounts
+    return np.concatenate(positions), subsetCounts
+
+
+class FrealignBlockPlan(object):
+    """ Split of the input particles, sorted by micrograph, into blocks
+    of contiguous micrographs. It is computed once and then used to
+    look up the particle range of each block in constant time.
+    """
+    def __init__(self, micList, particlesPerBlock):
+        """
+        Params:
+            micList: list of dicts with the '_micId' and the 'count'
+                (number of particles) of each micrograph.
+            particlesPerBlock: list with the number of particles
+                assigned to each block.
+        """
+        self.micList = sorted(micList, key=lambda k: k['_micId'])
+        # micOffsets[i] is the number of particles before micrograph i
+        self.micOffsets = [0]
+        for mic in self.micList:
+            self.micOffsets.append(self.micOffsets[-1] + mic['count'])
+
+        self.ranges = []
+        finalPart = 0
+        for n in particlesPerBlock:
+            self.ranges.append((finalPart + 1, finalPart + n))
+            finalPart += n
+        self._finalParts = [finalPart for _, finalPart in self.ranges]
+
+    def getNumberOfBlocks(self):
+        return len(self.ranges)
+
+    def getNumberOfParticles(self):
+        return self.micOffsets[-1]
+
+    def getRange(self, block):
+        """ Return the initial and final particle numbers of the block
+        (blocks are numbered from 1).
+        """
+        return self.ranges[block - 1]
+
+    def getBlock(self, partNumber):
+        """ Return the block that contains the given particle number. """
+        return bisect_left(self._finalParts, partNumber) + 1
+
+    def toDict(self):
+        return {'micList': self.micList,
+                'particlesPerBlock': [final - init + 1
+                                      for init, final in self.ranges]}
+
+    @classmethod
+    def fromDict(cls, planDict):
+        return cls(planDict['micList'], planDict['particlesPerBlock'])
+
+    @classmethod
+    def loadPlans(cls, text):
+        """ Load the plans stored with storePlans, as a dict
+        indexed by the number of blocks.
+        """
+        return dict((int(k), cls.fromDict(v))
+                    for k, v in json.loads(text or '{}').items())
+
+    @classmethod
+    def storePlans(cls, plans):
+        """ Return the given dict of plans (by number of blocks)
+        serialized as a json string.
+        """
+        return json.dumps(dict((str(k), plan.toDict())
+                               for k, plan in plans.items()))
+
+
+def iterBlockCtfLines(ctfFn, lastPart):
+    """ Iterate over the CTF lines (card 7 of Frealign) of a block that
+    ends in particle lastPart. As in the original per-block files, the
+    block gets the lines of the particles from the first one to lastPart,
+    whatever its first particle. ctfFn has a line per particle without
+    the MORE flag, that is 1 in all the lines but the last one.
+    """
+    with open(ctfFn) as f:
+        for partNumber, line in enumerate(f, 1):
+            more = 0 if partNumber == lastPart else 1
+            yield '%s, %d\n' % (line.rstrip('\n'), more)
+            if not more:
+                break
+
+
+def fileDigest(filename, chunkSize=1 << 20):
+    """ Return the sha1 hex digest of the content of a file. """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def jobSignature(params, inputFiles=()):
+    """ Return a digest that identifies a Frealign job: its parameters
+    and the size and modification time (in whole seconds) of its input
+    files. Two executions of a job with the same signature are expected
+    to give the same output.
+    """
+    sha = hashlib.sha1(json.dumps(params, sort_keys=True, default=str))
+    for fn in inputFiles:
+        if exists(fn):
+            sha.update('%s %d %d\n' % (fn, getsize(fn), int(getmtime(fn))))
+        else:
+            sha.update('%s missing\n' % fn)
+    return sha.hexdigest()
+
+
+class FrealignBlockManifest(object):
+    """ Json file that records the blocks of an iteration whose output
+    .par file was checked to be complete, with the size and content
+    digest of the file at that moment and the signature of the job that
+    produced it (see jobSignature). It allows to skip them when an
+    interrupted run is resumed with the same parameters.
+    """
+    # Blocks are run in parallel threads that update the same file
+    _lock = threading.Lock()
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _load(self):
+        if not exists(self.filename):
+            return {}
+        with open(self.filename) as f:
+            return json.load(f)
+
+    def isDone(self, key, parFn, signature=None):
+        """ Return True if the block was recorded as done by a job with
+        the same signature and its .par file has not changed since then.
+        """
+        with self._lock:
+            entry = self._load().get(key)
+        return (entry is not None and exists(parFn)
+                and entry.get('signature') == signature
+                and getsize(parFn) == entry['size']
+                and fileDigest(parFn) == entry['sha1'])
+
+    def setDone(self, key, parFn, signature=None, **info):
+        """ Record the block as done, with its .par file, the signature
+        of the job and any other info given.
+        """
+        info.update(size=getsize(parFn), sha1=fileDigest(parFn),
+                    signature=signature)
+        with self._lock:
+            entries = self._load()
+            entries[key] = info
+            tmpFn = self.filename + '.tmp'
+            with open(tmpFn, 'w') as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+            os.rename(tmpFn, self.filename)
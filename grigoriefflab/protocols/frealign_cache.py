@@ -0,0 +1,204 @@
+# **************************************************************************
+# *
+# * Authors:     Josue Gomez Blanco (josue.gomez-blanco@mcgill.ca)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+This module contains helpers to avoid copying big files in Frealign
+protocols: a cache of the particle stacks, so runs over the same
+particles can share a single stack, and the staging of volumes.
+"""
+
+import os
+import hashlib
+import shutil
+from os.path import join, exists
+
+
+class FrealignStackCache(object):
+    """ Directory with particle stacks named after a hash of the data
+    they were written from. Entries are linked into the runs that use
+    them and evicted in least recently used order when the cache gets
+    bigger than maxSize.
+    Note that maxSize only limits the stacks in the cache directory: an
+    evicted stack that is hard-linked by some runs keeps its disk space
+    until those links are removed too.
+    """
+    EXTENSION = '.mrc'
+
+    def __init__(self, cacheDir, maxSize):
+        """
+        Params:
+            cacheDir: directory where the stacks are stored.
+            maxSize: maximum size (in bytes) of all the stacks.
+        """
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+
+    @staticmethod
+    def getKey(*values):
+        """ Return a key for the given values, that should identify the
+        content of the stack (input set, item ids, ordering...).
+        Values that are lists are hashed item by item.
+        """
+        sha = hashlib.sha1()
+        for value in values:
+            if isinstance(value, (list, tuple)):
+                for item in value:
+                    sha.update('%s,' % (item,))
+            else:
+                sha.update('%s' % (value,))
+            sha.update('|')
+        return sha.hexdigest()
+
+    def getPath(self, key):
+        return join(self.cacheDir, key + self.EXTENSION)
+
+    def get(self, key):
+        """ Return the path of the stack with this key, or None if it is
+        not in the cache. A hit marks the entry as recently used.
+        """
+        path = self.getPath(key)
+        if not exists(path):
+            return None
+        os.utime(path, None)
+        return path
+
+    def add(self, key, size, writeFunc):
+        """ Add a new stack to the cache.
+        Params:
+            key: key of the stack (see getKey).
+            size: expected size of the stack in bytes.
+            writeFunc: function that receives a filename and writes the
+                stack into it.
+        Return the path of the cached stack, or None if the stack does
+        not fit in the cache.
+        """
+        if size > self.maxSize:
+            return None
+        if not exists(self.cacheDir):
+            os.makedirs(self.cacheDir)
+        self.evict(self.maxSize - size)
+
+        path = self.getPath(key)
+        # Write to a temporary name, so an interrupted write or another
+        # run adding the same key never leaves a partial entry
+        tmpPath = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            writeFunc(tmpPath)
+            os.rename(tmpPath, path)
+        finally:
+            if exists(tmpPath):
+                os.remove(tmpPath)
+        return path
+
+    def getEntries(self):
+        """ Return a list of (lastUse, size, path) of the cached stacks,
+        the least recently used first.
+        """
+        entries = []
+        if exists(self.cacheDir):
+            for fn in os.listdir(self.cacheDir):
+                if fn.endswith(self.EXTENSION):
+                    path = join(self.cacheDir, fn)
+                    stat = os.stat(path)
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self, maxSize):
+        """ Remove least recently used stacks until the cache size is not
+        bigger than maxSize. Runs that use a removed stack keep their
+        own link or copy of the data (see link).
+        """
+        entries = self.getEntries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= maxSize:
+                break
+            os.remove(path)
+            total -= size
+
+    @staticmethod
+    def link(path, dest):
+        """ Make dest a copy of the cached stack in path that is not
+        broken by eviction: a clone or a hard link when possible, and a
+        real copy otherwise (e.g. across filesystems), see stageFile.
+        Return the method used, or None if the stack was evicted (by
+        another run) after it was found in the cache.
+        """
+        try:
+            return stageFile(path, dest, readOnly=True)
+        except (IOError, OSError):
+            if exists(path):
+                raise
+            if os.path.lexists(dest):
+                os.remove(dest)
+            return None
+
+
+# ioctl request to clone a file (share its blocks) in Linux (FICLONE)
+FICLONE = 0x40049409
+
+STAGE_REFLINK = 'reflink'
+STAGE_HARDLINK = 'hardlink'
+STAGE_COPY = 'copy'
+
+
+def _reflink(src, dst):
+    """ Make dst a copy-on-write clone of src. It only works on
+    filesystems that support it (e.g. btrfs, xfs), otherwise it
+    raises IOError or OSError.
+    """
+    import fcntl
+    with open(src, 'rb') as fSrc:
+        with open(dst, 'wb') as fDst:
+            fcntl.ioctl(fDst.fileno(), FICLONE, fSrc.fileno())
+
+
+def stageFile(src, dst, readOnly=False):
+    """ Make dst have the same content as src with the cheapest
+    available method:
+    - reflink: a copy-on-write clone, that is safe to modify.
+    - hardlink: only if readOnly, since both names share the data.
+    - copy: a plain copy, if none of the above is possible.
+    Return the method used (STAGE_REFLINK, STAGE_HARDLINK or STAGE_COPY).
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        _reflink(src, dst)
+        return STAGE_REFLINK
+    except (IOError, OSError, ImportError):
+        if exists(dst):
+            os.remove(dst)
+
+    if readOnly:
+        try:
+            os.link(src, dst)
+            return STAGE_HARDLINK
+        except OSError:
+            pass
+
+    shutil.copyfile(src, dst)
+    return STAGE_COPY
@@ -0,0 +1,119 @@
+# **************************************************************************
+# *
+# * Authors:     Josue Gomez Blanco (josue.gomez-blanco@mcgill.ca)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+"""
+This module contains a helper class to remove the intermediate files of
+old Frealign iterations in the background (see ProtFrealignBase
+keepIterations).
+"""
+
+import os
+import threading
+from Queue import Queue
+from os.path import join, exists, getsize, isdir
+
+from grigoriefflab.convert import compressParFile, PAR_COMPRESSED_EXTS
+
+
+def cleanIterDir(iterDir, keepFiles, parFiles=(), compressExt=None):
+    """ Remove all files of an iteration directory but keepFiles and
+    parFiles (names relative to iterDir), compressing the parFiles with
+    the compression of compressExt if given (see compressParFile).
+    Return the number of files removed and the bytes freed.
+    """
+    keep = set(keepFiles)
+    for fn in parFiles:
+        keep.add(fn)
+        keep.update(fn + ext for ext in PAR_COMPRESSED_EXTS)
+
+    removed, freed = 0, 0
+    for fn in os.listdir(iterDir):
+        path = join(iterDir, fn)
+        if fn in keep or isdir(path):
+            continue
+        freed += getsize(path)
+        os.remove(path)
+        removed += 1
+
+    if compressExt:
+        for fn in parFiles:
+            path = join(iterDir, fn)
+            if exists(path):
+                size = getsize(path)
+                freed += size - getsize(compressParFile(path, compressExt))
+    return removed, freed
+
+
+class FrealignIterCleaner(object):
+    """ Clean the directories of the iterations (see cleanIterDir) one
+    after the other in a background thread, so the cleanup never delays
+    the next iteration. The thread is started with the first directory
+    and stopped by join.
+    """
+    def __init__(self, log=None):
+        """
+        Params:
+            log: function called with a message for each cleaned directory.
+        """
+        self._log = log
+        self._queue = Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.errors = []
+
+    def submit(self, iterDir, keepFiles, parFiles=(), compressExt=None):
+        """ Add an iteration directory to be cleaned. """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='FrealignIterCleaner')
+                self._thread.start()
+            self._queue.put((iterDir, keepFiles, parFiles, compressExt))
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            iterDir = task[0]
+            try:
+                if exists(iterDir):
+                    removed, freed = cleanIterDir(*task)
+                    if self._log:
+                        self._log("Cleaned %s: %d files removed, %0.1f MB freed"
+                                  % (iterDir, removed, freed / 1e6))
+            except Exception as e:
+                self.errors.append("Could not clean %s: %s" % (iterDir, e))
+
+    def join(self):
+        """ Wait until all submitted directories are cleaned and return
+        the list of errors found.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join()
+        return self.errors
@@ -0,0 +1,119 @@
+# **************************************************************************
+# *
+# * Authors:     Josue Gomez Blanco (josue.gomez-blanco@mcgill.ca)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+"""
+This module contains helper functions to estimate the memory used by
+Frealign with each memory mode (parameter IMEM), and to choose the
+fastest mode that fits in the memory of the node.
+"""
+
+import os
+
+
+# Memory modes, from the fastest to the one that uses less memory.
+# Padding the reference speeds up the refinement, that is the most
+# expensive part, so it goes before the multi-volume reconstruction.
+MEMORY_MODES = [3, 1, 2, 0]
+
+# Fraction of the available memory that the jobs can use
+MEMORY_SAFETY = 0.8
+
+# Frealign fixed memory (program, image buffers...) in MB
+FREALIGN_BASE_MB = 50.
+
+
+def isPaddedMode(memoryMode):
+    """ The reference is padded in refinement with modes 1 and 3. """
+    return memoryMode in (1, 3)
+
+
+def isMultiVolumeMode(memoryMode):
+    """ Each thread has its own reconstruction arrays with modes 2 and 3. """
+    return memoryMode in (2, 3)
+
+
+def estimateFrealignMemory(boxSize, memoryMode, kind, numberOfThreads=1):
+    """ Return the memory (in MB) that a Frealign job is expected to use.
+    The model counts the 3D arrays of a box of boxSize^3 voxels:
+     - the reference volume (4 bytes per voxel) and its Fourier
+       transform, padded twice in each dimension in modes 1 and 3
+       (8 bytes per complex voxel), only when refining.
+     - the reconstruction arrays, the sums of the two half sets and
+       their weights (24 bytes per voxel), one copy per thread in the
+       multi-volume modes 2 and 3.
+    The symmetry is applied on the fly, so it does not change the memory.
+    Params:
+        kind: 'refine' or 'reconstruct'.
+        numberOfThreads: threads of the job (NCPUS), only used by the
+            reconstruction.
+    """
+    voxels = float(boxSize) ** 3
+    size = 4 * voxels  # reference or output volume
+    if kind == 'refine':
+        pad = 8 if isPaddedMode(memoryMode) else 1
+        size += 8 * pad * voxels
+    copies = numberOfThreads if isMultiVolumeMode(memoryMode) else 1
+    size += 24 * voxels * copies
+    return FREALIGN_BASE_MB + size / (1024 * 1024)
+
+
+def estimatePeakMemory(boxSize, memoryMode, phases):
+    """ Return the peak memory (in MB) of several Frealign jobs running at
+    the same time. phases is a list with the jobs of each phase of an
+    iteration, as (kind, numberOfThreads) tuples.
+    """
+    return max(sum(estimateFrealignMemory(boxSize, memoryMode, kind, threads)
+                   for kind, threads in jobs)
+               for jobs in phases)
+
+
+def getAvailableMemory():
+    """ Return the memory (in MB) available in the node for new processes,
+    or None if it can not be read.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    try:
+        return (os.sysconf('SC_AVPHYS_PAGES') *
+                os.sysconf('SC_PAGE_SIZE')) / (1024. * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def chooseMemoryMode(boxSize, phases, availableMemory):
+    """ Return the fastest memory mode whose estimated peak memory fits
+    in the available memory (see MEMORY_SAFETY), and its estimate.
+    If none of them fits, or the available memory is unknown (None),
+    the one that uses less memory is returned.
+    """
+    for memoryMode in MEMORY_MODES:
+        peak = estimatePeakMemory(boxSize, memoryMode, phases)
+        if availableMemory is not None and peak <= availableMemory * MEMORY_SAFETY:
+            break
+    return memoryMode, peak
@@ -0,0 +1,139 @@
+# **************************************************************************
+# *
+# * Authors:     Josue Gomez Blanco (josue.gomez-blanco@mcgill.ca)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+"""
+This module contains helper classes to predict the CPU time and the disk
+space used by a Frealign run, calibrated with the metrics of the jobs of
+previous runs (see program_runner.ProgramRunner).
+"""
+
+# CPU seconds per particle and pixel of the box, used when there are no
+# metrics of previous jobs.
+DEFAULT_REFINE_COST = 5e-6
+DEFAULT_RECONSTRUCT_COST = 2e-7
+# CPU seconds per voxel of the box to prepare the volumes of each job
+VOLUME_COST = 2e-8
+# Only the most recent jobs are used to calibrate the model
+CALIBRATION_JOBS = 20
+
+# Orientations (in square degrees) and function evaluations in a
+# local refinement, to compare the cost of a search with a refinement.
+SPHERE_DEG2 = 41253.
+LOCAL_EVALUATIONS = 100.
+
+# Bytes of each line of a .par file
+PAR_LINE_BYTES = 140
+# Volumes written in each iteration and class: reference, refined,
+# weights, half maps, phase differences and point spread function.
+VOLUMES_PER_ITER = 7
+
+
+def searchFactor(mode, angStepSize, numberRandomSearch):
+    """ Return the relative cost of the orientation search of a particle
+    with respect to a local refinement (mode 1), for the Frealign mode
+    (IFLAG, the negative ones of the first iteration included).
+    """
+    mode = abs(mode)
+    if mode == 0:
+        return 0.
+    if mode in (3, 4):
+        factor = max(SPHERE_DEG2 / max(angStepSize, 0.1) ** 2 / LOCAL_EVALUATIONS, 1.)
+        if mode == 4:
+            factor += max(numberRandomSearch, 0)
+        return factor
+    return 1.
+
+
+class FrealignCostModel(object):
+    """ Cost of the Frealign refinement and reconstruction jobs, in CPU
+    seconds per particle and pixel of the box. It is the median of the
+    costs measured in the given jobs metrics, or a default one.
+    """
+    def __init__(self, metrics=()):
+        self.refineCost, self.refineJobs = self._calibrate(
+            metrics, 'refine', DEFAULT_REFINE_COST)
+        self.reconstructCost, self.reconstructJobs = self._calibrate(
+            metrics, 'reconstruct', DEFAULT_RECONSTRUCT_COST)
+
+    def _calibrate(self, metrics, kind, default):
+        costs = []
+        jobs = [m for m in metrics if m.get('kind') == kind
+                and m.get('exitCode') == 0 and m.get('particles')
+                and m.get('boxSize') and m.get('user') is not None]
+        jobs.sort(key=lambda m: m.get('time', 0))
+        for m in jobs[-CALIBRATION_JOBS:]:
+            work = m['particles'] * m['boxSize'] ** 2
+            if kind == 'refine':
+                work *= searchFactor(m.get('mode', 1), m.get('angStepSize', 10.),
+                                     m.get('numberRandomSearch', 0))
+            if work > 0:
+                costs.append((m['user'] + m['sys']) / work)
+        if not costs:
+            return default, 0
+        costs.sort()
+        return costs[len(costs) / 2], len(costs)
+
+    def isCalibrated(self):
+        return self.refineJobs > 0 or self.reconstructJobs > 0
+
+    def refineTime(self, particles, boxSize, mode, angStepSize,
+                   numberRandomSearch, numberOfBlocks):
+        """ CPU seconds to refine the particles, split in blocks. """
+        factor = searchFactor(mode, angStepSize, numberRandomSearch)
+        if factor == 0:
+            return 0.
+        return (self.refineCost * particles * boxSize ** 2 * factor +
+                VOLUME_COST * boxSize ** 3 * numberOfBlocks)
+
+    def reconstructTime(self, particles, boxSize):
+        """ CPU seconds to reconstruct a volume from the particles. """
+        return (self.reconstructCost * particles * boxSize ** 2 +
+                VOLUME_COST * boxSize ** 3)
+
+
+def estimateIterDisk(particles, boxSize, numberOfVolumes=1,
+                     writeMatchProj=False, cleaned=False):
+    """ Return the bytes written in the directory of an iteration:
+    the volumes and parameter files (input and output of the blocks,
+    merged and of the reconstruction) of each class, and the stacks of
+    matching projections of the refinement and the reconstruction.
+    If cleaned, only the volume and the merged and reconstruction
+    parameter files are counted (see ProtFrealignBase keepIterations).
+    """
+    if cleaned:
+        return (4 * boxSize ** 3 + 2 * PAR_LINE_BYTES * particles) * numberOfVolumes
+    volumes = VOLUMES_PER_ITER * 4 * boxSize ** 3
+    parFiles = 4 * PAR_LINE_BYTES * particles
+    disk = volumes + parFiles
+    if writeMatchProj:
+        disk += 2 * 4 * boxSize ** 2 * particles
+    return disk * numberOfVolumes
+
+
+def formatDuration(seconds):
+    """ Return the duration as a string with hours and minutes. """
+    minutes = int(round(seconds / 60.))
+    if minutes < 60:
+        return '%d min' % minutes
+    return '%dh %02dmin' % (minutes / 60, minutes % 60)
@@ -0,0 +1,102 @@
+# **************************************************************************
+# *
+# * Authors:     Josue Gomez Blanco (josue.gomez-blanco@mcgill.ca)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+This module contains helper classes to distribute the jobs of a Frealign
+iteration between worker steps, that take the next pending job as soon
+as they finish the previous one.
+"""
+
+import os
+import json
+import threading
+from os.path import exists
+
+
+class FrealignTaskPool(object):
+    """ Thread-safe queue of the tasks of an iteration, sorted by their
+    estimated cost (the most expensive first), so the longest tasks do
+    not start at the end and leave the other workers idle.
+    """
+    # Used to create the pools of a protocol only once
+    lock = threading.Lock()
+
+    def __init__(self, tasks):
+        """
+        Params:
+            tasks: list of (cost, task) pairs.
+        """
+        self._tasks = [task for _, task in
+                       sorted(tasks, key=lambda t: t[0], reverse=True)]
+        self._lock = threading.Lock()
+
+    def next(self):
+        """ Return the next task, or None if there are no more. """
+        with self._lock:
+            return self._tasks.pop(0) if self._tasks else None
+
+
+class FrealignTaskTimes(object):
+    """ Json file with the measured duration of the tasks, as seconds
+    per particle, grouped by kind of task and key (e.g. the class).
+    They are used to estimate the cost of the tasks of later iterations.
+    """
+    # Number of last measures used in the estimations
+    LAST_MEASURES = 5
+    _lock = threading.Lock()
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _load(self):
+        if not exists(self.filename):
+            return {}
+        with open(self.filename) as f:
+            return json.load(f)
+
+    def add(self, kind, key, seconds, particles):
+        """ Record the duration of a task that processed the given
+        number of particles.
+        """
+        with self._lock:
+            times = self._load()
+            measures = times.setdefault(kind, {}).setdefault(str(key), [])
+            measures.append(float(seconds) / max(particles, 1))
+            tmpFn = self.filename + '.tmp'
+            with open(tmpFn, 'w') as f:
+                json.dump(times, f, indent=1, sort_keys=True)
+            os.rename(tmpFn, self.filename)
+
+    def getRate(self, kind, key):
+        """ Return the estimated seconds per particle of a task: the mean
+        of the last measures with the same key, or of all measures of
+        this kind of task if there are none, or 1 otherwise.
+        """
+        with self._lock:
+            measures = self._load().get(kind, {})
+        values = measures.get(str(key), [])[-self.LAST_MEASURES:]
+        if not values:
+            values = [v for m in measures.values() for v in m[-self.LAST_MEASURES:]]
+        return sum(values) / len(values) if values else 1.
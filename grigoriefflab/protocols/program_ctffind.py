@@ -115,19 +115,17 @@ class ProgramCtffind:
         # FIXME: number of threads are used for steps, not for OpenMP, what should we do?
         # useThreads = self._protocol.numberOfThreads > 1
         useThreads = False
-        program = 'export OMP_NUM_THREADS=1; '  # FIXME: consider using OpenMPI threads
-        program += Plugin.getProgram(CTFFIND4, useMP=useThreads)
+        return Plugin.getProgram(CTFFIND4, useMP=useThreads)
 
-        return program
-
-    def getCommand(self, **kwargs):
-        """ Return the program and arguments to be run.
-        The input keywords argument should contain key-values for
-        one micrograph or group of micrographs.
+    def run(self, runner, **kwargs):
+        """ Run the program with the given ProgramRunner, feeding it
+        the arguments through stdin. The input keywords argument should
+        contain key-values for one micrograph or group of micrographs.
         """
         params = dict(self._params)
         params.update(kwargs)
-        return self._program, self._args % params
+        runner.run(self._program, inputLines=[self._args % params],
+                   logFn=params['ctffindOut'], numberOfThreads=1)
 
     def parseOutput(self, filename):
         """ Retrieve defocus U, V and angle from the
@@ -173,8 +171,7 @@ class ProgramCtffind:
         if downFactor != 1:
             params['scannedPixelSize'] *= downFactor
 
-        args = """   << eof > %(ctffindOut)s
-%(micFn)s
+        args = """%(micFn)s
 %(ctffindPSD)s"""
         args += self._getExtraArgs()
         return args, params
@@ -224,5 +221,5 @@ no
                                 '%(maxPhaseShift)f\n'
                                 '%(stepPhaseShift)f')
 
-        return args + 'eof\n'
+        return args.rstrip('\n') + '\n'
 
@@ -0,0 +1,291 @@
+# **************************************************************************
+# *
+# * Authors:     Josue Gomez Blanco (josue.gomez-blanco@mcgill.ca)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+"""
+This module contains helper classes to run the Grigorieff lab programs
+directly, without a shell, feeding their interactive input through stdin,
+and to keep a record of the resources used by each execution.
+"""
+
+import os
+import json
+import time
+import errno
+import signal
+import tempfile
+import threading
+import subprocess
+from os.path import exists, basename, abspath
+
+from grigoriefflab import Plugin
+
+
+METRICS_FILE = 'program_metrics.jsonl'
+
+
+def runProgram(program, args=None, inputLines=None, logFn=None, cwd=None,
+               env=None, timeout=None):
+    """ Run a program and wait until it finishes.
+    Params:
+        program: path of the executable.
+        args: list with the command line arguments.
+        inputLines: iterable over the lines (with the line break) that are
+            written to the program stdin, as they are produced.
+        logFn: file where the program output is written (by default,
+            the output of the current process).
+        cwd: working directory of the program.
+        env: environment of the program (by default, the current one).
+        timeout: seconds after which the program is killed.
+    Return a dict with the exit code of the program (negative if it was
+    killed by a signal), whether it timed out, and its wall time, user
+    and system CPU time (in seconds) and peak resident memory (in MB).
+    """
+    cmd = [program] + list(args or [])
+    log = open(logFn, 'w') if logFn else None
+    timer = None
+    timedOut = []
+    try:
+        stdin = subprocess.PIPE if inputLines is not None else None
+        start = time.time()
+        process = subprocess.Popen(cmd, stdin=stdin, stdout=log, cwd=cwd,
+                                   env=env)
+        if timeout:
+            def kill():
+                timedOut.append(True)
+                try:
+                    os.kill(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+
+        if inputLines is not None:
+            try:
+                for line in inputLines:
+                    process.stdin.write(line)
+            except IOError as e:
+                # The program exited before reading all its input,
+                # its exit code tells what went wrong.
+                if e.errno != errno.EPIPE:
+                    raise
+            finally:
+                try:
+                    process.stdin.close()
+                except IOError:
+                    pass
+
+        # wait4 gives the resources used by this child only
+        while True:
+            try:
+                _, status, rusage = os.wait4(process.pid, 0)
+                break
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+        wall = time.time() - start
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if log is not None:
+            log.close()
+
+    if os.WIFSIGNALED(status):
+        exitCode = -os.WTERMSIG(status)
+    else:
+        exitCode = os.WEXITSTATUS(status)
+    process.returncode = exitCode
+
+    return {'exitCode': exitCode,
+            'timedOut': bool(timedOut),
+            'wall': wall,
+            'user': rusage.ru_utime,
+            'sys': rusage.ru_stime,
+            'maxRss': rusage.ru_maxrss / 1024.  # ru_maxrss is in KB
+            }
+
+
+class ProgramRunner(object):
+    """ Run the programs of a protocol, setting the number of threads
+    they use, with an optional timeout and number of retries. The
+    resources used by each execution are appended to the metrics file
+    of the protocol (a json dict per line).
+    When the protocol runs with MPI or through a queue, the programs are
+    launched with the protocol runJob, so they go to the MPI nodes or the
+    queue as the other jobs (see useRunJob). Only their wall time is
+    recorded then, and the timeout is not applied.
+    """
+    # Executions from different steps can finish at the same time
+    lock = threading.Lock()
+
+    def __init__(self, protocol, timeout=None, retries=0):
+        self._protocol = protocol
+        self.timeout = timeout
+        self.retries = retries
+        self.metricsFn = protocol._getExtraPath(METRICS_FILE)
+
+    def runBinary(self, binaryKey, programKey='', useMP=False, **kwargs):
+        """ Run a program of the plugin (see Plugin.getProgram).
+        The keyword arguments are the ones of run.
+        """
+        program = Plugin.getProgram(binaryKey, programKey, useMP=useMP)
+        return self.run(program, **kwargs)
+
+    def run(self, program, args=None, inputLines=None, logFn=None, cwd=None,
+            numberOfThreads=1, env=None, timeout=None, retries=None,
+            **info):
+        """ Run a program (see runProgram) and record its metrics, with
+        the extra info given as keyword arguments (number of particles,
+        box size...).
+        Params:
+            inputLines: a list with the input lines or, when the input
+                is generated on the fly, a function that returns an
+                iterator over them (so it can be generated again if the
+                execution is retried).
+            numberOfThreads: set in the OMP_NUM_THREADS and NCPUS
+                environment variables of the program.
+            env: extra environment variables for the program.
+            timeout, retries: override the ones of the runner.
+        An Exception is raised if the program does not finish successfully
+        after all retries.
+        """
+        if not exists(program):
+            raise Exception('Missing ' + program)
+
+        programEnv = dict(os.environ)
+        programEnv['OMP_NUM_THREADS'] = str(numberOfThreads)
+        programEnv['NCPUS'] = str(numberOfThreads)
+        programEnv.update(env or {})
+
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+
+        if self.useRunJob():
+            return self._runJob(program, args, inputLines, logFn, cwd,
+                                numberOfThreads, programEnv, retries, info)
+
+        for attempt in range(retries + 1):
+            self._protocol.info("Running %s %s%s" % (program, ' '.join(args or []),
+                                                     ' (log: %s)' % logFn if logFn else ''))
+            lines = inputLines() if callable(inputLines) else inputLines
+            usage = runProgram(program, args, lines, logFn, cwd, programEnv,
+                               timeout)
+            metrics = dict(info)
+            metrics.update(usage)
+            metrics.update({'program': basename(program),
+                            'threads': numberOfThreads,
+                            'attempt': attempt + 1,
+                            'time': time.time()})
+            self._addMetrics(metrics)
+
+            if usage['exitCode'] == 0:
+                return metrics
+
+        raise Exception("Program %s failed with exit code %d%s%s"
+                        % (program, usage['exitCode'],
+                           ' after %d seconds timeout' % timeout if usage['timedOut'] else '',
+                           ' (see %s)' % logFn if logFn else ''))
+
+    def useRunJob(self):
+        """ Return True if the programs must be launched with the
+        protocol runJob, instead of directly in this process.
+        """
+        protocol = self._protocol
+        return protocol.numberOfMpi.get() > 1 or bool(protocol.useQueue())
+
+    def _runJob(self, program, args, inputLines, logFn, cwd, numberOfThreads,
+                env, retries, info):
+        """ Run the program with the protocol runJob, redirecting its
+        input from a file with inputLines and its output to logFn.
+        """
+        cmdArgs = ' '.join(args or [])
+        inputFn = None
+        if inputLines is not None:
+            fd, inputFn = tempfile.mkstemp(suffix='.stdin',
+                                           dir=self._protocol._getTmpPath())
+            with os.fdopen(fd, 'w') as f:
+                lines = inputLines() if callable(inputLines) else inputLines
+                for line in lines:
+                    f.write(line)
+            cmdArgs += ' < %s' % abspath(inputFn)
+        if logFn:
+            cmdArgs += ' > %s' % abspath(logFn)
+
+        try:
+            for attempt in range(retries + 1):
+                start = time.time()
+                try:
+                    self._protocol.runJob(program, cmdArgs, cwd=cwd, env=env,
+                                          numberOfMpi=1,
+                                          numberOfThreads=numberOfThreads)
+                    exitCode = 0
+                except Exception as e:
+                    self._protocol.info("%s failed: %s" % (program, e))
+                    exitCode = None
+                metrics = dict(info)
+                metrics.update({'exitCode': exitCode,
+                                'timedOut': False,
+                                'wall': time.time() - start,
+                                'user': None,
+                                'sys': None,
+                                'maxRss': None,
+                                'program': basename(program),
+                                'threads': numberOfThreads,
+                                'attempt': attempt + 1,
+                                'time': time.time()})
+                self._addMetrics(metrics)
+
+                if exitCode == 0:
+                    return metrics
+        finally:
+            if inputFn is not None and exists(inputFn):
+                os.remove(inputFn)
+
+        raise Exception("Program %s failed%s"
+                        % (program, ' (see %s)' % logFn if logFn else ''))
+
+    def _addMetrics(self, metrics):
+        with ProgramRunner.lock:
+            with open(self.metricsFn, 'a') as f:
+                f.write(json.dumps(metrics, sort_keys=True) + '\n')
+
+    def getMetrics(self, program=None):
+        """ Return the list of metrics recorded in the protocol, only
+        the ones of the given program (the executable name) if not None.
+        """
+        return readProgramMetrics(self.metricsFn, program)
+
+
+def readProgramMetrics(metricsFn, program=None):
+    """ Return the list of metrics of a metrics file (see ProgramRunner),
+    only the ones of the given program if not None.
+    """
+    metrics = []
+    if exists(metricsFn):
+        with open(metricsFn) as f:
+            for line in f:
+                if line.strip():
+                    m = json.loads(line)
+                    if program is None or m['program'] == program:
+                        metrics.append(m)
+    return metrics
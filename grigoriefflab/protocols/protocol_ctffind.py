@@ -32,6 +32,7 @@ import pyworkflow as pw
 import grigoriefflab.convert as convert
 from grigoriefflab.constants import *
 from .program_ctffind import ProgramCtffind
+from .program_runner import ProgramRunner
 from grigoriefflab import Plugin
 
 
@@ -102,13 +103,13 @@ class ProtCTFFind(pw.em.ProtCTFMicrographs):
             import traceback
             traceback.print_exc()
         try:
-            program, args = self._ctfProgram.getCommand(
+            self._ctfProgram.run(
+                ProgramRunner(self),
                 micFn=micFnMrc,
                 ctffindOut=self._getCtfOutPath(mic),
                 ctffindPSD=self._getPsdPath(mic),
                 **kwargs
             )
-            self.runJob(program, args)
 
             pw.utils.cleanPath(micDir)
 
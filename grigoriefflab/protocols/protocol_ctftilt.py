@@ -34,6 +34,7 @@ from pyworkflow import VERSION_1_2
 from grigoriefflab import Plugin
 from grigoriefflab.constants import (CTFFIND, CTFTILT)
 from grigoriefflab.convert import readCtfModel, parseCtftiltOutput
+from .program_runner import ProgramRunner
 
 
 class ProtCTFTilt(em.ProtCTFMicrographs):
@@ -121,7 +122,7 @@ class ProtCTFTilt(em.ProtCTFMicrographs):
             program, args = self._getCommand(micFn=micFnMrc,
                                              ctftiltOut=self._getCtfOutPath(micDir),
                                              ctftiltPSD=self._getPsdPath(micDir))
-            self.runJob(program, args)
+            self._runCtftilt(program, args, self._getCtfOutPath(micDir))
         except Exception as ex:
             print >> sys.stderr, "ctftilt has failed with micrograph %s" % micFnMrc
 
@@ -149,7 +150,7 @@ class ProtCTFTilt(em.ProtCTFMicrographs):
         try:
             program, args = self._getRecalCommand(
                 ctfModel, micFn=micFnMrc, ctftiltOut=out, ctftiltPSD=psdFile)
-            self.runJob(program, args)
+            self._runCtftilt(program, args, out)
         except Exception as ex:
             print >> sys.stderr, "ctftilt has failed with micrograph %s" % micFnMrc
         pwutils.cleanPattern(micFnMrc)
@@ -250,17 +251,20 @@ class ProtCTFTilt(em.ProtCTFMicrographs):
     def _useThreads(self):
         return self.numberOfThreads > 1
 
+    def _runCtftilt(self, program, args, ctftiltOut):
+        """ Run ctftilt feeding args through stdin. """
+        numberOfThreads = self.numberOfThreads.get() if self._useThreads() else 1
+        ProgramRunner(self).run(program, inputLines=[args], logFn=ctftiltOut,
+                                numberOfThreads=numberOfThreads,
+                                env={'NATIVEMTZ': 'kk'})
+
     def _getCommandFromParams(self, params):
-        program = 'export NATIVEMTZ=kk ; '
-        if self._useThreads():
-            program += 'export NCPUS=%d ;' % self.numberOfThreads
-        program += self._getProgram()
-        args = """   << eof > %(ctftiltOut)s
-%(micFn)s
+        """ Return the program and its input (read from stdin). """
+        program = self._getProgram()
+        args = """%(micFn)s
 %(ctftiltPSD)s
 %(sphericalAberration)f,%(voltage)f,%(ampContrast)f,%(magnification)f,%(scannedPixelSize)f,%(pixelAvg)d
 %(windowSize)d,%(lowRes)f,%(highRes)f,%(minDefocus)f,%(maxDefocus)f,%(step_focus)f,%(astigmatism)f,%(tiltAngle)f,%(tiltR)f
-eof
 """
         return program, args % params
 
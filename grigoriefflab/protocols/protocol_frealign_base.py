@@ -26,10 +26,13 @@
 """This module contains the protocol base class for frealign protocols"""
 
 import os
+import json
+import tempfile
 from os.path import join, exists, basename
+import numpy as np
 
-from pyworkflow.object import Integer
-from pyworkflow.utils.path import copyFile, createLink, makePath, moveFile
+from pyworkflow.object import Integer, String
+from pyworkflow.utils.path import copyFile, createLink, makePath, cleanPath
 from pyworkflow.protocol.constants import STEPS_PARALLEL, LEVEL_ADVANCED
 from pyworkflow.protocol.params import (StringParam, BooleanParam, IntParam,
                                         PointerParam, EnumParam, FloatParam,
@@ -38,8 +41,28 @@ from pyworkflow.em.protocol import EMProtocol
 from pyworkflow.em.convert import ImageHandler
 
 from grigoriefflab import Plugin
-from grigoriefflab.convert import geometryFromMatrix
+from grigoriefflab.convert import (geometryFromMatrices, writeParAngles,
+                                   splitParFile, mergeParFiles,
+                                   isMrcStack, writeMrcStack, MRC_HEADER_BYTES,
+                                   parIterStats, readMrcHeader,
+                                   resizeMrcStack, resizeMrcVolume,
+                                   selectMrcStack, expandParSubset,
+                                   readParRange, copyParFile, removeParFile,
+                                   findParFile,
+                                   uncompressedParFile, isZstdAvailable,
+                                   PAR_GZIP_EXT, PAR_ZSTD_EXT,
+                                   PAR_HEADER, PAR_ANGLES_COLUMNS)
 from grigoriefflab.constants import *
+from .frealign_blocks import (FrealignBlockPlan, balancedParticlesPerBlock,
+                              stratifiedSubset, FrealignBlockManifest,
+                              jobSignature, iterBlockCtfLines)
+from .frealign_cache import FrealignStackCache, stageFile
+from .program_runner import ProgramRunner, readProgramMetrics, METRICS_FILE
+from .frealign_memory import (getAvailableMemory, chooseMemoryMode,
+                              estimateFrealignMemory, isPaddedMode)
+from .frealign_cleanup import FrealignIterCleaner
+from .frealign_plan import (FrealignCostModel, estimateIterDisk,
+                            formatDuration)
 
 
 class ProtFrealignBase(EMProtocol):
@@ -68,6 +91,21 @@ class ProtFrealignBase(EMProtocol):
         EMProtocol.__init__(self, **args)
         self.stepsExecutionMode = STEPS_PARALLEL
         self._lastIter = Integer(0)
+        # Iteration where the refinement converged (see doAutoStop)
+        self._convergedIter = Integer()
+        # Iteration where the downsampled iterations converged, the
+        # refinement goes on with the last one (see _checkConvergence)
+        self._binnedConvergedIter = Integer()
+        # Block plans (as json) computed when inserting the steps
+        self._blockPlans = String()
+        self._blockPlanCache = {}
+        # Block plans of the warm-up subset (see warmupIterations)
+        self._warmupBlockPlans = String()
+        self._warmupPlanCache = {}
+        # Run plan (as json) estimated when inserting the steps
+        self._runPlan = String()
+        # Removes the intermediate files of old iterations
+        self._iterCleaner = FrealignIterCleaner(log=self.info)
 
     def _createFilenameTemplates(self):
         """ Centralize how files are called for iterations and references. """
@@ -79,6 +117,9 @@ class ProtFrealignBase(EMProtocol):
 
         myDict = {
             'particles': self._getTmpPath('particles.mrc'),
+            'particles_bin': self._getTmpPath('particles_bin%(bin)d.mrc'),
+            'particles_subset': self._getTmpPath('particles_subset.mrc'),
+            'particles_subset_bin': self._getTmpPath('particles_subset_bin%(bin)d.mrc'),
             'init_vol': self._getTmpPath('volume.mrc'),
             # Volumes for the iteration
             'ref_vol': iterFile('reference_volume_iter_%(iter)03d.mrc'),
@@ -88,7 +129,10 @@ class ProtFrealignBase(EMProtocol):
             'output_vol_par': iterFile('output_vol_iter_%(iter)03d.par'),
             # dictionary for all set
             'output_par': iterFile('particles_iter_%(iter)03d.par'),
+            'warmup_par': iterFile('particles_iter_%(iter)03d_all.par'),
+            'blocks_manifest': iterFile('blocks_done.json'),
             'projections':  self._getExtraPath('projections_iter_%(iter)03d.sqlite'),
+            'convergence': self._getExtraPath('convergence.json'),
             'classes_scipion': iterFile('classes_scipion.sqlite'),
             'data_scipion': iterFile('data_scipion.sqlite'),
             'shift' : 'particles_shifts_iter_%(iter)03d.shft',
@@ -108,6 +152,7 @@ class ProtFrealignBase(EMProtocol):
             'vol2_block' : 'volume_2_iter_%(iter)03d_%(block)02d',
             'phase_block' : 'volume_phasediffs_iter_%(iter)03d_%(block)02d',
             'spread_block' : 'volume_pointspread_iter_%(iter)03d_%(block)02d',
+            'ctf_particles' : iterFile('particles_ctf_iter_%(iter)03d.txt'),
             # each class volumes for the iteration
             'ref_vol_class': iterFile('reference_volume_iter_%(iter)03d_class_%(ref)02d.mrc'),
             'iter_vol_class': iterFile('volume_iter_%(iter)03d_class_%(ref)02d.mrc'),
@@ -116,6 +161,7 @@ class ProtFrealignBase(EMProtocol):
             'output_par_class': iterFile('particles_iter_%(iter)03d_class_%(ref)02d.par'),
             'projectionsClass':  self._getExtraPath('projections_iter_%(iter)03d_class_%(ref)02d.sqlite'),
             'output_par_class_tmp': iterFile('particles_iter_%(iter)03d_class_0.par'),
+            'output_par_class_occ': iterFile('particles_iter_%(iter)03d_class_%(ref)02d_occ.par'),
             'shift_class' : 'particles_shifts_iter_%(iter)03d_class_%(ref)02d.shft',
             'match_class' : 'particles_match_iter_%(iter)03d_class_%(ref)02d.mrc',
             'weight_class' : 'volume_weights_iter_%(iter)03d_class_%(ref)02d.mrc',
@@ -124,6 +170,9 @@ class ProtFrealignBase(EMProtocol):
             'phase_class' : 'volume_phasediffs_iter_%(iter)03d_class_%(ref)02d.mrc',
             'spread_class' : 'volume_pointspread_iter_%(iter)03d_class_%(ref)02d.mrc',
             'logFileRecons' : 'logRecons_iter_%(iter)03d_class_%(ref)02d.log',
+            'logFileRsample' : 'logRsample_iter_%(iter)03d.log',
+            'logFileOcc' : 'logOcc_iter_%(iter)03d.log',
+            'logFileOccLast' : 'logOcc_iter_%(iter)03d_last.log',
             # dictionary for each processing block and class
             'input_par_block_class': iterFile('particles_iter_%(prevIter)03d_class_%(ref)02d_%(block)02d.par'),
             'output_par_block_class': iterFile('particles_iter_%(iter)03d_class_%(ref)02d_%(block)02d.par'),
@@ -202,6 +251,57 @@ class ProtFrealignBase(EMProtocol):
                       help='Set to *Yes* if you want to use the projection assignment (angles/shifts) \n '
                            'associated with the input particles (hasProjectionAssigment=True)')
 
+        if self.IS_REFINE:
+            form.addParam('warmupIterations', IntParam, default=0,
+                          condition='not doContinue',
+                          label='Warm-up iterations',
+                          help='Number of initial iterations that only refine '
+                               'a random subset of the particles (the same '
+                               'fraction of each micrograph). They are much '
+                               'faster while the volume is still at low '
+                               'resolution, specially with global searches. '
+                               'After them, the rest of particles take their '
+                               'initial parameters and all particles are '
+                               'refined and reconstructed. Without initial '
+                               'angles, the first iteration with all particles '
+                               'searches their orientations as iteration 1.\n'
+                               'Use 0 to refine all particles from the first '
+                               'iteration.')
+            form.addParam('warmupFraction', FloatParam, default=0.1,
+                          condition='not doContinue and warmupIterations > 0',
+                          label='Fraction of particles in warm-up',
+                          help='Fraction (0 to 1) of the particles of each '
+                               'micrograph refined in the warm-up iterations.')
+
+        form.addParam('doAutoStop', BooleanParam, default=False,
+                      label='Stop when converged?',
+                      help='If yes, the statistics of each iteration are '
+                           'compared with the previous ones, and the '
+                           'remaining iterations are skipped when the '
+                           'resolution and the angular change of the '
+                           'particles do not improve any more. The output '
+                           'is created from the last iteration done.\n'
+                           'If the particles are downsampled, when the '
+                           'downsampled iterations converge the remaining '
+                           'ones are skipped but the last one, that is done '
+                           'at full size.')
+        line = form.addLine('Convergence tolerance',
+                            condition='doAutoStop',
+                            help='Changes of the resolution (A) and of the '
+                                 'mean angle (degrees) between the '
+                                 'orientations assigned to each particle in '
+                                 'two consecutive iterations below which '
+                                 'the refinement is considered converged.')
+        line.addParam('resolutionTolerance', FloatParam, default=0.2,
+                      label='resolution (A)')
+        line.addParam('angularTolerance', FloatParam, default=1.0,
+                      label='angles (deg)')
+        form.addParam('convergencePatience', IntParam, default=2,
+                      condition='doAutoStop',
+                      label='Converged iterations before stopping',
+                      help='Number of consecutive iterations within the '
+                           'tolerances needed to stop.')
+
         form.addSection(label='Flow Control')
 
         form.addParam('Firstmode', EnumParam, condition='not useInitialAngles and not doContinue',
@@ -295,7 +395,8 @@ class ProtFrealignBase(EMProtocol):
                            'Calculate additional statistics in resolution table at the end \n'
                            '(*QFACT, SSNR, CC* and related columns). Setting *FSTAT* False saves over 50% of memory!.')
         form.addParam('memory', EnumParam, choices=['NO pad - NO multi-vol', 'pad - NO multi-vol',
-                                                    'NO pad- multi-vol', 'pad - multi-vol'],
+                                                    'NO pad- multi-vol', 'pad - multi-vol',
+                                                    'Automatic'],
                       default=MEM_0,
                       label='Memory usage', display=EnumParam.DISPLAY_COMBO,
                       help='Parameter *IMEM* in FREALIGN\n\n'
@@ -307,9 +408,14 @@ class ProtFrealignBase(EMProtocol):
                            '_NO pad - multi-vol_:no padding of reference during refinement,\n'
                            '   multi-volume parallelization during reconstruction. *Option 2*.\n'
                            '_pad - multi-vol_: padding of reference during refinement,\n'
-                           '   multi-volume parallelization during reconstruction (most memory usage). *Option 3*.')
+                           '   multi-volume parallelization during reconstruction (most memory usage). *Option 3*.\n'
+                           '_Automatic_: the fastest option whose estimated memory, for the box size\n'
+                           '   of each iteration and all the jobs running at the same time, fits in\n'
+                           '   the available memory of the node where each job runs (option 0 if it\n'
+                           '   can not be read). The interpolation is nearest neighbor when the\n'
+                           '   reference is padded, and trilinear otherwise.')
         form.addParam('interpolationScheme', EnumParam, choices=['Nearest neighbor', 'Trilinear'],
-                      default=INTERPOLATION_1,
+                      default=INTERPOLATION_1, condition='memory != %d' % MEM_AUTO,
                       label='Interpolation Scheme', display=EnumParam.DISPLAY_COMBO,
                       help='Parameter *INTERP* in FREALIGN\n\n'
                            'The options are:\n'
@@ -487,6 +593,90 @@ class ProtFrealignBase(EMProtocol):
                            'high values in the FSC curve (se publication #2 above). FREALIGN uses an\n'
                            'automatic weighting scheme and RBFACT should normally be set to 0.0.')
 
+        form.addParam('doBinning', BooleanParam, default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Downsample particles in early iterations?',
+                      help='If yes, all iterations but the last one use '
+                           'particles and volumes downsampled (cropped in '
+                           'Fourier space) by the biggest factor whose '
+                           'Nyquist frequency still covers the high '
+                           'resolution limit of the refinement (and of the '
+                           'classification). These iterations are much '
+                           'faster, and the last one is done at full size.\n'
+                           'The reconstructions of the downsampled '
+                           'iterations are limited to their Nyquist '
+                           'frequency.')
+        form.addParam('maxBinning', IntParam, default=4,
+                      expertLevel=LEVEL_ADVANCED, condition='doBinning',
+                      label='Maximum downsampling factor',
+                      help='Only factors that give an even box size '
+                           'are used.')
+
+        form.addParam('numberOfBlocksPerCpu', IntParam, default=1,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Processing blocks per CPU',
+                      help='The particles are split in blocks of contiguous '
+                           'micrographs, with a similar number of particles, '
+                           'that are refined in parallel. Using more than one '
+                           'block per CPU gives smaller jobs, so a CPU that '
+                           'finishes early can take the next block instead of '
+                           'waiting for the slowest one.')
+
+        form.addParam('useStackCache', BooleanParam, default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Cache particles stack?',
+                      help='The particles are written to a stack ordered by '
+                           'micrograph. If yes, this stack is kept in the '
+                           'project Tmp folder and linked (or copied, if it '
+                           'can not be linked) by other runs (or continued '
+                           'runs) that use the same particles, instead of '
+                           'writing it again.')
+        form.addParam('stackCacheSize', IntParam, default=200,
+                      expertLevel=LEVEL_ADVANCED,
+                      condition='useStackCache',
+                      label='Stack cache size (GB)',
+                      help='Maximum disk space used by the cached stacks. '
+                           'The least recently used stacks are removed '
+                           'when it is exceeded. A removed stack that is '
+                           'hard-linked by other runs still uses disk space '
+                           'until those runs are deleted.')
+
+        form.addParam('doCleanIterations', BooleanParam, default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Clean old iterations?',
+                      help='If yes, only the last iterations are kept in '
+                           'full. Older ones keep only their particles '
+                           'parameters (.par files) and volumes, the other '
+                           'files (matching projections, shifts, block '
+                           'files, half maps, weights...) are removed in the '
+                           'background after each iteration.')
+        form.addParam('keepIterations', IntParam, default=2,
+                      expertLevel=LEVEL_ADVANCED,
+                      condition='doCleanIterations',
+                      label='Iterations kept in full',
+                      help='Number of last iterations that are not cleaned.')
+        form.addParam('compressParFiles', BooleanParam, default=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      condition='doCleanIterations',
+                      label='Compress .par files of old iterations?',
+                      help='If yes, the .par files kept in the cleaned '
+                           'iterations are compressed, in the format chosen '
+                           'below or with gzip if none is chosen.')
+        form.addParam('parCompression', EnumParam,
+                      choices=['none', 'gzip', 'zstd'],
+                      default=PAR_COMPRESS_NONE,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Compress .par files',
+                      help='The merged .par file of the particles of each '
+                           'iteration is written compressed, they are '
+                           'several times smaller and faster to read and '
+                           'write in network file systems. The Frealign '
+                           'programs are given an uncompressed copy, '
+                           'written to the local temporary directory '
+                           '(TMPDIR). The .par files written by the Frealign '
+                           'programs are not compressed.\n'
+                           'zstd needs the zstandard Python module.')
+
         form.addParallelSection(threads=4, mpi=1)
 
     #--------------------------- INSERT steps functions ------------------------
@@ -496,6 +686,8 @@ class ProtFrealignBase(EMProtocol):
         self.numberOfBlocks = self._defNumberOfCPUs()
         self._createFilenameTemplates()
         self._insertContinueStep()
+        self._createBlockPlans()
+        self._createRunPlan()
         self._insertItersSteps()
         self._insertFunctionStep("createOutputStep")
 
@@ -536,7 +728,7 @@ class ProtFrealignBase(EMProtocol):
                 stepConstructId = self._insertFunctionStep("constructParamFilesStep", paramsDic, prerequisites=depsInitId)
                 depsConstruct = [stepConstructId]
                 for block in self._allBlocks():
-                    refineId = self._insertFunctionStep("refineBlockStep", block, prerequisites=depsConstruct)
+                    refineId = self._insertFunctionStep("refineBlockStep", block, paramsDic, prerequisites=depsConstruct)
                     depsRefine.append(refineId)
             else:
                 initAngStepId = self._insertFunctionStep("writeInitialAnglesStep", prerequisites=depsInitId)
@@ -565,6 +757,10 @@ class ProtFrealignBase(EMProtocol):
 
     def initIterStep(self, iterN):
         """ Prepare files and directories for the current iteration """
+        if self._isIterPassed(iterN):
+            self._passIter(iterN)
+        if self._isIterSkipped(iterN):
+            return
 
         self._createIterWorkingDir(iterN) # create the working directory for the current iteration.
         prevIter = iterN - 1
@@ -577,110 +773,112 @@ class ProtFrealignBase(EMProtocol):
 
             imgFn = self._getFileName('particles')
             volFn = self._getFileName('init_vol')
-            # TODO check if the input is already a single mrc stack
             self.writeParticlesByMic(imgFn)
             ImageHandler().convert(vol.getLocation(), volFn) # convert the reference volume into a mrc volume
-            copyFile(volFn, refVol)  #Copy the initial volume in the current directory.
+            self._stageIterVolume(volFn, refVol, iterN)  #Copy the initial volume in the current directory.
         else:
-            self._splitParFile(iterN, self.numberOfBlocks)
-            copyFile(prevIterVol, refVol)   #Copy the previous volume as reference volume.
-        copyFile(refVol, iterVol)   #Copy the reference volume as refined volume.
+            parFn = None
+            if self._isWarmupIter(prevIter) and not self._isWarmupIter(iterN):
+                parFn = self._expandWarmupParFile(prevIter)
+            self._splitParFile(iterN, self.numberOfBlocks, parFn)
+            self._stageIterVolume(prevIterVol, refVol, iterN)   #Copy the previous volume as reference volume.
+        self._stageVolume(refVol, iterVol)   #Copy the reference volume as refined volume.
+        self._prepareIterParticles(iterN)
 
     def constructParamFilesStep(self, paramsDic):
         """ Construct a parameter file (.par) with the information of the SetOfParticles. """
         #  This function will be called only in iteration 1.
         iterN = 1
-        iterDir = self._iterWorkingDir(iterN)
-        self._enterDir(iterDir)
 
         inputParticles = self._getInputParticles()
         magnification = inputParticles.getAcquisition().getMagnification()
-        params = {}
+        # The CTF lines of all blocks are written once, each block reads
+        # the ones it needs (see iterBlockCtfLines)
+        lastPart = max(self._initFinalBlockParticles(block, iterN)[1]
+                       for block in self._allBlocks())
+        f = open(self._getFileName('ctf_particles', iter=iterN), 'w')
+
+        micIdMap = self._getMicCounter()
+        # In warm-up, only the subset particles are written (and numbered)
+        subsetNumbers = self._getIterSubsetNumbers(iterN)
+        for i, img in self.iterParticlesByMic():
+            if subsetNumbers is not None:
+                if not subsetNumbers[i]:
+                    continue
+                partNumber = subsetNumbers[i]
+            else:
+                partNumber = i + 1
 
-        for block in self._allBlocks():
-            more = 1
-            initPart, lastPart = self._initFinalBlockParticles(block)
-            params['initParticle'] = initPart
-            params['finalParticle'] = lastPart
-            paramDic = self._setParamsRefineParticles(iterN, block)
-            paramsRefine = dict(paramsDic.items() + params.items() + paramDic.items())
-            f = self.__openParamFile(block, paramsRefine)
-
-            # ToDo: Implement a better method to get the info particles.
-            #  Now, you iterate several times over the SetOfParticles
-            # (as many threads as you have)
-            micIdMap = self._getMicCounter()
-            for i, img in self.iterParticlesByMic():
-                if img.hasMicId():
-                    micId = img.getMicId()
-                elif img.hasCoordinate():
-                    micId = img.getCoordinate().getMicId()
-                else:
-                    micId = 0
-                
-                film = micIdMap[micId]
-                ctf = img.getCTF()
-                defocusU, defocusV, astig = ctf.getDefocusU(), ctf.getDefocusV(), ctf.getDefocusAngle()
-                partCounter = i + 1
-
-                if partCounter == lastPart: # The last particle in the block
-                    more = 0
-                particleLine = ('1, %05d, %05d, %05f, %05f, %02f, %01d\n' %
-                                (magnification, film, defocusU, defocusV, astig, more))
-                self.__writeParamParticle(f, particleLine)
-
-                if more == 0: # close the block.
-                    self.__closeParamFile(f, paramsRefine)
-                    break
-        self._leaveDir()
-
-    def refineBlockStep(self, block):
-        """ This function execute the bash script for refine a subset(block) of images.
-        It will enter in the iteration dir and execute the script there. 
+            if img.hasMicId():
+                micId = img.getMicId()
+            elif img.hasCoordinate():
+                micId = img.getCoordinate().getMicId()
+            else:
+                micId = 0
+
+            film = micIdMap[micId]
+            ctf = img.getCTF()
+            defocusU, defocusV, astig = ctf.getDefocusU(), ctf.getDefocusV(), ctf.getDefocusAngle()
+            f.write('1, %05d, %05d, %05f, %05f, %02f\n' %
+                    (magnification, film, defocusU, defocusV, astig))
+
+            if partNumber == lastPart:
+                break
+        f.close()
+
+    def refineBlockStep(self, block, paramsDic):
+        """ Refine a subset(block) of images in the first iteration, feeding
+        Frealign with the CTF lines written by constructParamFilesStep.
         """
         iterDir = self._iterWorkingDir(1)
-        program = "./block%03d.sh" % block
-        os.chmod(join(iterDir, program), 0775)
-        self.runJob(program, "", cwd=iterDir)
+        initPart, lastPart = self._initFinalBlockParticles(block, 1)
+        parFn = self._getFileName('output_par_block', block=block, iter=1)
+        blockKey = 'block_%02d' % block
+        params = {'initParticle': initPart,
+                  'finalParticle': lastPart,
+                  'mode': paramsDic['mode2']}
+        paramDic = self._setParamsRefineParticles(1, block)
+        paramsRefine = dict(paramsDic.items() + paramDic.items() + params.items())
+        particlesFn = self._getFileName('ctf_particles', iter=1)
+        signature = self._getJobSignature(paramsRefine, iterDir,
+                                          paramsRefine['volume'],
+                                          paramsRefine['imageFn'], particlesFn)
+        if self._isBlockDone(1, blockKey, parFn, initPart, lastPart, signature):
+            return
+
+        self._runFrealign(paramsRefine, iterDir, 1, 'refine',
+                          particlesFn=particlesFn)
+        self._setBlockDone(1, blockKey, parFn, initPart, lastPart, signature)
 
     def writeInitialAnglesStep(self):
         """This function write a .par file with all necessary information for a refinement"""
-
-        self.micIdMap={}
-        counter = 0;
-        for mic in self._micList:
-            self.micIdMap[mic['_micId']]=counter
-            counter = counter +1
-
+        parData = self._getInitialParData()
+        if self._isWarmupIter(1):
+            parData = parData[self._getWarmupSubset()[0]]
+            parData['INDEX'] = np.arange(1, len(parData) + 1)
+
+        # Each block file only has the particles of the block, as the ones
+        # of the next iterations (see _splitParFile). Frealign reads the
+        # range given by initParticle and finalParticle, and the merge in
+        # reconstruction mode needs contiguous blocks (see _mergeAllParFiles).
         for block in self._allBlocks():
-            more = 1
-            _, lastPart = self._initFinalBlockParticles(block)
+            initPart, lastPart = self._initFinalBlockParticles(block, 1)
             parFn = self._getFileName('input_par_block', block= block, iter=1, prevIter=0)
             f = open(parFn, 'w')
-            f.write("C           PSI   THETA     PHI       SHX       SHY     MAG  FILM      DF1"
-                    "      DF2  ANGAST     OCC     -LogP      SIGMA   SCORE  CHANGE\n")
-
-            # ToDo: Implement a better method to get the info particles.
-            # Now, you iterate several times over the SetOfParticles (as many threads as you have)
-            for i, img in self.iterParticlesByMic():
-                partCounter = i + 1
-
-                if partCounter == lastPart: # The last particle in the block
-                    more = 0
-
-                self.writeAnglesLines(partCounter, img, f)
-
-                if more == 0: # close the block.
-                    f.close()
-                    break
+            f.write(PAR_HEADER)
+            writeParAngles(f, parData[initPart-1:lastPart])
+            f.close()
 
     def refineParticlesStep(self, iterN, block, paramsDic):
         """Only refine the parameters of the SetOfParticles
         """
+        if self._isIterSkipped(iterN):
+            return
+
         param = {}
 
         iterDir = self._iterWorkingDir(iterN)
-        iniPart, lastPart = self._initFinalBlockParticles(block)
+        iniPart, lastPart = self._initFinalBlockParticles(block, iterN)
         prevIter = iterN - 1
         param['inputParFn'] = self._getBaseName('input_par_block', block= block, iter=iterN, prevIter=prevIter)
         param['initParticle'] = iniPart
@@ -689,11 +887,17 @@ class ProtFrealignBase(EMProtocol):
         paramDic = self._setParamsRefineParticles(iterN, block)
 
         paramsRefine = dict(paramsDic.items() + paramDic.items() + param.items())
-        args = self._prepareCommand()
 
         if self.mode.get() != 0:
-            # frealign program is already in the args script, that's why runJob('')
-            self.runJob('', args % paramsRefine, cwd=iterDir)
+            parFn = self._getFileName('output_par_block', block=block, iter=iterN)
+            blockKey = 'block_%02d' % block
+            signature = self._getRefineSignature(paramsRefine, iterDir)
+            if self._isBlockDone(iterN, blockKey, parFn, iniPart, lastPart,
+                                 signature):
+                return
+            self._runFrealign(paramsRefine, iterDir, iterN, 'refine')
+            self._setBlockDone(iterN, blockKey, parFn, iniPart, lastPart,
+                               signature)
         else:
             pass
             ##ugly hack when for reconstruction only, just copy the input files
@@ -706,13 +910,17 @@ class ProtFrealignBase(EMProtocol):
     def reconstructVolumeStep(self, iterN, paramsDic):
         """Reconstruct a volume from a SetOfParticles with its current parameters refined
         """
+        if self._isIterSkipped(iterN):
+            return
+
         self._mergeAllParFiles(iterN, self.numberOfBlocks)  # merge all parameter files generated in a refineIterStep function.
 
         initParticle = 1
-        finalParticle = self._getInputParticles().getSize()
+        finalParticle = self._getIterNumberOfParticles(iterN)
 
-        os.environ['NCPUS'] = str(self.numberOfBlocks)
-        paramsDic['frealign'] = self._getProgram()
+        numberOfThreads = min(self.numberOfBlocks, self._getNumberOfCpus())
+        paramsDic = dict(paramsDic)  # shared with the refinement steps
+        paramsDic['frealign'] = self._getProgram(useMP=True)
         paramsDic['outputParFn'] = self._getBaseName('output_vol_par', iter=iterN)
         paramsDic['initParticle'] = initParticle
         paramsDic['finalParticle'] = finalParticle
@@ -722,15 +930,60 @@ class ProtFrealignBase(EMProtocol):
 
         params3DR = dict(paramsDic.items() + params2.items())
 
-        args = self._prepareCommand()
         iterDir = self._iterWorkingDir(iterN)
-        # frealign program is already in the args script, that's why runJob('')
-        self.runJob('', args % params3DR, cwd=iterDir)
+        scratchDir = tempfile.mkdtemp(prefix='frealign_')
+        try:
+            params3DR['inputParFn'] = self._getProgramParFn('output_par', scratchDir,
+                                                            iter=iterN)
+            self._runFrealign(params3DR, iterDir, iterN, 'reconstruct',
+                              numberOfThreads=numberOfThreads)
+        finally:
+            cleanPath(scratchDir)
         self._setLastIter(iterN)
+        self._checkConvergence(iterN)
+        self._cleanOldIterations(iterN)
 
     def createOutputStep(self):
         pass # should be implemented in subclasses
 
+    #--------------------------- CLEANUP functions -----------------------------
+    def _cleanOldIterations(self, iterN):
+        """ Clean in the background the iteration that is no longer kept
+        in full after iterN (see doCleanIterations). The iterations of a
+        continued run are never cleaned.
+        """
+        if not self.doCleanIterations:
+            return
+        cleanIter = iterN - self.keepIterations.get()
+        if cleanIter < self.initIter:
+            return
+        parFiles, volFiles = self._getIterKeptFiles(cleanIter)
+        compressExt = None
+        if self.compressParFiles:
+            compressExt = self._getParCompressionExt() or PAR_GZIP_EXT
+        self._iterCleaner.submit(self._iterWorkingDir(cleanIter),
+                                 [basename(fn) for fn in volFiles],
+                                 [basename(fn) for fn in parFiles],
+                                 compressExt=compressExt)
+
+    def _getIterKeptFiles(self, iterN):
+        """ Return the .par files and the other files (volumes and
+        viewer sets) of an iteration that are kept when cleaning it.
+        """
+        parFiles = [self._getFileName('output_par', iter=iterN),
+                    self._getFileName('output_vol_par', iter=iterN)]
+        otherFiles = [self._getFileName('iter_vol', iter=iterN),
+                      self._getFileName('classes_scipion', iter=iterN),
+                      self._getFileName('data_scipion', iter=iterN)]
+        return parFiles, otherFiles
+
+    def _waitCleanup(self):
+        """ Wait until the old iterations are cleaned. Errors cleaning
+        them are only reported, the run results do not depend on it.
+        """
+        for error in self._iterCleaner.join():
+            self.info(error)
+
     #--------------------------- INFO functions --------------------------------
     def _validate(self):
         errors = []
@@ -751,12 +1004,37 @@ class ProtFrealignBase(EMProtocol):
         if not imgSet.hasAlignmentProj() and self.useInitialAngles.get():
             errors.append("Particles has not initial angles !!!")
 
+        if self.IS_REFINE and not self.doContinue and self.warmupIterations.get() > 0:
+            if self.warmupIterations.get() >= self.numberOfIterations.get():
+                errors.append("The number of warm-up iterations must be "
+                              "smaller than the number of iterations.")
+            if not 0 < self.warmupFraction.get() <= 1:
+                errors.append("The fraction of particles in warm-up must "
+                              "be between 0 and 1.")
+
+        if self.doCleanIterations and self.keepIterations.get() < 1:
+            errors.append("At least the last iteration must be kept in full.")
+
+        if self.parCompression == PAR_COMPRESS_ZSTD and not isZstdAvailable():
+            errors.append("The zstandard Python module is needed to "
+                          "compress the .par files with zstd.")
+
         if imgSet.isPhaseFlipped():
             errors.append("Your particles are phase flipped. Please, choose "
                           "a set of particles without phase-contrast correction "
                           "to run Frealign.")
         return errors
 
+    def _warnings(self):
+        warnings = []
+        plan = self._getRunPlan()
+        freeDisk = self._getFreeDisk()
+        if freeDisk is not None and plan['disk'] > freeDisk:
+            warnings.append("The run needs about %0.1f GB of disk, but there "
+                            "are only %0.1f GB free." % (plan['disk'] / 1e9,
+                                                         freeDisk / 1e9))
+        return warnings
+
     def _summary(self):
         summary = []
         if self._getInputParticles() is not None:
@@ -768,12 +1046,32 @@ class ProtFrealignBase(EMProtocol):
             summary.append("Output volumes not ready yet.")
         else:
             summary.append("Number of iterations: %d" % self.numberOfIterations.get())
+            if self._binnedConvergedIter.get() is not None:
+                summary.append("Downsampled iterations converged at iteration: %d"
+                               % self._binnedConvergedIter.get())
+            if self._convergedIter.get() is not None:
+                summary.append("Converged at iteration: %d" % self._convergedIter.get())
             #             summary.append("Angular step size: %f" % self.angStepSize.get())
             summary.append("Symmetry: %s" % self.symmetry.get())
             summary.append("Final volume: %s" % self.outputVolume.getFileName())
 
+        summary += self._summaryPlan()
         return summary
 
+    def _summaryPlan(self):
+        """ Show the run plan stored when the steps were inserted. """
+        if not self._runPlan.get():
+            return []
+        plan = json.loads(self._runPlan.get())
+        iterTimes = ', '.join(formatDuration(t) for t in plan['iterCpu'])
+        source = ('calibrated with %d jobs of previous runs' % plan['calibrationJobs']
+                  if plan['calibrationJobs'] else 'not calibrated yet')
+        return ["Estimated CPU time per iteration: %s" % iterTimes,
+                "Estimated total: %s of CPU, %s on %d CPUs (%s)"
+                % (formatDuration(plan['cpu']), formatDuration(plan['wall']),
+                   plan['cpus'], source),
+                "Estimated disk usage: %0.1f GB" % (plan['disk'] / 1e9)]
+
     def _methods(self):
         # ToDo: implement this method
         return self._summary()
@@ -785,6 +1083,17 @@ class ProtFrealignBase(EMProtocol):
     def _getParamsIteration(self, iterN):
         """ Defining the current iteration """
         imgSet = self._getInputParticles()
+        binning = self._getIterBinning(iterN)
+        samplingRate = imgSet.getSamplingRate() * binning
+        resolution = self.resolution.get()
+        highResolRefine = self.highResolRefine.get()
+        resolClass = self.resolClass.get()
+        if binning > 1:
+            # Resolution limits can not go beyond Nyquist
+            nyquist = 2 * samplingRate
+            resolution = max(resolution, nyquist)
+            highResolRefine = max(highResolRefine, nyquist)
+            resolClass = max(resolClass, nyquist)
 
         #Prepare arguments to call program fralign_v9.exe
         paramsDic = {'frealign': self._getProgram(),
@@ -804,45 +1113,34 @@ class ProtFrealignBase(EMProtocol):
                      'score': self.score.get(),
                      'beamTiltX': self.beamTiltX.get(),
                      'beamTiltY': self.beamTiltY.get(),
-                     'resol': self.resolution.get(),
+                     'resol': resolution,
                      'lowRes': self.lowResolRefine.get(),
-                     'highRes': self.highResolRefine.get(),
-                     'resolClass': self.resolClass.get(),
+                     'highRes': highResolRefine,
+                     'resolClass': resolClass,
                      'defocusUncertainty': self.defocusUncertainty.get(),
                      'Bfactor': self.Bfactor.get(),
-                     'sampling3DR': imgSet.getSamplingRate()
+                     'sampling3DR': samplingRate
         }
 
         # Get the particles stack
         iterDir = self._iterWorkingDir(iterN)
-        paramsDic['imageFn'] = os.path.relpath(self._getFileName("particles"), iterDir)
+        paramsDic['imageFn'] = os.path.relpath(self._getIterParticles(iterN), iterDir)
         acquisition = imgSet.getAcquisition()
 
         # Get the amplitude Contrast of the micrographs
         paramsDic['ampContrast'] = acquisition.getAmplitudeContrast()
-        # Get the scanned pixel size of the micrographs
-        paramsDic['scannedPixelSize'] = acquisition.getMagnification() * imgSet.getSamplingRate() / 10000
+        # Get the scanned pixel size of the micrographs. It is scaled with the
+        # binning, so the magnification in the .par files does not change.
+        # Radii and shifts are given in A, so they do not depend on it.
+        paramsDic['scannedPixelSize'] = acquisition.getMagnification() * samplingRate / 10000
         # Get the voltage and spherical aberration of the microscope
         paramsDic['voltage'] = acquisition.getVoltage()
         paramsDic['sphericalAberration'] = acquisition.getSphericalAberration()
 
-        # Defining the operation mode
-        if self.mode == MOD_RECONSTRUCTION:
-            paramsDic['mode'] = 0
-        elif self.mode == MOD_REFINEMENT:
-            paramsDic['mode'] = 1
-        elif self.mode == MOD_RANDOM_SEARCH_REFINEMENT:
-            paramsDic['mode'] = 2
-        elif self.mode == MOD_SIMPLE_SEARCH_REFINEMENT:
-            paramsDic['mode'] = 3
-        else:
-            paramsDic['mode'] = 4
-
-        # Defining the operation mode for iteration 1.
-        if self.Firstmode == MOD2_SIMPLE_SEARCH_REFINEMENT:
-            paramsDic['mode2'] = -3
-        else:
-            paramsDic['mode2'] = -4
+        # Defining the operation modes (the second one for iteration 1)
+        paramsDic['mode'], paramsDic['mode2'] = self._getFrealignModes()
+        if self._isSearchAfterWarmupIter(iterN) and paramsDic['mode'] in (1, 2):
+            paramsDic['mode'] = -paramsDic['mode2']
 
         # Defining if magnification refinement is going to do
         if self.doMagRefinement and iterN != 1:
@@ -919,19 +1217,22 @@ class ProtFrealignBase(EMProtocol):
         else:
             paramsDic['doAditionalStatisFSC'] = 'F'
 
+        if self.interpolationScheme == INTERPOLATION_0:
+            paramsDic['interpolation'] = 0
+        else:
+            paramsDic['interpolation'] = 1
+
         if self.memory == MEM_0:
             paramsDic['memory'] = 0
         elif self.memory == MEM_1:
             paramsDic['memory'] = 1
         elif self.memory == MEM_2:
             paramsDic['memory'] = 2
-        else:
+        elif self.memory == MEM_3:
             paramsDic['memory'] = 3
-
-        if self.interpolationScheme == INTERPOLATION_0:
-            paramsDic['interpolation'] = 0
         else:
-            paramsDic['interpolation'] = 1
+            # Chosen by each job in the node where it runs (see _runFrealign)
+            paramsDic['memory'] = MEM_AUTO
 
         if self.paramRefine == REF_ALL:
             paramsDic['paramRefine'] = '1, 1, 1, 1, 1'
@@ -993,13 +1294,11 @@ class ProtFrealignBase(EMProtocol):
         paramDics['logFile'] = self._getFileName('logFileRecons', iter=iterN, ref=1)
         return paramDics
 
-    def __openParamFile(self, blockNumber, paramsDict):
-        """ Open the file and write the first part of the block param file. """
-        frealign = self._getProgram()
-        if not exists(frealign):
-            raise Exception('Missing ' + frealign)
-        initaLines = """%(frealign)s << eot > %(logFile)s
-M,%(mode2)s,%(doMagRefinement)s,%(doDefocusRef)s,%(doAstigRef)s,%(doDefocusPartRef)s,%(metEwaldSphere)s,%(doExtraRealSpaceSym)s,%(doWienerFilter)s,%(doBfactor)s,%(writeMatchProj)s,%(metFsc)s,%(doAditionalStatisFSC)s,%(memory)s,%(interpolation)s
+    def _prepareCommand(self):
+        """ prepare the Frealign input, from the control cards to the
+        name of the matching projections stack.
+        """
+        args = """M,%(mode)s,%(doMagRefinement)s,%(doDefocusRef)s,%(doAstigRef)s,%(doDefocusPartRef)s,%(metEwaldSphere)s,%(doExtraRealSpaceSym)s,%(doWienerFilter)s,%(doBfactor)s,%(writeMatchProj)s,%(metFsc)s,%(doAditionalStatisFSC)s,%(memory)s,%(interpolation)s
 %(outerRadius)s,%(innerRadius)s,%(sampling3DR)s,%(molMass)s,%(ampContrast)s,%(ThresholdMask)s,%(pseudoBFactor)s,%(avePhaseResidual)s,%(angStepSize)s,%(numberRandomSearch)s,%(numberPotentialMatches)s
 %(paramRefine)s
 %(initParticle)s,%(finalParticle)s
@@ -1009,48 +1308,11 @@ M,%(mode2)s,%(doMagRefinement)s,%(doDefocusRef)s,%(doAstigRef)s,%(doDefocusPartR
 %(imageFn)s
 %(imgFnMatch)s
 """
-        paramFile = 'block%03d.sh' % blockNumber
-        f = open(paramFile, 'w+')
-        f.write(initaLines % paramsDict)
-        return f
-
-    def __writeParamParticle(self, f, particleLine):
-        """ Write a particle line to the param file """
-        f.write(particleLine)
-
-    def __closeParamFile(self, f, paramsDict):
-        """ Close the param file for a block. """
-        finaLines = """%(outputParFn)s
-%(outputShiftFn)s
-%(stopParam)s, 0., 0., 0., 0., 0., 0., 0.
-%(volume)s
-%(3Dweigh)s
-%(FSC3DR1)s
-%(FSC3DR2)s
-%(VolPhResidual)s
-%(VolpointSpread)s
-eot
-"""
-        f.write(finaLines % paramsDict)
-        f.close()
+        return args
 
-    def _prepareCommand(self):
-        """ prepare the command to execute"""
-        frealign = self._getProgram()
-        if not exists(frealign):
-            raise Exception('Missing ' + frealign)
-        args = """%(frealign)s  << eot > %(logFile)s
-M,%(mode)s,%(doMagRefinement)s,%(doDefocusRef)s,%(doAstigRef)s,%(doDefocusPartRef)s,%(metEwaldSphere)s,%(doExtraRealSpaceSym)s,%(doWienerFilter)s,%(doBfactor)s,%(writeMatchProj)s,%(metFsc)s,%(doAditionalStatisFSC)s,%(memory)s,%(interpolation)s
-%(outerRadius)s,%(innerRadius)s,%(sampling3DR)s,%(molMass)s,%(ampContrast)s,%(ThresholdMask)s,%(pseudoBFactor)s,%(avePhaseResidual)s,%(angStepSize)s,%(numberRandomSearch)s,%(numberPotentialMatches)s
-%(paramRefine)s
-%(initParticle)s,%(finalParticle)s
-%(sym)s
-%(relMagnification)s,%(scannedPixelSize)s,%(targetScore)s,%(score)s,%(sphericalAberration)s,%(voltage)s,%(beamTiltX)s,%(beamTiltY)s
-%(resol)s,%(lowRes)s,%(highRes)s,%(resolClass)s,%(defocusUncertainty)s,%(Bfactor)s
-%(imageFn)s
-%(imgFnMatch)s
-%(inputParFn)s
-%(outputParFn)s
+    def _prepareOutputCommand(self):
+        """ prepare the Frealign input after the particles parameters """
+        args = """%(outputParFn)s
 %(outputShiftFn)s
 %(stopParam)s, 0., 0., 0., 0., 0., 0., 0.
 %(volume)s
@@ -1059,77 +1321,249 @@ M,%(mode)s,%(doMagRefinement)s,%(doDefocusRef)s,%(doAstigRef)s,%(doDefocusPartRe
 %(FSC3DR2)s
 %(VolPhResidual)s
 %(VolpointSpread)s
-eot
 """
         return args
 
-    def _mergeAllParFiles(self, iterN, numberOfBlocks):
-        """ This method merge all parameters files that has been created in a refineIterStep """
+    def _iterFrealignInput(self, paramsDic, particlesFn=None):
+        """ Iterate over the lines of the Frealign input. The particles
+        parameters are read from the inputParFn file or, if particlesFn
+        is given, from its CTF lines (see iterBlockCtfLines).
+        """
+        yield self._prepareCommand() % paramsDic
+        if particlesFn is None:
+            yield '%(inputParFn)s\n' % paramsDic
+        else:
+            for line in iterBlockCtfLines(particlesFn, paramsDic['finalParticle']):
+                yield line
+        yield self._prepareOutputCommand() % paramsDic
+
+    def _runFrealign(self, paramsDic, cwd, iterN, kind, particlesFn=None,
+                     numberOfThreads=1):
+        """ Run the Frealign program of paramsDic in cwd, streaming its
+        input to the program stdin (see _iterFrealignInput) and writing
+        its output to the logFile. The kind of job ('refine' or
+        'reconstruct') is recorded with its metrics.
+        """
+        boxSize = self._getIterBoxSize(iterN)
+        if paramsDic['memory'] == MEM_AUTO:
+            paramsDic = self._setAutoMemoryMode(paramsDic, boxSize)
+
+        def inputLines():
+            return self._iterFrealignInput(paramsDic, particlesFn)
+
+        estimate = estimateFrealignMemory(boxSize, paramsDic['memory'], kind,
+                                          numberOfThreads)
+        metrics = ProgramRunner(self).run(
+            paramsDic['frealign'], inputLines=inputLines,
+            logFn=join(cwd, paramsDic['logFile']), cwd=cwd,
+            numberOfThreads=numberOfThreads, kind=kind, iteration=iterN,
+            particles=paramsDic['finalParticle'] - paramsDic['initParticle'] + 1,
+            boxSize=boxSize, memory=paramsDic['memory'],
+            mode=paramsDic['mode'] if kind == 'refine' else 0,
+            angStepSize=paramsDic['angStepSize'],
+            numberRandomSearch=paramsDic['numberRandomSearch'],
+            memoryEstimate=estimate)
+        if metrics['maxRss'] is not None:
+            self.info("Frealign %s job: peak memory %d MB (estimated %d MB)"
+                      % (kind, metrics['maxRss'], estimate))
+
+    def _setAutoMemoryMode(self, paramsDic, boxSize):
+        """ Return a copy of paramsDic with the memory mode chosen for
+        the memory available now in this node (see chooseMemoryMode).
+        """
+        availableMemory = getAvailableMemory()
+        memory, peak = chooseMemoryMode(boxSize, self._getConcurrentJobs(),
+                                        availableMemory)
+        paramsDic = dict(paramsDic)
+        paramsDic['memory'] = memory
+        # With the padded reference, nearest neighbor is accurate enough
+        paramsDic['interpolation'] = 0 if isPaddedMode(memory) else 1
+        self.info("Memory mode %d for box size %d, estimated peak memory "
+                  "%d MB (%s MB available)"
+                  % (memory, boxSize, peak,
+                     '%d' % availableMemory if availableMemory else 'unknown'))
+        return paramsDic
 
-        #if we only want to reconstruct then use the initial par file
-        #instead of the output one since they are empty
-        file2 = self._getFileName('output_par', iter=iterN)
+    def _mergeAllParFiles(self, iterN, numberOfBlocks, compress=True):
+        """ This method merge all parameters files that has been created in a refineIterStep.
+        The merged file is compressed (see parCompression) if compress is True.
+        """
+
+        #if we only want to reconstruct then use the input par files
+        #of the blocks instead of the output ones since they are empty
+        file2 = self._getParOutputFn('output_par', compress, iter=iterN)
         if (self.mode.get()==0):
-            inFile = self._getFileName('input_par_block', block= numberOfBlocks, iter=1, prevIter=0)
-            print inFile, file2
-            copyFile(inFile,file2)
+            blockFiles = [self._getFileName('input_par_block', block=block,
+                                            iter=iterN, prevIter=iterN-1)
+                          for block in range(1, numberOfBlocks + 1)]
+            mergeParFiles(blockFiles, file2, header=PAR_HEADER)
         else:
             if numberOfBlocks != 1:
-                f2 = open(file2, 'w+')
-                f2.write("C           PSI   THETA     PHI       SHX       SHY     MAG  FILM      DF1"
-                         "      DF2  ANGAST     OCC     -LogP      SIGMA   SCORE  CHANGE\n")
+                blockFiles = []
                 for block in range(1, numberOfBlocks + 1):
                     file1 = self._getFileName('output_par_block', block=block, iter=iterN)
                     if not os.path.exists(file1):
                         raise Exception("Error: file %s does not exist" % file1)
-                    f1 = open(file1)
-
-                    for l in f1:
-                        if not l.startswith('C'):
-                            f2.write(l)
-                    f1.close()
-                f2.close()
+                    blockFiles.append(file1)
+                mergeParFiles(blockFiles, file2, header=PAR_HEADER)
             else:
                 file1 = self._getFileName('output_par_block', block=1, iter=iterN)
-                copyFile(file1, file2)
+                copyParFile(file1, file2)
 
-    def _splitParFile(self, iterN, numberOfBlocks):
-        """ This method split the parameter files that has been previously merged """
+    def _splitParFile(self, iterN, numberOfBlocks, parFn=None):
+        """ This method split the parameter files that has been previously merged
+        (or parFn, if given).
+        """
 
         prevIter = iterN -1
-        file1 = self._getFileName('output_par', iter=prevIter)
+        file1 = parFn or self._getFileName('output_par', iter=prevIter)
         if numberOfBlocks != 1:
+            blockFiles = []
             for block in range(1, numberOfBlocks + 1):
-                f1 = open(file1)
                 file2 = self._getFileName('input_par_block', block=block, iter=iterN, prevIter=prevIter)
-                f2 = open(file2, 'w+')
-                f2.write("C           PSI   THETA     PHI       SHX       SHY     MAG  FILM      DF1"
-                         "      DF2  ANGAST     OCC     -LogP      SIGMA   SCORE  CHANGE\n")
-
-                _, finalPart = self._initFinalBlockParticles(block)
-
-                for l in f1:
-
-                    if l.startswith('C'):
-                        f2.write(l)
-                    else:
-                        split = l.split()
-                        numPart = int(''.join(split[:1]))
-
-                        if numPart <= finalPart:
-                            f2.write(l)
-                        else:
-                            break
-                f2.close()
-                f1.close()
+                initPart, finalPart = self._initFinalBlockParticles(block, iterN)
+                blockFiles.append((file2, initPart, finalPart))
+            splitParFile(file1, blockFiles, header=PAR_HEADER)
         else:
             file2 = self._getFileName('input_par_block', block=1, iter=iterN, prevIter=prevIter)
-            copyFile(file1, file2)
+            copyParFile(file1, file2)
+
+    def _getParCompressionExt(self):
+        """ Return the extension of the compressed .par files
+        (see parCompression), or an empty string.
+        """
+        if self.parCompression == PAR_COMPRESS_GZIP:
+            return PAR_GZIP_EXT
+        elif self.parCompression == PAR_COMPRESS_ZSTD:
+            return PAR_ZSTD_EXT
+        return ''
+
+    def _getParOutputFn(self, key, compress=True, **kwargs):
+        """ Return the name to write a .par file, compressed if compress
+        is True (see parCompression). Any previous copy of the file, with
+        other compression, is removed so it is not read instead.
+        """
+        parFn = self._getFileName(key, **kwargs)
+        removeParFile(parFn)
+        if compress:
+            return parFn + self._getParCompressionExt()
+        return parFn
+
+    def _getProgramParFn(self, key, scratchDir, **kwargs):
+        """ Return the name of a .par file to give to the Frealign
+        programs, run in the iteration directory. A compressed file is
+        decompressed to scratchDir (see uncompressedParFile).
+        """
+        parFn = self._getFileName(key, **kwargs)
+        programParFn = uncompressedParFile(parFn, scratchDir)
+        if programParFn == parFn:
+            return basename(parFn)
+        return programParFn
 
     def _setLastIter(self, iterN):
         self._lastIter.set(iterN)
         self._store(self._lastIter)
 
+    def _isIterSkipped(self, iterN):
+        """ Iterations after the convergence are not executed, nor the
+        ones passed after the downsampled iterations converged.
+        """
+        convergedIter = self._convergedIter.get()
+        return ((convergedIter is not None and iterN > convergedIter)
+                or self._isIterPassed(iterN))
+
+    def _isIterPassed(self, iterN):
+        """ When the downsampled iterations converge, the next ones are
+        passed (see _passIter) up to the last one, done at full size.
+        """
+        binnedConvergedIter = self._binnedConvergedIter.get()
+        return (binnedConvergedIter is not None
+                and binnedConvergedIter < iterN < self.finalIter - 1)
+
+    def _passIter(self, iterN):
+        """ Take the results of the previous iteration (the .par files
+        and volumes, see _getIterKeptFiles) as the ones of an iteration
+        that is not executed, so the next one starts from them.
+        """
+        self._createIterWorkingDir(iterN)
+        prevParFiles, prevOtherFiles = self._getIterKeptFiles(iterN - 1)
+        parFiles, otherFiles = self._getIterKeptFiles(iterN)
+        for src, dst in zip(prevParFiles, parFiles):
+            srcFn = findParFile(src)
+            if srcFn is not None:
+                # keep the compression extension, if any
+                stageFile(srcFn, dst + srcFn[len(src):], readOnly=True)
+        for src, dst in zip(prevOtherFiles, otherFiles):
+            if exists(src):
+                stageFile(src, dst, readOnly=True)
+        self.info("Iteration %d passed, it takes the results of iteration %d"
+                  % (iterN, iterN - 1))
+
+    def _getIterStats(self, iterN):
+        """ Return a dict with the statistics of the iteration
+        (see parIterStats).
+        """
+        prevParFn = None
+        if iterN > 1:
+            prevParFn = self._getFileName('output_par', iter=iterN-1)
+        return parIterStats(self._getFileName('output_par', iter=iterN),
+                            self._getFileName('output_vol_par', iter=iterN),
+                            prevParFn)
+
+    def _loadConvergenceStats(self):
+        """ Return the list of statistics of the iterations done so far. """
+        statsFn = self._getFileName('convergence')
+        if not exists(statsFn):
+            return []
+        with open(statsFn) as f:
+            return json.load(f)
+
+    def _checkConvergence(self, iterN):
+        """ Store the statistics of the iteration and, if doAutoStop,
+        mark the protocol as converged when the last convergencePatience
+        iterations did not change the resolution nor the angles more
+        than the given tolerances.
+        """
+        if not self.doAutoStop:
+            return
+
+        stats = self._getIterStats(iterN)
+        stats['iter'] = iterN
+        allStats = [s for s in self._loadConvergenceStats() if s['iter'] < iterN]
+        allStats.append(stats)
+        with open(self._getFileName('convergence'), 'w') as f:
+            json.dump(allStats, f, indent=1)
+        self.info("Iteration %d statistics: %s" % (iterN, stats))
+
+        def isStable(prev, curr):
+            if (prev['iter'] != curr['iter'] - 1 or curr['angularChange'] is None
+                    or prev['resolution'] is None or curr['resolution'] is None):
+                return False
+            return (abs(curr['resolution'] - prev['resolution']) <= self.resolutionTolerance.get()
+                    and curr['angularChange'] <= self.angularTolerance.get())
+
+        patience = max(self.convergencePatience.get(), 1)
+        if len(allStats) <= patience or self._isWarmupIter(iterN):
+            return
+        lastStats = allStats[-patience-1:]
+        if not all(isStable(p, c) for p, c in zip(lastStats[:-1], lastStats[1:])):
+            return
+
+        if self._getIterBinning(iterN) > 1:
+            # Downsampled iterations are limited in resolution, so the
+            # refinement only stops after the last one, at full size
+            if self._binnedConvergedIter.get() is None:
+                self.info("Downsampled iterations converged at iteration %d, "
+                          "the refinement goes on with the last iteration, "
+                          "at full size." % iterN)
+                self._binnedConvergedIter.set(iterN)
+                self._store(self._binnedConvergedIter)
+        else:
+            self.info("Refinement converged at iteration %d, the remaining "
+                      "iterations will be skipped." % iterN)
+            self._convergedIter.set(iterN)
+            self._store(self._convergedIter)
+
     def _getLastIter(self):
         return self._lastIter.get()
 
@@ -1146,83 +1580,169 @@ eot
         for i in range(1, self.numberOfBlocks+1):
             yield i
 
-    def _initFinalBlockParticles(self, block):
+    def _initFinalBlockParticles(self, block, iterN=None):
         """ return initial and final particle number for a determined block """
+        return self._getBlockPlan(iterN=iterN).getRange(block)
+
+    def _getBlockNumbers(self):
+        """ Return the different number of blocks the particles are split in.
+        """
+        return [self.numberOfBlocks]
+
+    def _createBlockPlans(self):
+        """ Compute the block plans once, when the steps are inserted,
+        and store them with the protocol.
+        """
         sortedMicIdList = sorted(self._micList, key=lambda k: k['_micId'])
-        finalPart = 0
-        particlesPerBlock = self._particlesPerBlock(self.numberOfBlocks, sortedMicIdList)
-        for i in range(block):
-            initPart = 1 + finalPart
-            finalPart = finalPart + particlesPerBlock[i]
-        return initPart, finalPart
+        self._blockPlanCache = {}
+        for numberOfBlocks in self._getBlockNumbers():
+            particlesPerBlock = self._particlesPerBlock(numberOfBlocks,
+                                                        sortedMicIdList)
+            self._blockPlanCache[numberOfBlocks] = FrealignBlockPlan(
+                sortedMicIdList, particlesPerBlock)
+        self._blockPlans.set(FrealignBlockPlan.storePlans(self._blockPlanCache))
+        self._store(self._blockPlans)
+
+        self._warmupPlanCache = {}
+        if self._isWarmupIter(1):
+            _, subsetCounts = self._getWarmupSubset()
+            subsetMicList = [{'_micId': mic['_micId'], 'count': count}
+                             for mic, count in zip(sortedMicIdList, subsetCounts)]
+            particlesPerBlock = self._particlesPerBlock(self.numberOfBlocks,
+                                                        subsetMicList)
+            self._warmupPlanCache[self.numberOfBlocks] = FrealignBlockPlan(
+                subsetMicList, particlesPerBlock)
+        self._warmupBlockPlans.set(FrealignBlockPlan.storePlans(self._warmupPlanCache))
+        self._store(self._warmupBlockPlans)
+
+    def _createRunPlan(self):
+        """ Estimate the run plan once, when the steps are inserted, and
+        store it with the protocol, so the summary does not read the
+        metrics of all the runs of the project each time it is shown.
+        """
+        self._runPlan.set(json.dumps(self._getRunPlan()))
+        self._store(self._runPlan)
+
+    def _getBlockPlan(self, numberOfBlocks=None, iterN=None):
+        """ Return the FrealignBlockPlan to split the particles in
+        numberOfBlocks (by default, the number of processing blocks).
+        In warm-up iterations, the plan splits the warm-up subset.
+        """
+        if numberOfBlocks is None:
+            numberOfBlocks = self.numberOfBlocks
+        if self._isWarmupIter(iterN):
+            if numberOfBlocks not in self._warmupPlanCache:
+                self._warmupPlanCache = FrealignBlockPlan.loadPlans(self._warmupBlockPlans.get())
+            return self._warmupPlanCache[numberOfBlocks]
+        if numberOfBlocks not in self._blockPlanCache:
+            self._blockPlanCache = FrealignBlockPlan.loadPlans(self._blockPlans.get())
+        return self._blockPlanCache[numberOfBlocks]
+
+    def _isSearchAfterWarmupIter(self, iterN):
+        """ Without initial angles, the particles out of the warm-up
+        subset start with zero angles, so the first iteration with all
+        particles has to search their orientations globally (with the
+        search mode of iteration 1, see Firstmode), not only refine them.
+        """
+        return (not self.useInitialAngles and self._isWarmupIter(iterN - 1)
+                and not self._isWarmupIter(iterN))
+
+    def _isWarmupIter(self, iterN):
+        """ Return True if the iteration only refines the warm-up subset
+        (see warmupIterations). The last iteration is never a warm-up one.
+        """
+        if iterN is None or not self.IS_REFINE or self.doContinue:
+            return False
+        warmupIters = min(self.warmupIterations.get(), self.numberOfIterations.get() - 1)
+        return 1 <= iterN <= warmupIters
+
+    def _getWarmupSubset(self):
+        """ Return the positions (in micrograph order) of the particles
+        in the warm-up subset and the number of them in each micrograph.
+        The seed is fixed, so it is the same subset every time.
+        """
+        if getattr(self, '_warmupSubset', None) is None:
+            sortedMicIdList = sorted(self._micList, key=lambda k: k['_micId'])
+            self._warmupSubset = stratifiedSubset(
+                [mic['count'] for mic in sortedMicIdList],
+                self.warmupFraction.get())
+        return self._warmupSubset
+
+    def _getIterSubsetNumbers(self, iterN):
+        """ Return None if the iteration refines all particles. Otherwise
+        return an array with the number of each particle in the warm-up
+        subset (from 1), or 0 for the particles not in it.
+        """
+        if not self._isWarmupIter(iterN):
+            return None
+        positions, _ = self._getWarmupSubset()
+        numbers = np.zeros(self._getInputParticles().getSize(), dtype=int)
+        numbers[positions] = np.arange(1, len(positions) + 1)
+        return numbers
+
+    def _getIterNumberOfParticles(self, iterN):
+        if self._isWarmupIter(iterN):
+            return len(self._getWarmupSubset()[0])
+        return self._getInputParticles().getSize()
+
+    def _expandWarmupParFile(self, iterN):
+        """ Write a .par file with all particles after the last warm-up
+        iteration: the refined ones of the subset and the initial
+        parameters for the rest. Return its filename.
+        """
+        parFn = self._getFileName('warmup_par', iter=iterN)
+        expandParSubset(self._getFileName('output_par', iter=iterN), parFn,
+                        self._getInitialParData(), self._getWarmupSubset()[0])
+        return parFn
 
     def _particlesPerBlock(self, numberOfBlocks, micIdList):
         """ Return a list with numberOfBlocks values, each value will be
         the number of particles assigned to each block.
         """
-        numbOfMIcs = len(micIdList)
-
-        restBlock = numbOfMIcs % numberOfBlocks
-        colBlock = numbOfMIcs / numberOfBlocks
-        # Create a list with the number of micrographs assigned
-        # to each block, initially equally distributed
-        blockMics = [colBlock] * numberOfBlocks
-        # Now assign the particles in the rest
-        for i, v in enumerate(blockMics):
-            if i < restBlock:
-                blockMics[i] += 1
-
-        blckCounter = 0
-        micCounter = 1
-        numberOfParts = 0
-        particlesPerBlock = []
-        for mic in micIdList:
-            numberOfParts = numberOfParts + mic['count']
-            if micCounter == blockMics[blckCounter]:
-                if blckCounter < len(blockMics)-1:
-                    blckCounter += 1
-                micCounter = 0
-                particlesPerBlock.append(numberOfParts)
-                numberOfParts = 0
-            micCounter += 1
-        return particlesPerBlock
-
-    def writeAnglesLines(self, counter, img, filePar):
-        if img.hasMicId():
-            micId = img.getMicId()
-        elif img.hasCoordinate():
-            micId = img.getCoordinate().getMicId()
-        else:
-            micId = 0
-        objId = self.micIdMap[micId]
+        return balancedParticlesPerBlock([mic['count'] for mic in micIdList],
+                                         numberOfBlocks)
 
-        # get alignment parameters for each particle
-        shifts, angles = geometryFromMatrix(img.getTransform().getMatrix())
+    def _getInitialParData(self):
+        """ Return an array with the initial .par columns (see
+        PAR_ANGLES_COLUMNS) of all particles, taken from their
+        current alignment, ctf and acquisition.
+        """
+        imgSet = self._getInputParticles()
+        micIdMap = self._getMicCounter()
+        parData = np.zeros(imgSet.getSize(),
+                           dtype=[(c, np.float64) for c in PAR_ANGLES_COLUMNS])
+        matrices = np.empty((len(parData), 4, 4))
+
+        for i, img in self.iterParticlesByMic():
+            if img.hasMicId():
+                micId = img.getMicId()
+            elif img.hasCoordinate():
+                micId = img.getCoordinate().getMicId()
+            else:
+                micId = 0
+
+            ctfModel = img.getCTF()
+            parData[i] = (i + 1, 0, 0, 0, 0, 0,
+                          img.getAcquisition().getMagnification(),
+                          micIdMap[micId],
+                          ctfModel.getDefocusU(), ctfModel.getDefocusV(),
+                          ctfModel.getDefocusAngle())
+            transform = img.getTransform()
+            matrices[i] = np.eye(4) if transform is None else transform.getMatrix()
+
+        # get alignment parameters for all particles
+        shifts, angles = geometryFromMatrices(matrices)
         # TODO: check if can use shiftZ
-        shiftXP, shiftYP, _ = shifts * img.getSamplingRate()
-        psiP, thetaP, phiP = angles
+        shifts *= imgSet.getSamplingRate()
 
         # TODO review FLIP. I think we got it wrong
-        psi = phiP
-        theta = thetaP
-        phi  = psiP
-        shiftX = -shiftXP
-        shiftY = -shiftYP
-
-        # get ctfModel for each particle
-        ctfModel = img.getCTF()
-        defU = ctfModel.getDefocusU()
-        defV = ctfModel.getDefocusV()
-        defAngle = ctfModel.getDefocusAngle()
-
-        # get the adquisition info
-        acquisition = img.getAcquisition()
-        mag = acquisition.getMagnification()
-
-        filePar.write("%(counter)7d %(psi)7.2f %(theta)7.2f %(phi)7.2f "
-                      "%(shiftX)9.2f %(shiftY)9.2f %(mag)7.0f %(objId)5d %("
-                      "defU)8.1f %(defV)8.1f %(defAngle)7.2f  100.00      0000"
-                      "     0.5000   00.00   00.00\n" % locals())
+        parData['PSI'] = angles[:, 2]
+        parData['THETA'] = angles[:, 1]
+        parData['PHI'] = angles[:, 0]
+        parData['SHX'] = -shifts[:, 0]
+        parData['SHY'] = -shifts[:, 1]
+
+        return parData
 
     def iterParticlesByMic(self):
         """ Iterate the particles ordered by micrograph """
@@ -1231,14 +1751,193 @@ eot
             yield i, part
 
     def writeParticlesByMic(self, stackFn):
-        self._getInputParticles().writeStack(stackFn,
-                                             orderBy=['_micId', 'id'],
-                                             direction='ASC')
-        if self.doInvert:
-            tmpFile = self._getTmpPath("kk.mrc")
+        """ Write the particles stack ordered by micrograph. If the input
+        is already a single mrc stack with the particles in that order,
+        and they do not need to be inverted, just link to it.
+        Otherwise the stack is taken from the project stack cache (if
+        enabled), so it is written only once for the same particles.
+        """
+        imgSet = self._getInputParticles()
+        ids, locations = [], []
+        for _, img in self.iterParticlesByMic():
+            ids.append(img.getObjId())
+            locations.append(img.getLocation())
+        numberOfImages = len(locations)
+        fileNames = set(fn.split(':')[0] for _, fn in locations)
+
+        if not self.doInvert and len(fileNames) == 1:
+            inputStack = fileNames.pop()
+            if ([index for index, _ in locations] == range(1, numberOfImages + 1)
+                    and isMrcStack(inputStack, numberOfImages)):
+                createLink(inputStack, stackFn)
+                return
+
+        xdim, ydim, _ = imgSet.getDimensions()
+        dims = (xdim, ydim, numberOfImages)
+        samplingRate = imgSet.getSamplingRate()
+        invert = self.doInvert.get()
+
+        def writeStack(fn):
             ih = ImageHandler()
-            ih.invertStack(stackFn, tmpFile)
-            moveFile(tmpFile, stackFn)
+            images = (ih.read(loc).getData() for loc in locations)
+            writeMrcStack(images, fn, dims, samplingRate, invert=invert)
+
+        if self.useStackCache:
+            cache = FrealignStackCache(self._getStackCacheDir(),
+                                       self.stackCacheSize.get() * 1024**3)
+            key = cache.getKey(imgSet.getObjId(), imgSet.getFileName(),
+                               ids, '_micId,id ASC', invert, samplingRate,
+                               dims)
+            cachedStack = cache.get(key)
+            if cachedStack is None:
+                stackSize = MRC_HEADER_BYTES + 4 * xdim * ydim * numberOfImages
+                cachedStack = cache.add(key, stackSize, writeStack)
+            else:
+                self.info("Using cached particles stack %s" % cachedStack)
+
+            if cachedStack is not None:
+                method = cache.link(cachedStack, stackFn)
+                if method is not None:
+                    self.info("Linked %s to %s (%s)"
+                              % (stackFn, cachedStack, method))
+                    return
+                self.info("Cached stack %s was removed, writing it again"
+                          % cachedStack)
+
+        writeStack(stackFn)
+
+    def _stageVolume(self, src, dst, readOnly=False):
+        """ Copy a volume avoiding a real copy when possible (see stageFile).
+        Volumes that Frealign only reads (readOnly=True) can be hard-linked,
+        the ones that it writes are cloned or copied.
+        """
+        method = stageFile(src, dst, readOnly)
+        self.info("Staged %s to %s (%s)" % (src, dst, method))
+
+    def _getJobSignature(self, paramsDic, cwd, *inputFiles):
+        """ Return the signature of a Frealign job (see jobSignature),
+        with its input files given relative to its working dir.
+        """
+        return jobSignature(paramsDic, [join(cwd, fn) for fn in inputFiles])
+
+    def _getRefineSignature(self, paramsRefine, cwd):
+        """ Signature of a refinement job that reads its parameters
+        from inputParFn.
+        """
+        return self._getJobSignature(paramsRefine, cwd,
+                                     paramsRefine['volume'],
+                                     paramsRefine['imageFn'],
+                                     paramsRefine['inputParFn'])
+
+    def _isBlockDone(self, iterN, blockKey, parFn, initPart, lastPart,
+                     signature=None):
+        """ Return True if the block was completed by a previous execution
+        of the same job (see _setBlockDone) and its output is still valid.
+        """
+        manifest = self._getBlockManifest(iterN)
+        if (manifest.isDone(blockKey, parFn, signature)
+                and readParRange(parFn) == (lastPart - initPart + 1, initPart, lastPart)):
+            self.info("Iteration %d, %s was already done, skipping it."
+                      % (iterN, blockKey))
+            return True
+        return False
+
+    def _setBlockDone(self, iterN, blockKey, parFn, initPart, lastPart,
+                      signature=None):
+        """ Check that the output .par file of a block has all its
+        particles and record it in the iteration manifest, together with
+        the signature of the job that wrote it.
+        """
+        count, first, last = readParRange(parFn)
+        if (count, first, last) != (lastPart - initPart + 1, initPart, lastPart):
+            raise Exception("Incomplete output %s: expected particles %d to %d, "
+                            "found %d particles from %s to %s"
+                            % (parFn, initPart, lastPart, count, first, last))
+        manifest = self._getBlockManifest(iterN)
+        manifest.setDone(blockKey, parFn, signature,
+                         first=first, last=last, count=count)
+
+    def _getBlockManifest(self, iterN):
+        return FrealignBlockManifest(self._getFileName('blocks_manifest', iter=iterN))
+
+    def _getIterBinning(self, iterN):
+        """ Return the downsampling factor of the particles and volumes
+        of an iteration (see doBinning). The last iteration is always
+        done at full size.
+        """
+        if iterN >= self.finalIter - 1:
+            return 1
+        return self._getBinningFactor()
+
+    def _getBinningFactor(self):
+        """ Return the downsampling factor of all iterations but the
+        last one: the biggest one (up to maxBinning) that keeps an even
+        box size and the refinement resolution below Nyquist.
+        """
+        if not self.doBinning:
+            return 1
+        imgSet = self._getInputParticles()
+        xdim = imgSet.getXDim()
+        samplingRate = imgSet.getSamplingRate()
+        limit = self.highResolRefine.get()
+        if not self.IS_REFINE:
+            limit = min(limit, self.resolClass.get())
+
+        for binning in range(self.maxBinning.get(), 1, -1):
+            if (xdim % binning == 0 and (xdim / binning) % 2 == 0
+                    and 2 * samplingRate * binning <= limit):
+                return binning
+        return 1
+
+    def _getIterBoxSize(self, iterN):
+        return self._getInputParticles().getXDim() / self._getIterBinning(iterN)
+
+    def _getIterParticles(self, iterN, binning=None):
+        """ Return the particles stack used in an iteration (the warm-up
+        subset or all particles, downsampled or not).
+        """
+        key = 'particles_subset' if self._isWarmupIter(iterN) else 'particles'
+        if binning is None:
+            binning = self._getIterBinning(iterN)
+        if binning == 1:
+            return self._getFileName(key)
+        return self._getFileName(key + '_bin', bin=binning)
+
+    def _prepareIterParticles(self, iterN):
+        """ Write the warm-up subset and downsampled particles stacks of
+        the iteration, if they are needed and were not written by a
+        previous one.
+        """
+        fullStackFn = self._getIterParticles(iterN, binning=1)
+        if not exists(fullStackFn):
+            tmpFn = fullStackFn + '.tmp'
+            selectMrcStack(self._getFileName('particles'), tmpFn,
+                           self._getWarmupSubset()[0])
+            os.rename(tmpFn, fullStackFn)
+
+        stackFn = self._getIterParticles(iterN)
+        if not exists(stackFn):
+            tmpFn = stackFn + '.tmp'
+            resizeMrcStack(fullStackFn, tmpFn, self._getIterBoxSize(iterN))
+            os.rename(tmpFn, stackFn)
+
+    def _stageIterVolume(self, src, dst, iterN, readOnly=True):
+        """ Stage a volume for an iteration (see _stageVolume), resizing
+        it if it was made with a different downsampling factor.
+        """
+        size = self._getIterBoxSize(iterN)
+        header = readMrcHeader(src)
+        if header is not None and header['nx'] != size:
+            resizeMrcVolume(src, dst, size)
+            self.info("Resized %s to %s (%d pixels)" % (src, dst, size))
+        else:
+            self._stageVolume(src, dst, readOnly)
+
+    def _getStackCacheDir(self):
+        """ Directory of the project where the particles stacks
+        are cached (see writeParticlesByMic).
+        """
+        return join('Tmp', 'frealign_stacks')
 
     def _getMicIdList(self):
         imgSet = self._getInputParticles()
@@ -1279,9 +1978,136 @@ eot
     def _getInputParticles(self):
         return self._getInputParticlesPointer().get()
 
+    def _getConcurrentJobs(self):
+        """ Return the Frealign jobs that run at the same time in each phase
+        of an iteration, as lists of (kind, numberOfThreads).
+        """
+        cpus = self._getNumberOfCpus()
+        refineJobs = [('refine', 1)] * min(self.numberOfBlocks, cpus)
+        reconsJobs = [('reconstruct', min(self.numberOfBlocks, cpus))]
+        return [refineJobs, reconsJobs]
+
+    def _getFrealignModes(self):
+        """ Return the Frealign operation mode (IFLAG) of the iterations,
+        and the one of iteration 1 when it starts without initial angles.
+        """
+        if self.mode == MOD_RECONSTRUCTION:
+            mode = 0
+        elif self.mode == MOD_REFINEMENT:
+            mode = 1
+        elif self.mode == MOD_RANDOM_SEARCH_REFINEMENT:
+            mode = 2
+        elif self.mode == MOD_SIMPLE_SEARCH_REFINEMENT:
+            mode = 3
+        else:
+            mode = 4
+
+        if self.Firstmode == MOD2_SIMPLE_SEARCH_REFINEMENT:
+            firstMode = -3
+        else:
+            firstMode = -4
+        return mode, firstMode
+
+    def _getNumberOfVolumes(self):
+        """ Number of volumes refined in each iteration. """
+        return 1
+
+    def _getCalibrationMetrics(self):
+        """ Return the metrics of the Frealign jobs of this run and of
+        the other Frealign runs of the project (see ProgramRunner).
+        """
+        program = basename(self._getProgram())
+        metrics = readProgramMetrics(self._getExtraPath(METRICS_FILE), program)
+        try:
+            runs = self.getProject().getRuns()
+        except Exception:
+            # The project is not available (e.g. protocol not saved yet)
+            runs = []
+        for run in runs:
+            if isinstance(run, ProtFrealignBase) and run.getObjId() != self.getObjId():
+                metrics += readProgramMetrics(run._getExtraPath(METRICS_FILE), program)
+        return metrics
+
+    def _getRunPlan(self):
+        """ Predict the CPU time of each iteration, and the total CPU
+        time, wall time and disk space of the run, from the parameters of
+        the protocol and the cost of the Frealign jobs of previous runs
+        (see FrealignCostModel). It does not need the steps inserted, so
+        it can be used to warn about the disk space before launching it.
+        """
+        imgSet = self._getInputParticles()
+        size = imgSet.getSize()
+        xdim = imgSet.getXDim()
+        numberOfIters = self.numberOfIterations.get()
+        numberOfVolumes = self._getNumberOfVolumes()
+        cpus = self._getNumberOfCpus()
+        numberOfBlocks = cpus * max(self.numberOfBlocksPerCpu.get(), 1)
+        binning = self._getBinningFactor()
+        model = FrealignCostModel(self._getCalibrationMetrics())
+
+        warmupIters = 0
+        if self.IS_REFINE and not self.doContinue:
+            warmupIters = min(self.warmupIterations.get(), numberOfIters - 1)
+        # Stack of particles, its warm-up subset and downsampled copies
+        disk = 4 * xdim ** 2 * size
+        if warmupIters > 0:
+            disk += 4 * xdim ** 2 * size * self.warmupFraction.get()
+        if binning > 1:
+            disk += 4 * (xdim / binning) ** 2 * size
+
+        iterCpu = []
+        for iterN in range(1, numberOfIters + 1):
+            particles = size
+            if iterN <= warmupIters:
+                particles = int(size * self.warmupFraction.get())
+            boxSize = xdim if iterN == numberOfIters else xdim / binning
+            mode, firstMode = self._getFrealignModes()
+            if (iterN == 1 and not self.useInitialAngles
+                    and not self.doContinue and mode != 0):
+                mode = firstMode
+            elif self._isSearchAfterWarmupIter(iterN) and mode in (1, 2):
+                mode = -firstMode
+            cpu = model.refineTime(particles, boxSize, mode,
+                                   self.angStepSize.get(),
+                                   self.numberRandomSearch.get(), numberOfBlocks)
+            cpu += model.reconstructTime(particles, boxSize)
+            iterCpu.append(cpu * numberOfVolumes)
+            cleaned = (self.doCleanIterations and
+                       iterN <= numberOfIters - self.keepIterations.get())
+            disk += estimateIterDisk(particles, boxSize, numberOfVolumes,
+                                     self.writeMatchProjections.get(), cleaned)
+
+        return {'iterCpu': iterCpu,
+                'cpu': sum(iterCpu),
+                'wall': sum(iterCpu) / cpus,
+                'cpus': cpus,
+                'disk': disk,
+                'calibrationJobs': model.refineJobs + model.reconstructJobs}
+
+    def _getFreeDisk(self):
+        """ Return the free bytes in the disk of the run directory,
+        or None if it is unknown.
+        """
+        path = os.path.abspath(self._getPath())
+        while not exists(path) and path != os.path.dirname(path):
+            path = os.path.dirname(path)
+        try:
+            st = os.statvfs(path)
+        except (OSError, AttributeError):
+            return None
+        return st.f_bavail * st.f_frsize
+
+    def _getNumberOfCpus(self):
+        """ Number of processes that can run at the same time. """
+        return max(self.numberOfMpi.get() - 1, self.numberOfThreads.get() - 1, 1)
+
     def _defNumberOfCPUs(self):
+        """ Return the number of processing blocks. It can be bigger than
+        the number of CPUs (see numberOfBlocksPerCpu), but each block
+        needs at least one micrograph.
+        """
         self._micList = []
         self._getMicIdList()
-        cpus = max(self.numberOfMpi.get() - 1, self.numberOfThreads.get() - 1, 1)
+        blocks = self._getNumberOfCpus() * max(self.numberOfBlocksPerCpu.get(), 1)
         numberOfMics = len(self._micList)
-        return min(cpus, numberOfMics)
+        return min(blocks, numberOfMics)
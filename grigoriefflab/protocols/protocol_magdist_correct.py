@@ -38,6 +38,7 @@ from pyworkflow.em.data import SetOfMovies
 from grigoriefflab import Plugin
 from grigoriefflab.constants import MAGDIST, MAGDISTCORR
 from grigoriefflab.convert import parseMagCorrInput
+from .program_runner import ProgramRunner
 
 
 class ProtMagDistCorr(ProtProcessMovies):
@@ -159,7 +160,9 @@ class ProtMagDistCorr(ProtProcessMovies):
         self._storeSummary(movie)
 
         try:
-            self.runJob(self._program % params, self._args % params)
+            ProgramRunner(self).run(self._program,
+                                    inputLines=[self._args % params],
+                                    logFn=logFn, numberOfThreads=params['nthr'])
         except:
             print("ERROR: Distortion correction for movie %s failed\n"
                   % movie.getFileName())
@@ -284,11 +287,10 @@ class ProtMagDistCorr(ProtProcessMovies):
         return 'micrograph_%06d_Log.txt' % movie.getObjId()
 
     def _argsMagDistCor(self):
-        self._program = 'export NCPUS=%(nthr)d ; ' + self._getProgram()
+        self._program = self._getProgram()
 
         if self.doGain and self.doResample:
-            self._args = """   << eof > %(logFn)s
-%(movieFn)s
+            self._args = """%(movieFn)s
 %(outputMovieFn)s
 %(angDist)f
 %(scaleMaj)f
@@ -298,11 +300,9 @@ class ProtMagDistCorr(ProtProcessMovies):
 %(doResample)s
 %(newX)d
 %(newY)d
-eof
 """
         elif self.doGain and not self.doResample:
-            self._args = """   << eof > %(logFn)s
-%(movieFn)s
+            self._args = """%(movieFn)s
 %(outputMovieFn)s
 %(angDist)f
 %(scaleMaj)f
@@ -310,11 +310,9 @@ eof
 %(doGain)s
 %(gainFile)s
 %(doResample)s
-eof
 """
         elif not self.doGain and self.doResample:
-            self._args = """   << eof > %(logFn)s
-%(movieFn)s
+            self._args = """%(movieFn)s
 %(outputMovieFn)s
 %(angDist)f
 %(scaleMaj)f
@@ -323,19 +321,16 @@ eof
 %(doResample)s
 %(newX)d
 %(newY)d
-eof
 """
 
         else:
-            self._args = """   << eof > %(logFn)s
-%(movieFn)s
+            self._args = """%(movieFn)s
 %(outputMovieFn)s
 %(angDist)f
 %(scaleMaj)f
 %(scaleMin)f
 %(doGain)s
 %(doResample)s
-eof
 """
 
     def _getMovieFn(self, movie):
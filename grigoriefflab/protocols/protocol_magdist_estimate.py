@@ -35,6 +35,7 @@ from pyworkflow.em.protocol import ProtPreprocessMicrographs
 from grigoriefflab import Plugin
 from grigoriefflab.convert import parseMagEstOutput
 from grigoriefflab.constants import MAGDIST, MAGDISTEST, MAGDISTEST_BIN
+from .program_runner import ProgramRunner
 
 
 class ProtMagDistEst(ProtPreprocessMicrographs):
@@ -140,10 +141,7 @@ class ProtMagDistEst(ProtPreprocessMicrographs):
 
     def _insertAllSteps(self):
         self._insertFunctionStep('convertInputStep')
-        parameters = self.runMagDistEst()
-        self._argsMagDistEst()
-        self._insertRunJobStep(self._program % parameters,
-                               self._args % parameters)
+        self._insertFunctionStep('estimateDistortionStep')
         self._insertFunctionStep('createOutputStep')
 
     # --------------------------- STEPS functions ------------------------------
@@ -158,6 +156,14 @@ class ProtMagDistEst(ProtPreprocessMicrographs):
         # Grigorieff's program recognizes only mrc extension
         pwutils.moveFile(stackFn, stackFnMrc)
 
+    def estimateDistortionStep(self):
+        parameters = self.runMagDistEst()
+        self._argsMagDistEst()
+        ProgramRunner(self).run(self._program,
+                                inputLines=[self._args % parameters],
+                                logFn=parameters['logFn'],
+                                numberOfThreads=parameters['nthr'])
+
     def runMagDistEst(self):
         self._defineInputs()
 
@@ -243,10 +249,8 @@ class ProtMagDistEst(ProtPreprocessMicrographs):
         return parseMagEstOutput(fnOut)
 
     def _argsMagDistEst(self):
-        self._program = 'export NCPUS=%(nthr)d ; '
-        self._program += Plugin.getProgram(MAGDIST, MAGDISTEST)
-        self._args = """   << eof > %(logFn)s
-%(stackFnMrc)s
+        self._program = Plugin.getProgram(MAGDIST, MAGDISTEST)
+        self._args = """%(stackFnMrc)s
 %(spectraFn)s
 %(rotAvgFn)s
 %(spectraCorrFn)s
@@ -262,7 +266,6 @@ YES
 %(lowp)f
 %(highp)f
 %(box)d
-eof
 """
 
     def getOutputAmplitudes(self):
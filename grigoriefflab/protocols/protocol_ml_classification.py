@@ -28,14 +28,22 @@ This module contains the protocol to classify a set of particles using Frealign
 """
 
 import os
+import time
+from os.path import join
+from itertools import izip
+
 from pyworkflow.utils import copyFile
 import pyworkflow.em as em
 from pyworkflow.em.data import Volume
 
 from grigoriefflab import Plugin
-from grigoriefflab.convert import rowToAlignment, OrderedDict, HEADER_COLUMNS
+from grigoriefflab.convert import (matricesFromParArray, readParClasses,
+                                   splitParFile, mergeParFiles, parIterStats,
+                                   copyParFile)
 from grigoriefflab.protocols import ProtFrealignBase
 from grigoriefflab.constants import FREALIGN, RSAMPLE, CALC_OCC
+from .frealign_tasks import FrealignTaskPool, FrealignTaskTimes
+from .program_runner import ProgramRunner
 
 
 class ProtFrealignClassify(ProtFrealignBase, em.ProtClassify3D):
@@ -52,6 +60,8 @@ marginal likelihood.
     
     def __init__(self, **args):
         ProtFrealignBase.__init__(self, **args)
+        # Task pools of the worker steps, by (iteration, kind of task)
+        self._taskPools = {}
     
     # -------------------------- INSERT steps functions -----------------------
     def _insertContinueStep(self):
@@ -73,24 +83,64 @@ marginal likelihood.
         self.cpuList = self._cpusPerClass(self.numberOfBlocks, self.numberOfRef)
     
     def _insertItersSteps(self):
-        """ Insert the steps for all iters """
-        
+        """ Insert the steps for all iters. Only calc_occ needs all classes;
+        the reconstruction of each class, and the splitting of its
+        parameters for the next iteration, wait only for the steps of
+        that class.
+        The next iteration starts after the first calc_occ, while the
+        classes are reconstructed, unless the end of the iteration checks
+        the convergence (it decides if the next one is executed) or
+        cleans old iterations.
+        """
+        waitEndIter = self.doAutoStop or self.doCleanIterations
+        depsClass = {}
+        depsIter = None # the first iteration follows the previous steps
+        endId = None
         for iterN in self._allItersN():
-            depsRecons = []
-            initId = self._insertFunctionStep('initIterStep', iterN)
+            initId = self._insertFunctionStep('initIterStep', iterN,
+                                              prerequisites=depsIter)
+            depsInit = [initId]
+            for ref in self._allRefs():
+                classInitId = self._insertFunctionStep(
+                    'initClassIterStep', iterN, ref,
+                    prerequisites=[initId] + depsClass.get(ref, []))
+                depsInit.append(classInitId)
             paramsDic = self._getParamsIteration(iterN)
-            depsRefine = self._insertRefineIterStep(iterN, paramsDic, [initId])
+            depsRefine = self._insertRefineIterStep(iterN, paramsDic, depsInit)
             firstOccId = self._insertFunctionStep("calculateOCCStep",
                                                   iterN, False,
                                                   prerequisites=depsRefine)
+            lastOccId = self._insertFunctionStep("calculateOCCStep",
+                                                 iterN, True,
+                                                 prerequisites=[firstOccId])
+            depsEnd = [] if endId is None else [endId]
             for ref in self._allRefs():
                 reconsId = self._insertFunctionStep("reconstructVolumeStep",
                                                     iterN, ref, paramsDic,
                                                     prerequisites=[firstOccId])
-                depsRecons.append(reconsId)
-            self._insertFunctionStep("calculateOCCStep", iterN, True,
-                                     prerequisites=depsRecons)
-#             depsOcc = [secondOccId]
+                finalId = self._insertFunctionStep("finalizeClassIterStep",
+                                                   iterN, ref,
+                                                   prerequisites=[reconsId,
+                                                                  lastOccId])
+                depsClass[ref] = [finalId]
+                depsEnd.append(finalId)
+            endId = self._insertFunctionStep("endIterStep", iterN,
+                                             prerequisites=depsEnd)
+            depsIter = [endId] if waitEndIter else [firstOccId]
+
+    def _insertWorkerSteps(self, stepName, iterN, paramsDic, prerequisites,
+                           numberOfTasks):
+        """ Insert one worker step per CPU (at most one per task). The
+        workers share the tasks of the iteration (see _getTaskPool).
+        """
+        depsWorkers = []
+        numberOfWorkers = min(self._getNumberOfCpus(), numberOfTasks)
+        for worker in range(1, numberOfWorkers + 1):
+            workerId = self._insertFunctionStep(stepName, iterN, worker,
+                                                paramsDic,
+                                                prerequisites=prerequisites)
+            depsWorkers.append(workerId)
+        return depsWorkers
     
     def _insertRefineIterStep(self, iterN, paramsDic, depsInitId):
         """ execute the refinement for the current iteration """
@@ -106,7 +156,8 @@ marginal likelihood.
 
                 for block in self._allBlocks():
                     refineId = self._insertFunctionStep(
-                        "refineBlockStep", block, prerequisites=depsConstruct)
+                        "refineBlockStep", block, paramsDic,
+                        prerequisites=depsConstruct)
                     depsRefine.append(refineId)
             else:
                 initAngStepId = self._insertFunctionStep(
@@ -119,36 +170,36 @@ marginal likelihood.
                         prerequisites=[initAngStepId])
                     depsRefine.append(refineId)
         else:
-            
-            for ref in self._allRefs():
-                for block in self._selBlocks(self.cpuList[ref-1]):
-                    restIterAngle = iterN % self.itRefineAngles.get()
-                    restIterShifts = iterN % self.itRefineShifts.get()
- 
-                    if restIterAngle == 0 and restIterShifts == 0:
-                        pass # no change anything
-                    elif restIterAngle == 0:
-                        paramsDic['mode'] = 1
-                        paramsDic['paramRefine'] = '1, 1, 1, 0, 0'
-                    elif restIterShifts == 0:
-                        paramsDic['mode'] = 1
-                        paramsDic['paramRefine'] = '0, 0, 0, 1, 1'
-                    else:
-                        paramsDic['mode'] = 1
-                        paramsDic['paramRefine'] = '0, 0, 0, 0, 0'
-                    
-                    refineId = self._insertFunctionStep(
-                        "refineClassParticlesStep", iterN, ref, block, paramsDic,
-                        prerequisites=depsInitId)
-                    depsRefine.append(refineId)
+            restIterAngle = iterN % self.itRefineAngles.get()
+            restIterShifts = iterN % self.itRefineShifts.get()
+
+            if restIterAngle == 0 and restIterShifts == 0:
+                pass # no change anything
+            elif restIterAngle == 0:
+                paramsDic['mode'] = 1
+                paramsDic['paramRefine'] = '1, 1, 1, 0, 0'
+            elif restIterShifts == 0:
+                paramsDic['mode'] = 1
+                paramsDic['paramRefine'] = '0, 0, 0, 1, 1'
+            else:
+                paramsDic['mode'] = 1
+                paramsDic['paramRefine'] = '0, 0, 0, 0, 0'
+
+            # Each class refines all particles, split in numberOfBlocks
+            depsRefine = self._insertWorkerSteps(
+                "refineWorkerStep", iterN, paramsDic, depsInitId,
+                self.numberOfRef * self.numberOfBlocks)
         return depsRefine
     
     #--------------------------- STEPS functions ---------------------------------------------------
     def initIterStep(self, iterN):
         """ Prepare files and directories for the current iteration """
-        
+        if self._isIterPassed(iterN):
+            self._passIter(iterN)
+        if self._isIterSkipped(iterN):
+            return
+
         self._createIterWorkingDir(iterN) # create the working directory for the current iteration.
-        prevIter = iterN - 1
         
         if iterN==1:
             vol = self.input3DReference.get()
@@ -156,28 +207,38 @@ marginal likelihood.
             imgFn = self._getFileName('particles')
             volFn = self._getFileName('init_vol')
             refVol = self._getFileName('ref_vol', iter=iterN) # reference volume of the step.
-            #TODO check if the input is already a single mrc stack
             self.writeParticlesByMic(imgFn)
             em.ImageHandler().convert(vol.getLocation(), volFn) # convert the reference volume into a mrc volume
-            copyFile(volFn, refVol)  #Copy the initial volume in the current directory.
-            
-        for ref in self._allRefs():
-            refVol = self._getFileName('ref_vol_class', iter=iterN, ref=ref) # reference volume of the step.
-            iterVol =  self._getFileName('iter_vol_class', iter=iterN, ref=ref) # refined volumes of the step
-            if iterN == 1:
-                copyFile(volFn, iterVol)  #Copy the initial volume in current directory.
-            else:
-                self._splitParFile(iterN, ref, self.cpuList[ref-1])
-                prevIterVol = self._getFileName('iter_vol_class', iter=prevIter, ref=ref) # volumes of the previous iteration
-                copyFile(prevIterVol, refVol)   #Copy the reference volume as refined volume.
-                copyFile(refVol, iterVol)   #Copy the reference volume as refined volume.
+            self._stageIterVolume(volFn, refVol, iterN)  #Copy the initial volume in the current directory.
+        self._prepareIterParticles(iterN)
+    
+    def initClassIterStep(self, iterN, ref):
+        """ Prepare the parameters and volumes of a class for the
+        current iteration.
+        """
+        if self._isIterSkipped(iterN):
+            return
+
+        refVol = self._getFileName('ref_vol_class', iter=iterN, ref=ref) # reference volume of the step.
+        iterVol =  self._getFileName('iter_vol_class', iter=iterN, ref=ref) # refined volumes of the step
+        if iterN == 1:
+            volFn = self._getFileName('init_vol')
+            self._stageIterVolume(volFn, iterVol, iterN, readOnly=False)  #Copy the initial volume in current directory.
+        else:
+            self._splitParFile(iterN, ref, self.numberOfBlocks)
+            prevIterVol = self._getFileName('iter_vol_class', iter=iterN-1, ref=ref) # volumes of the previous iteration
+            self._stageIterVolume(prevIterVol, refVol, iterN)   #Copy the reference volume as refined volume.
+            self._stageVolume(refVol, iterVol)   #Copy the reference volume as refined volume.
     
     def refineClassParticlesStep(self, iterN, ref, block, paramsDic):
         """Only refine the parameters of the SetOfParticles
         """
+        if self._isIterSkipped(iterN):
+            return
+
         iterDir = self._iterWorkingDir(iterN)
         
-        iniPart, lastPart = self._particlesInBlock(block, self.cpuList[ref-1])
+        iniPart, lastPart = self._particlesInBlock(block, self.numberOfBlocks)
         prevIter = iterN - 1
         
         inOutParam = {'inputParFn' : self._getBaseName('input_par_block_class',prevIter=prevIter, iter=iterN, ref=ref, block=block),
@@ -188,21 +249,42 @@ marginal likelihood.
         paramClassRefDic = self._setParamsClassRefineParticles(iterN, ref, block)
         
         paramsRefine = dict(paramsDic.items() + paramClassRefDic.items() + inOutParam.items())
-        
-        args = self._prepareCommand()
-        
-        # frealign program is already in the args script, that's why runJob('')
-        self.runJob('', args % paramsRefine, cwd=iterDir)
+
+        parFn = self._getFileName('output_par_block_class', iter=iterN, ref=ref, block=block)
+        blockKey = 'class_%02d_block_%02d' % (ref, block)
+        signature = self._getRefineSignature(paramsRefine, iterDir)
+        if self._isBlockDone(iterN, blockKey, parFn, iniPart, lastPart,
+                             signature):
+            return False
+        self._runFrealign(paramsRefine, iterDir, iterN, 'refine')
+        self._setBlockDone(iterN, blockKey, parFn, iniPart, lastPart,
+                           signature)
+        return True
     
+    def refineWorkerStep(self, iterN, worker, paramsDic):
+        """ Refine (class, block) tasks of the iteration until there are
+        no more pending ones.
+        """
+        self._runWorker(iterN, 'refine', paramsDic)
+
     def reconstructVolumeStep(self, iterN, ref, paramsDic):
         """Reconstruct a volume from a SetOfParticles with its current parameters refined
         """
+        if self._isIterSkipped(iterN):
+            return
+
+        volParFn = self._getFileName('output_vol_par_class', iter=iterN, ref=ref)
+        volumeKey = 'class_%02d_volume' % ref
+        start = time.time()
         imgSet = self._getInputParticles()
         initParticle = 1
         finalParticle = imgSet.getSize()
         iterDir = self._iterWorkingDir(iterN)
         
-        os.environ['NCPUS'] = str(self.cpuList[ref-1])
+        numberOfThreads = min(self.cpuList[ref-1], self._getNumberOfCpus())
+        # The classes are reconstructed in parallel steps that share
+        # paramsDic, so only a copy is changed
+        paramsDic = dict(paramsDic)
         paramsDic['frealign'] = Plugin.getProgram(FREALIGN, useMP=True)
         paramsDic['outputParFn'] = self._getBaseName('output_vol_par_class', iter=iterN, ref=ref)
         paramsDic['initParticle'] = initParticle
@@ -212,12 +294,22 @@ marginal likelihood.
         params2 = self._setParams3DR(iterN, ref)
         
         params3DR = dict(paramsDic.items() + params2.items())
+        signature = self._getJobSignature(params3DR, iterDir,
+                                          params3DR['imageFn'],
+                                          params3DR['inputParFn'])
+        manifest = self._getBlockManifest(iterN)
+        if manifest.isDone(volumeKey, volParFn, signature):
+            return
         
-        args = self._prepareCommand()
-        # frealign program is already in the args script, that's why runJob('')
-        self.runJob('', args % params3DR, cwd=iterDir)
+        self._runFrealign(params3DR, iterDir, iterN, 'reconstruct',
+                          numberOfThreads=numberOfThreads)
+        manifest.setDone(volumeKey, volParFn, signature)
+        self._getTaskTimes().add('reconstruct', ref, time.time() - start,
+                                 finalParticle)
     
     def calculateOCCStep(self, iterN, isLastIterStep):
+        if self._isIterSkipped(iterN):
+            return
 
         imgSet = self._getInputParticles()
         numberOfClasses = self.numberOfRef
@@ -225,29 +317,56 @@ marginal likelihood.
         iterDir = self._iterWorkingDir(iterN)
         
         if iterN == 1 and not isLastIterStep:
-            ProtFrealignBase._mergeAllParFiles(self, iterN, self.numberOfBlocks)
+            # rsample reads the merged file, it can not be compressed
+            ProtFrealignBase._mergeAllParFiles(self, iterN, self.numberOfBlocks,
+                                               compress=False)
             parFile = self._getBaseName('output_par', iter=iterN)
             samplingRate = imgSet.getSamplingRate()
             rootFn = self._getBaseName('output_par_class_tmp', iter=iterN)
             args  = self._rsampleCommand()
             program = Plugin.getProgram(FREALIGN, RSAMPLE)
+            logKey = 'logFileRsample'
         else:
+            # The last update is written apart, the class reconstructions
+            # are still reading the parameters (see finalizeClassIterStep)
+            outputKey = 'output_par_class_occ' if isLastIterStep else 'output_par_class'
             args = self._occCommand()
             tmp = ''
             for ref in self._allRefs():
                 if not isLastIterStep:
-                    self._mergeAllParFiles(iterN, ref, self.cpuList[ref-1])
+                    self._mergeAllParFiles(iterN, ref, self.numberOfBlocks)
                 args += '%s\n' % self._getBaseName('output_par_class', iter=iterN, ref=ref)
-                tmp += '%s\n' % self._getBaseName('output_par_class', iter=iterN, ref=ref)
-            args = args + tmp + 'eot'
+                tmp += '%s\n' % self._getBaseName(outputKey, iter=iterN, ref=ref)
+            args = args + tmp
             program = Plugin.getProgram(FREALIGN, CALC_OCC)
+            logKey = 'logFileOccLast' if isLastIterStep else 'logFileOcc'
 
-        self.runJob(program, args % locals(), cwd=iterDir)
-        
-        if isLastIterStep:
-            self._setLastIter(iterN)
+        logFn = join(iterDir, self._getFileName(logKey, iter=iterN))
+        ProgramRunner(self).run(program, inputLines=[args % locals()],
+                                logFn=logFn, cwd=iterDir, kind='occupancy',
+                                iteration=iterN)
+    
+    def finalizeClassIterStep(self, iterN, ref):
+        """ Replace the parameters of the class by the ones with the
+        last occupancies, once the class volume is reconstructed.
+        """
+        if self._isIterSkipped(iterN):
+            return
+
+        occParFn = self._getFileName('output_par_class_occ', iter=iterN, ref=ref)
+        if os.path.exists(occParFn):
+            os.rename(occParFn, self._getFileName('output_par_class', iter=iterN, ref=ref))
+    
+    def endIterStep(self, iterN):
+        if self._isIterSkipped(iterN):
+            return
+
+        self._setLastIter(iterN)
+        self._checkConvergence(iterN)
+        self._cleanOldIterations(iterN)
     
     def createOutputStep(self):
+        self._waitCleanup()
         numberOfClasses = self.numberOfRef
         imgSet = self._getInputParticles()
         volumes = self._createSetOfVolumes()
@@ -337,17 +456,9 @@ marginal likelihood.
         
         file2 = self._getFileName('output_par_class', iter=iterN, ref=ref)
         if numberOfBlocks != 1:
-            f2 = open(file2, 'w+')
-            
-            for block in range(1, numberOfBlocks + 1):
-                file1 = self._getFileName('output_par_block_class', block=block, iter=iterN, ref=ref)
-                f1 = open(file1)
-                
-                for l in f1:
-                    if not l.startswith('C'):
-                        f2.write(l)
-                f1.close()
-            f2.close()
+            blockFiles = [self._getFileName('output_par_block_class', block=block, iter=iterN, ref=ref)
+                          for block in range(1, numberOfBlocks + 1)]
+            mergeParFiles(blockFiles, file2)
         else:
             file1 = self._getFileName('output_par_block_class', block=1, iter=iterN, ref=ref)
             copyFile(file1, file2)
@@ -358,43 +469,26 @@ marginal likelihood.
         prevIter = iterN -1
         file1 = self._getFileName('output_par_class', iter=prevIter, ref=ref)
         if numberOfBlocks != 1:
+            blockFiles = []
             for block in range(1, numberOfBlocks + 1):
-                f1 = open(file1)
                 file2 = self._getFileName('input_par_block_class',prevIter=prevIter, iter=iterN, ref=ref, block=block)
-                f2 = open(file2, 'w+')
-                _, finalPart = self._particlesInBlock(block, numberOfBlocks)
-                
-                for l in f1:
-                    
-                    if l.startswith('C'):
-                        f2.write(l)
-                    else:
-                        split = l.split()
-                        numPart = int(''.join(split[:1]))
-                        
-                        if numPart <= finalPart:
-                            f2.write(l)
-                        else:
-                            break
-                f2.close()
-                f1.close()
+                initPart, finalPart = self._particlesInBlock(block, numberOfBlocks)
+                blockFiles.append((file2, initPart, finalPart))
+            splitParFile(file1, blockFiles)
         else:
             file2 = self._getFileName('input_par_block_class',prevIter=prevIter, iter=iterN, ref=ref, block=1)
-            copyFile(file1, file2)
+            copyParFile(file1, file2)
     
     def _rsampleCommand(self):
-        args = """ << eot
-%(parFile)s
+        args = """%(parFile)s
 %(samplingRate)f
 %(numberOfClasses)d
 %(rootFn)s
-eot
 """
         return args
     
     def _occCommand(self):
-        args = """ << eot
-%(numberOfClasses)d
+        args = """%(numberOfClasses)d
 1.0
 """
         return args
@@ -404,63 +498,121 @@ eot
         for i in range(1, self.numberOfRef+1):
             yield i
 
-    def _selBlocks(self, blocks):
-        """ Iterate over all numberOfCPUs. """
-        for i in range(1, blocks+1):
-            yield i
-    
     def _particlesInBlock(self, block, numberOfBlocks):
         """calculate the initial and final particles that belongs to this block"""
-        sortedMicIdList = sorted(self._micList, key=lambda k: k['_micId'])
-        blockParticles = self._particlesPerBlock(numberOfBlocks, sortedMicIdList)
-        initPart = 0
-        lastPart = 0
-        for i in range(block):
-            initPart = lastPart + 1
-            lastPart = lastPart + blockParticles[i]
-        
-        return initPart, lastPart
+        return self._getBlockPlan(numberOfBlocks).getRange(block)
     
-    def _fill3DClasses(self, clsSet, numberOfClasses):
+    def _runWorker(self, iterN, kind, paramsDic):
+        """ Run the tasks of the iteration pool of this kind, one after
+        another, and record how long they take.
+        """
+        if self._isIterSkipped(iterN):
+            return
+
+        pool = self._getTaskPool(iterN, kind)
+        times = self._getTaskTimes()
+        task = pool.next()
+        while task is not None:
+            ref, block = task
+            start = time.time()
+            iniPart, lastPart = self._particlesInBlock(block, self.numberOfBlocks)
+            if self.refineClassParticlesStep(iterN, ref, block, paramsDic):
+                times.add(kind, ref, time.time() - start, lastPart - iniPart + 1)
+            task = pool.next()
+
+    def _getTaskPool(self, iterN, kind):
+        """ Return the pool with the tasks of this kind ('refine') of
+        the iteration, shared by all its workers.
+        """
+        with FrealignTaskPool.lock:
+            key = (iterN, kind)
+            if key not in self._taskPools:
+                self._taskPools[key] = FrealignTaskPool(self._getIterTasks(kind))
+            return self._taskPools[key]
+
+    def _getIterTasks(self, kind):
+        """ Return a list of (cost, (ref, block)) with the tasks of an
+        iteration. The cost is estimated from the duration of the same
+        tasks in previous iterations.
+        """
+        times = self._getTaskTimes()
+        tasks = []
+        for ref in self._allRefs():
+            rate = times.getRate(kind, ref)
+            for block in self._allBlocks():
+                iniPart, lastPart = self._particlesInBlock(block, self.numberOfBlocks)
+                tasks.append((rate * (lastPart - iniPart + 1), (ref, block)))
+        return tasks
+
+    def _getIterKeptFiles(self, iterN):
+        parFiles, otherFiles = [], [self._getFileName('classes_scipion', iter=iterN)]
+        for ref in self._allRefs():
+            parFiles.append(self._getFileName('output_par_class', iter=iterN, ref=ref))
+            parFiles.append(self._getFileName('output_vol_par_class', iter=iterN, ref=ref))
+            otherFiles.append(self._getFileName('iter_vol_class', iter=iterN, ref=ref))
+        return parFiles, otherFiles
+
+    def _getNumberOfVolumes(self):
+        if self.doContinue:
+            return self.continueRun.get().numberOfClasses.get()
+        return self.numberOfClasses.get()
+
+    def _getConcurrentJobs(self):
+        """ Return the Frealign jobs that run at the same time in each phase
+        of an iteration: the refinement workers, and the reconstruction of
+        all classes.
+        """
+        cpus = self._getNumberOfCpus()
+        refineJobs = [('refine', 1)] * min(cpus, self.numberOfRef * self.numberOfBlocks)
+        reconsJobs = [('reconstruct', min(self.cpuList[ref-1], cpus))
+                      for ref in self._allRefs()]
+        return [refineJobs, reconsJobs]
+
+    def _getTaskTimes(self):
+        return FrealignTaskTimes(self._getExtraPath('task_times.json'))
+    
+    def _getIterStats(self, iterN):
+        """ Return the statistics of the iteration, averaged over
+        all classes (see parIterStats).
+        """
+        classStats = []
+        for ref in self._allRefs():
+            prevParFn = None
+            if iterN > 1:
+                prevParFn = self._getFileName('output_par_class', iter=iterN-1, ref=ref)
+            parFn = self._getFileName('output_par_class', iter=iterN, ref=ref)
+            volParFn = self._getFileName('output_vol_par_class', iter=iterN, ref=ref)
+            classStats.append(parIterStats(parFn, volParFn, prevParFn))
+
+        stats = {}
+        for key in classStats[0]:
+            values = [st[key] for st in classStats]
+            stats[key] = None if None in values else sum(values) / len(values)
+        return stats
+
+    def _fill3DClasses(self, clsSet, numberOfClasses, iterN=None):
         params = {'orderBy' : ['_micId', 'id'],
               'direction' : 'ASC'
               }
+        iterN = iterN or self._getLastIter()
+        parFiles = [self._getFileName('output_par_class', iter=iterN, ref=ref)
+                    for ref in range(1, numberOfClasses + 1)]
+        classIds, parData = readParClasses(parFiles)
+        samplingRate = self._getInputParticles().getSamplingRate()
+        matrices = matricesFromParArray(parData, samplingRate)
         
         clsSet.classifyItems(updateItemCallback=self._updateParticle,
                      updateClassCallback=self._updateClass,
-                     itemDataIterator=self._iterRows(numberOfClasses),
+                     itemDataIterator=izip(classIds.tolist(), matrices),
                      iterParams=params)
     
     def _updateParticle(self, item, row):
         item.setClassId(row[0])
-        vals = OrderedDict(zip(HEADER_COLUMNS, row[1]))
-        item.setTransform(rowToAlignment(vals, item.getSamplingRate()))
+        alignment = em.Transform()
+        alignment.setMatrix(row[1])
+        item.setTransform(alignment)
     
     def _updateClass(self, item):
         classId = item.getObjId()
         volFn = self._getFileName('iter_vol_class', iter=self._getLastIter(), ref=classId)
         item.getRepresentative().setLocation(volFn)
-    
-    def _iterRows(self, numberOfClasses):
-        filePar = self._getFileName('output_par_class', iter=self._getLastIter(), ref=1)
-        f1 = open(filePar)
-        for i, line in enumerate(f1):
-            if not line.startswith("C"):
-                values = map(float, line.split())
-                occValue = values[11]
-                classNum = 1
-                
-                for ref in range(2, numberOfClasses+1):
-                    filePar2 = self._getFileName('output_par_class', iter=self._getLastIter(), ref=ref)
-                    f2 = open(filePar2)
-                    line2 = f2.readlines()[i]
-                    val2 = map(float, line2.split())
-                    occNewValue = val2[11]
-                    
-                    if occNewValue > occValue:
-                        occValue = occNewValue
-                        classNum = ref
-                        values = val2
-                    
-                    f2.close()
-                yield classNum, values
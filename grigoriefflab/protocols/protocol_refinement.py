@@ -29,7 +29,7 @@ This module contains the protocol to obtain a refined 3D reconstruction from a s
 from os.path import exists
 import pyworkflow.em as em 
 from protocol_frealign_base import ProtFrealignBase
-from grigoriefflab.convert import rowToAlignment, FrealignParFile
+from grigoriefflab.convert import readParArray, matricesFromParArray
 
 
 class ProtFrealign(ProtFrealignBase, em.ProtRefine3D):
@@ -44,6 +44,7 @@ reconstructions.
         ProtFrealignBase.__init__(self, **args)
     
     def createOutputStep(self):
+        self._waitCleanup()
         lastIter = self._getLastIter()
         inputSet = self._getInputParticles()
         
@@ -91,11 +92,14 @@ reconstructions.
         initPartSet = self._getInputParticles()
         imgSet.setAlignmentProj()
         partIter = iter(initPartSet.iterItems(orderBy=['_micId', 'id'], direction='ASC'))
-        iterParFile = iter(FrealignParFile(parFn))
+        matrices = matricesFromParArray(readParArray(parFn),
+                                        initPartSet.getSamplingRate())
         
         imgSet.copyItems(partIter,
                          updateItemCallback=self._createItemMatrix,
-                         itemDataIterator=iterParFile)
+                         itemDataIterator=iter(matrices))
         
-    def _createItemMatrix(self, item, row):
-        item.setTransform(rowToAlignment(row, item.getSamplingRate()))
+    def _createItemMatrix(self, item, matrix):
+        alignment = em.Transform()
+        alignment.setMatrix(matrix)
+        item.setTransform(alignment)
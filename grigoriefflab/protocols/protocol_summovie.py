@@ -34,6 +34,7 @@ from pyworkflow.em.protocol import ProtAlignMovies, ProtProcessMovies
 from grigoriefflab import Plugin
 from grigoriefflab.constants import SUMMOVIE
 from grigoriefflab.convert import writeShiftsMovieAlignment
+from .program_runner import ProgramRunner
 
 
 class ProtSummovie(ProtAlignMovies):
@@ -132,7 +133,9 @@ class ProtSummovie(ProtAlignMovies):
                       'doRestoreNoisePower': 'YES' if self.doRestoreNoisePower else 'NO'
                       }
 
-            self.runJob(self._program, self._args % params)
+            ProgramRunner(self).run(self._program,
+                                    inputLines=[self._args % params],
+                                    frames=sN - s0 + 1)
             self._storeSummary(movie)
             if self.cleanInputMovies:
                 pwutils.cleanPath(movie._originalFileName.get())
@@ -211,12 +214,9 @@ class ProtSummovie(ProtAlignMovies):
 
     def _argsSummovie(self):
 
-        # Avoid threads multiplication
-        # self._program = 'export OMP_NUM_THREADS=%d; ' % self.numberOfThreads.get()
-        self._program = 'export OMP_NUM_THREADS=1; '
-        self._program += self._getProgram()
-        self._args = """ << eof
-%(movieFn)s
+        # Avoid threads multiplication: a single OpenMP thread per movie
+        self._program = self._getProgram()
+        self._args = """%(movieFn)s
 %(numberOfFrames)s
 %(micFn)s
 %(shiftsFn)s
@@ -229,7 +229,6 @@ class ProtSummovie(ProtAlignMovies):
 %(voltage)f
 0
 %(doRestoreNoisePower)s
-eof
 """
     
     def _getMovieFn(self, movie):
@@ -37,6 +37,7 @@ writeShiftsMovieAlignment = pwutils.importFromPlugin('xmipp3.convert', 'writeShi
 from grigoriefflab import Plugin
 from grigoriefflab.convert import readShiftsMovieAlignment
 from grigoriefflab.constants import UNBLUR
+from .program_runner import ProgramRunner
 
 
 class ProtUnblur(ProtAlignMovies):
@@ -222,7 +223,9 @@ class ProtUnblur(ProtAlignMovies):
         self._argsUnblur(movie, range)
         
         try:
-            self.runJob(self._program, self._args)
+            ProgramRunner(self).run(self._program, inputLines=[self._args],
+                                    numberOfThreads=self.openmpThreads.get(),
+                                    frames=range)
 
             outMicFn = self._getExtraPath(self._getOutputMicName(movie))
             if not os.path.exists(outMicFn):
@@ -311,16 +314,13 @@ class ProtUnblur(ProtAlignMovies):
                 'exposurePerFrame': movie.getAcquisition().getDosePerFrame() or 0.0
                 }
 
-        # Avoid threads multiplication
-        # self._program = 'export OMP_NUM_THREADS=%d; ' % self.numberOfThreads.get()
-        self._program = 'export OMP_NUM_THREADS=%d; ' % self.openmpThreads
-        self._program += self._getProgram()
+        # Avoid threads multiplication: each movie uses openmpThreads
+        self._program = self._getProgram()
 
         if self._isNewUnblur():
             args['preExposureAmount'] = movie.getAcquisition().getDoseInitial() \
                                         or 0.0
-            self._args = """ << eof
-%(movieName)s
+            self._args = """%(movieName)s
 %(numberOfFramesPerMovie)s
 %(micFnName)s
 %(shiftFnName)s
@@ -341,12 +341,10 @@ YES
 %(maximumNumberIterations)d
 %(doRestoreNoisePwr)s
 %(doVerboseOutput)s
-eof
 """ % args
 
         else:
-            self._args = """ << eof
-%(movieName)s
+            self._args = """%(movieName)s
 %(numberOfFramesPerMovie)s
 %(micFnName)s
 %(shiftFnName)s
@@ -365,7 +363,6 @@ YES
 %(maximumNumberIterations)d
 %(doRestoreNoisePwr)s
 %(doVerboseOutput)s
-eof
 """ % args
     
     def _getMicName(self, movieName):
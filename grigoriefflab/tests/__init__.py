@@ -25,8 +25,8 @@
 # **************************************************************************
 
 from .test_protocols_grigoriefflab import (
-    TestBase, TestImportParticles, TestCtffind4, TestCtftilt,
-    TestFrealignRefine, TestFrealignClassify)
+    TestBase, TestImportParticles, TestFrealignParFile, TestCtffind4,
+    TestCtftilt, TestFrealignRefine, TestFrealignClassify)
 from .test_protocols_grigoriefflab_magdist import TestMagDistBase, TestMagDist
 from .test_protocols_grigoriefflab_movies import (TestMoviesBase, TestUnblur,
                                                   TestSummovie)
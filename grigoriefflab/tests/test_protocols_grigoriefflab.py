@@ -24,12 +24,43 @@
 # *
 # **************************************************************************
 
+import inspect
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+
 from pyworkflow.em import *
 from pyworkflow.tests import *
 from pyworkflow.em.protocol import ProtImportParticles, ProtImportVolumes
 
 from grigoriefflab import *
+from grigoriefflab.convert import *
 from grigoriefflab.protocols import *
+from grigoriefflab.protocols.frealign_blocks import (FrealignBlockPlan,
+                                                      balancedParticlesPerBlock,
+                                                      stratifiedSubset,
+                                                      FrealignBlockManifest,
+                                                      jobSignature,
+                                                      iterBlockCtfLines)
+from grigoriefflab.protocols.frealign_cache import (FrealignStackCache,
+                                                     stageFile)
+from grigoriefflab.protocols.frealign_tasks import (FrealignTaskPool,
+                                                     FrealignTaskTimes)
+from grigoriefflab.protocols.program_runner import runProgram, ProgramRunner
+from grigoriefflab.protocols.frealign_memory import (estimateFrealignMemory,
+                                                      estimatePeakMemory,
+                                                      chooseMemoryMode,
+                                                      MEMORY_SAFETY)
+from grigoriefflab.protocols.frealign_plan import (searchFactor,
+                                                    FrealignCostModel,
+                                                    estimateIterDisk,
+                                                    formatDuration)
+from grigoriefflab.protocols.frealign_cleanup import (cleanIterDir,
+                                                       FrealignIterCleaner)
 
 
 class TestBase(BaseTest):
@@ -179,6 +210,1011 @@ class TestImportParticles(BaseTest):
         self.assertTrue(outputParticles.hasCTF())
         self.assertTrue(outputParticles.hasAlignmentProj())
 
+
+class TestFrealignParFile(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        cls.dataset = DataSet.getDataSet('grigorieff')
+        cls.parFile = cls.dataset.getFile('particles/particles_iter_002.par')
+
+    def test_readArray(self):
+        parData = readParArray(self.parFile)
+        rows = list(FrealignParFile(self.parFile))
+
+        self.assertEqual(len(parData), 180)
+        self.assertEqual(len(parData), len(rows))
+        for row, values in izip(rows, parData):
+            for column in parData.dtype.names:
+                self.assertAlmostEqual(float(row[column]), values[column])
+
+    def test_matricesFromParArray(self):
+        samplingRate = 9.90
+        matrices = matricesFromParArray(readParArray(self.parFile),
+                                        samplingRate)
+
+        for row, matrix in izip(FrealignParFile(self.parFile), matrices):
+            m = rowToAlignment(row, samplingRate).getMatrix()
+            self.assertTrue(np.allclose(m, matrix, atol=1e-6))
+
+
+class TestFrealignConvergence(BaseTest):
+    # Resolution and angular change of each iteration, it is stable
+    # from iteration 3 on
+    STATS = [(10.0, None), (8.0, 5.0), (7.9, 0.5), (7.8, 0.4), (7.8, 0.3)]
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _createProtocol(self, binnedIters=0):
+        prot = ProtFrealign(doAutoStop=True, convergencePatience=2,
+                            resolutionTolerance=0.2, angularTolerance=1.0)
+        prot.setWorkingDir(self.tmpDir)
+        prot._createFilenameTemplates()
+        os.makedirs(prot._getExtraPath())
+        prot.finalIter = 8
+        prot.info = lambda msg: None
+        prot._store = lambda *objs: None
+        prot._getIterStats = lambda iterN: {
+            'resolution': self.STATS[iterN-1][0],
+            'angularChange': self.STATS[iterN-1][1]}
+        prot._getIterBinning = lambda iterN: 2 if iterN <= binnedIters else 1
+        return prot
+
+    def test_converged(self):
+        prot = self._createProtocol()
+        for iterN in range(1, 5):
+            prot._checkConvergence(iterN)
+        self.assertEqual(prot._convergedIter.get(), 4)
+        self.assertFalse(prot._isIterSkipped(4))
+        self.assertTrue(prot._isIterSkipped(5))
+        self.assertTrue(prot._isIterSkipped(7))
+
+    def test_convergedDownsampled(self):
+        # Downsampled iterations converge at 4, iterations 5 and 6 are
+        # passed and the last one (7) is done at full size
+        prot = self._createProtocol(binnedIters=6)
+        for iterN in range(1, 6):
+            prot._checkConvergence(iterN)
+        self.assertIsNone(prot._convergedIter.get())
+        self.assertEqual(prot._binnedConvergedIter.get(), 4)
+        self.assertEqual([prot._isIterSkipped(i) for i in range(4, 8)],
+                         [False, True, True, False])
+        self.assertTrue(prot._isIterPassed(6))
+
+
+class TestFrealignHelpers(BaseTest):
+    """ Base class of the tests of the Frealign helpers, that work with
+    small files written to a temporary directory.
+    """
+    PAR_LINE = ("%7d %7.2f %7.2f %7.2f %9.2f %9.2f %7.0f %5d %8.1f %8.1f %7.2f"
+                " %7.2f %9d %10.4f %7.2f %7.2f\n")
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _tmpFile(self, filename):
+        return os.path.join(self.tmpDir, filename)
+
+    def _parLine(self, index, psi=0., occ=100., film=1):
+        return self.PAR_LINE % (index, psi, 0., 0., 0., 0., 10000, film,
+                                20000., 20000., 0., occ, 0, 0.5, 0., 0.)
+
+    def _writeParFile(self, filename, indexes, comments=True, **kwargs):
+        """ Write a .par file with a line per particle index, the
+        keyword arguments are lists with a value per particle.
+        """
+        filename = self._tmpFile(filename)
+        with open(filename, 'w') as f:
+            if comments:
+                f.write(PAR_HEADER)
+            for i, index in enumerate(indexes):
+                values = dict((k, v[i]) for k, v in kwargs.items())
+                f.write(self._parLine(index, **values))
+            if comments:
+                f.write("C  Average   0.0   0.0\n")
+        return filename
+
+
+class TestFrealignParClasses(TestFrealignHelpers):
+    def test_readParClasses(self):
+        parFiles = [self._writeParFile('class1.par', [1, 2, 3],
+                                       psi=[10., 20., 30.],
+                                       occ=[60., 30., 50.]),
+                    self._writeParFile('class2.par', [1, 2, 3],
+                                       psi=[11., 21., 31.],
+                                       occ=[40., 70., 50.])]
+        classIds, parData = readParClasses(parFiles)
+
+        # Ties keep the first class
+        self.assertEqual(list(classIds), [1, 2, 1])
+        self.assertEqual(list(parData['OCC']), [60., 70., 50.])
+        self.assertEqual(list(parData['PSI']), [10., 21., 30.])
+
+    def test_readParClassesOneClass(self):
+        parFn = self._writeParFile('class1.par', [1, 2], occ=[0., 0.])
+        classIds, parData = readParClasses([parFn])
+        self.assertEqual(list(classIds), [1, 1])
+        self.assertEqual(list(parData['INDEX']), [1, 2])
+
+    def test_readParClassesDifferentSize(self):
+        parFiles = [self._writeParFile('class1.par', [1, 2, 3]),
+                    self._writeParFile('class2.par', [1, 2])]
+        self.assertRaises(Exception, readParClasses, parFiles)
+
+
+class TestFrealignSplitParFile(TestFrealignHelpers):
+    def _readIndexes(self, parFn):
+        return [int(l.split()[0]) for l in open(parFn)
+                if not l.startswith('C')]
+
+    def _split(self, indexes, ranges):
+        parFn = self._writeParFile('input.par', indexes)
+        blockFiles = [(self._tmpFile('block_%d.par' % i), first, last)
+                      for i, (first, last) in enumerate(ranges, 1)]
+        splitParFile(parFn, blockFiles, header='C header\n')
+        return [fn for fn, _, _ in blockFiles]
+
+    def test_split(self):
+        blockFiles = self._split(range(1, 8), [(1, 3), (4, 5), (6, 7)])
+        self.assertEqual([self._readIndexes(fn) for fn in blockFiles],
+                         [[1, 2, 3], [4, 5], [6, 7]])
+        # Each block starts with the header and the input comments,
+        # the statistics at the end are not copied
+        for fn in blockFiles:
+            lines = open(fn).readlines()
+            self.assertEqual(lines[:2], ['C header\n', PAR_HEADER])
+            self.assertFalse(lines[-1].startswith('C'))
+
+    def test_splitOneBlock(self):
+        blockFiles = self._split(range(1, 5), [(1, 4)])
+        self.assertEqual(self._readIndexes(blockFiles[0]), [1, 2, 3, 4])
+
+    def test_splitEmptyRange(self):
+        # No particles in the second block, and particles out of all
+        # the ranges are skipped
+        blockFiles = self._split([1, 2, 5, 6, 9], [(1, 2), (3, 4), (5, 6)])
+        self.assertEqual([self._readIndexes(fn) for fn in blockFiles],
+                         [[1, 2], [], [5, 6]])
+
+
+class TestFrealignMergeParFiles(TestFrealignHelpers):
+    def _particleLines(self, parFn):
+        return [l for l in open(parFn) if not l.startswith('C')]
+
+    def test_splitAndMerge(self):
+        parFn = self._writeParFile('input.par', range(1, 11))
+        blockFiles = [(self._tmpFile('block_%d.par' % i), first, last)
+                      for i, (first, last) in enumerate([(1, 4), (5, 10)], 1)]
+        splitParFile(parFn, blockFiles)
+        outputFn = self._tmpFile('output.par')
+        mergeParFiles([fn for fn, _, _ in blockFiles], outputFn,
+                      header=PAR_HEADER)
+
+        self.assertEqual(open(outputFn).readline(), PAR_HEADER)
+        self.assertEqual(self._particleLines(outputFn),
+                         self._particleLines(parFn))
+
+    def test_mergeEmptyFile(self):
+        # Files without particles are skipped
+        inputFiles = [self._writeParFile('block_1.par', [1, 2]),
+                      self._writeParFile('block_2.par', []),
+                      self._writeParFile('block_3.par', [3])]
+        outputFn = self._tmpFile('output.par')
+        mergeParFiles(inputFiles, outputFn)
+        self.assertEqual([int(l.split()[0]) for l in self._particleLines(outputFn)],
+                         [1, 2, 3])
+
+    def test_mergeNotContiguous(self):
+        inputFiles = [self._writeParFile('block_1.par', [1, 2]),
+                      self._writeParFile('block_2.par', [4, 5])]
+        self.assertRaises(Exception, mergeParFiles, inputFiles,
+                          self._tmpFile('output.par'))
+
+
+class TestFrealignBlockPlan(BaseTest):
+    MICS = [{'_micId': 3, 'count': 4}, {'_micId': 1, 'count': 2},
+            {'_micId': 2, 'count': 3}]
+
+    def test_ranges(self):
+        plan = FrealignBlockPlan(self.MICS, [5, 4])
+        self.assertEqual(plan.getNumberOfBlocks(), 2)
+        self.assertEqual(plan.getNumberOfParticles(), 9)
+        self.assertEqual([m['_micId'] for m in plan.micList], [1, 2, 3])
+        self.assertEqual([plan.getRange(b) for b in (1, 2)],
+                         [(1, 5), (6, 9)])
+        self.assertEqual([plan.getBlock(p) for p in (1, 5, 6, 9)],
+                         [1, 1, 2, 2])
+
+    def test_oneBlock(self):
+        plan = FrealignBlockPlan(self.MICS, [9])
+        self.assertEqual(plan.getRange(1), (1, 9))
+        self.assertEqual(plan.getBlock(9), 1)
+
+    def test_storePlans(self):
+        plans = {1: FrealignBlockPlan(self.MICS, [9]),
+                 2: FrealignBlockPlan(self.MICS, [5, 4])}
+        loaded = FrealignBlockPlan.loadPlans(
+            FrealignBlockPlan.storePlans(plans))
+        self.assertEqual(sorted(loaded), [1, 2])
+        for n in plans:
+            self.assertEqual(loaded[n].toDict(), plans[n].toDict())
+        self.assertEqual(FrealignBlockPlan.loadPlans(''), {})
+
+
+class TestFrealignBalancedBlocks(BaseTest):
+    def test_balanced(self):
+        self.assertEqual(balancedParticlesPerBlock([5, 1, 1, 5, 2, 2], 2),
+                         [7, 9])
+        self.assertEqual(balancedParticlesPerBlock([3] * 6, 3), [6, 6, 6])
+
+    def test_oneBlock(self):
+        self.assertEqual(balancedParticlesPerBlock([4, 2, 7], 1), [13])
+
+    def test_moreBlocksThanMics(self):
+        # Each block keeps at least one micrograph
+        self.assertEqual(balancedParticlesPerBlock([10, 1, 1], 5), [10, 1, 1])
+        self.assertEqual(balancedParticlesPerBlock([1, 1, 10], 3), [1, 1, 10])
+
+
+class TestFrealignStackCache(TestFrealignHelpers):
+    def _add(self, cache, key, data):
+        def writeFunc(fn):
+            with open(fn, 'w') as f:
+                f.write(data)
+        return cache.add(key, len(data), writeFunc)
+
+    def test_addAndGet(self):
+        cache = FrealignStackCache(self._tmpFile('cache'), 10)
+        key = FrealignStackCache.getKey('set', [1, 2, 3])
+        self.assertIsNone(cache.get(key))
+        path = self._add(cache, key, 'abcd')
+        self.assertEqual(cache.get(key), path)
+        self.assertEqual(open(path).read(), 'abcd')
+        self.assertNotEqual(key, FrealignStackCache.getKey('set', [1, 2]))
+
+    def test_evict(self):
+        cache = FrealignStackCache(self._tmpFile('cache'), 10)
+        path1 = self._add(cache, 'k1', 'a' * 4)
+        path2 = self._add(cache, 'k2', 'b' * 4)
+        os.utime(path1, (1, 1))  # least recently used
+        self._add(cache, 'k3', 'c' * 4)
+        self.assertIsNone(cache.get('k1'))
+        self.assertEqual(cache.get('k2'), path2)
+        # A stack bigger than the cache is not added
+        self.assertIsNone(self._add(cache, 'k4', 'd' * 11))
+
+    def test_linkSurvivesEvict(self):
+        cache = FrealignStackCache(self._tmpFile('cache'), 10)
+        path = self._add(cache, 'k1', 'abcd')
+        dest = self._tmpFile('particles.mrc')
+        FrealignStackCache.link(path, dest)
+        cache.evict(0)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.islink(dest))
+        self.assertEqual(open(dest).read(), 'abcd')
+
+    def test_linkEvictedBefore(self):
+        # Another run evicts the stack between get and link
+        cache = FrealignStackCache(self._tmpFile('cache'), 10)
+        path = self._add(cache, 'k1', 'abcd')
+        self.assertEqual(cache.get('k1'), path)
+        cache.evict(0)
+        dest = self._tmpFile('particles.mrc')
+        self.assertIsNone(FrealignStackCache.link(path, dest))
+        self.assertFalse(os.path.exists(dest))
+
+
+class TestFrealignFourierResize(TestFrealignHelpers):
+    def _lowPassImages(self, n, size):
+        """ Images with only low frequencies, that can be downsampled
+        to half size without losing information.
+        """
+        x = np.arange(size) * 2 * np.pi / size
+        images = [np.add.outer(np.cos(i * x), np.sin((i + 1) * x)) + i
+                  for i in range(n)]
+        return np.array(images, dtype=np.float32)
+
+    def test_sameSize(self):
+        images = self._lowPassImages(2, 16)
+        self.assertTrue(np.array_equal(fourierResize(images, 16), images))
+
+    def test_downsampleAndUpsample(self):
+        images = self._lowPassImages(3, 32)
+        small = fourierResize(images, 16)
+        self.assertEqual(small.shape, (3, 16, 16))
+        self.assertEqual(small.dtype, np.float32)
+        self.assertTrue(np.allclose(small.mean(axis=(1, 2)),
+                                    images.mean(axis=(1, 2)), atol=1e-4))
+        self.assertTrue(np.allclose(fourierResize(small, 32), images,
+                                    atol=1e-4))
+
+    def test_volume(self):
+        volume = np.ones((8, 8, 8), dtype=np.float32)
+        resized = fourierResize(volume, 4, ndim=3)
+        self.assertEqual(resized.shape, (4, 4, 4))
+        self.assertTrue(np.allclose(resized, 1., atol=1e-5))
+
+    def test_resizeMrcStack(self):
+        images = self._lowPassImages(3, 32)
+        inputFn = self._tmpFile('input.mrcs')
+        outputFn = self._tmpFile('output.mrcs')
+        writeMrcStack(images, inputFn, (32, 32, 3), samplingRate=1.5)
+        resizeMrcStack(inputFn, outputFn, 16)
+
+        data, samplingRate = readMrcData(outputFn)
+        self.assertEqual(data.shape, (3, 16, 16))
+        self.assertAlmostEqual(samplingRate, 3.0, places=4)
+        self.assertTrue(np.allclose(data, fourierResize(images, 16),
+                                    atol=1e-5))
+
+
+class TestFrealignWarmupSubset(TestFrealignHelpers):
+    def test_stratifiedSubset(self):
+        micCounts = [10, 1, 4, 20]
+        positions, subsetCounts = stratifiedSubset(micCounts, 0.25)
+        # At least one particle of each micrograph
+        self.assertEqual(subsetCounts, [3, 1, 1, 5])
+        self.assertEqual(len(positions), sum(subsetCounts))
+        self.assertTrue(np.all(np.diff(positions) > 0))
+        offsets = np.cumsum([0] + micCounts)
+        for mic, count in enumerate(subsetCounts):
+            inMic = (positions >= offsets[mic]) & (positions < offsets[mic + 1])
+            self.assertEqual(inMic.sum(), count)
+        # The same seed gives the same subset
+        self.assertTrue(np.array_equal(
+            stratifiedSubset(micCounts, 0.25)[0], positions))
+
+    def test_stratifiedSubsetEdges(self):
+        positions, subsetCounts = stratifiedSubset([3, 2], 1.)
+        self.assertEqual(list(positions), [0, 1, 2, 3, 4])
+        positions, subsetCounts = stratifiedSubset([], 0.5)
+        self.assertEqual((len(positions), subsetCounts), (0, []))
+
+    def test_expandParSubset(self):
+        parFn = self._writeParFile('all.par', range(1, 6),
+                                   psi=[1., 2., 3., 4., 5.])
+        parData = readParArray(parFn)
+        positions = np.array([1, 3])
+        subsetFn = self._writeParFile('subset.par', [1, 2],
+                                      psi=[20., 40.], occ=[50., 50.])
+        outputFn = self._tmpFile('output.par')
+        expandParSubset(subsetFn, outputFn, parData, positions)
+
+        outputData = readParArray(outputFn)
+        self.assertEqual(list(outputData['INDEX']), [1, 2, 3, 4, 5])
+        self.assertEqual(list(outputData['PSI']), [1., 20., 3., 40., 5.])
+        self.assertEqual(list(outputData['OCC']),
+                         [100., 50., 100., 50., 100.])
+
+    def test_expandParSubsetWrongSize(self):
+        parData = readParArray(self._writeParFile('all.par', range(1, 6)))
+        subsetFn = self._writeParFile('subset.par', [1])
+        self.assertRaises(Exception, expandParSubset, subsetFn,
+                          self._tmpFile('output.par'), parData,
+                          np.array([1, 3]))
+
+
+class TestFrealignBlockManifest(TestFrealignHelpers):
+    def test_manifest(self):
+        parFn = self._writeParFile('block_1.par', [1, 2])
+        manifest = FrealignBlockManifest(self._tmpFile('manifest.json'))
+        self.assertFalse(manifest.isDone('block_1', parFn))
+
+        manifest.setDone('block_1', parFn, particles=2)
+        # A new manifest reads the same file
+        manifest = FrealignBlockManifest(self._tmpFile('manifest.json'))
+        self.assertTrue(manifest.isDone('block_1', parFn))
+        self.assertFalse(manifest.isDone('block_2', parFn))
+
+    def test_manifestChangedFile(self):
+        parFn = self._writeParFile('block_1.par', [1, 2])
+        manifest = FrealignBlockManifest(self._tmpFile('manifest.json'))
+        manifest.setDone('block_1', parFn)
+        # A block interrupted after being recorded, or removed
+        with open(parFn, 'a') as f:
+            f.write(self._parLine(3))
+        self.assertFalse(manifest.isDone('block_1', parFn))
+        os.remove(parFn)
+        self.assertFalse(manifest.isDone('block_1', parFn))
+
+    def test_manifestSignature(self):
+        parFn = self._writeParFile('block_1.par', [1, 2])
+        volFn = self._tmpFile('volume.mrc')
+        with open(volFn, 'w') as f:
+            f.write('volume')
+        params = {'mode': 1, 'highRes': 8.}
+        signature = jobSignature(params, [volFn])
+        self.assertEqual(signature, jobSignature(dict(params), [volFn]))
+        manifest = FrealignBlockManifest(self._tmpFile('manifest.json'))
+        manifest.setDone('block_1', parFn, signature)
+        self.assertTrue(manifest.isDone('block_1', parFn, signature))
+        # Continuing the run with other parameters or inputs
+        params['highRes'] = 6.
+        self.assertFalse(manifest.isDone('block_1', parFn,
+                                         jobSignature(params, [volFn])))
+        with open(volFn, 'a') as f:
+            f.write('changed')
+        self.assertNotEqual(signature, jobSignature({'mode': 1, 'highRes': 8.},
+                                                    [volFn]))
+        self.assertFalse(manifest.isDone('block_1', parFn))
+
+
+class TestFrealignCtfLines(TestFrealignHelpers):
+    # Micrograph id and defocus of each particle, in micrograph order
+    PARTICLES = [(1, 10000.), (1, 11000.), (2, 20000.), (2, 21000.), (2, 22000.)]
+
+    def test_blockCtfLines(self):
+        ctfFn = self._tmpFile('ctf.txt')
+        with open(ctfFn, 'w') as f:
+            for i in range(1, 6):
+                f.write('1, 60000, 00000, %d, %d, 0.0\n' % (i, i))
+        lines = list(iterBlockCtfLines(ctfFn, 3))
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0], '1, 60000, 00000, 1, 1, 0.0, 1\n')
+        self.assertEqual(lines[-1], '1, 60000, 00000, 3, 3, 0.0, 0\n')
+        self.assertEqual(len(list(iterBlockCtfLines(ctfFn, 5))), 5)
+
+    def _createParticles(self):
+        partSet = SetOfParticles(filename=self._tmpFile('particles.sqlite'))
+        partSet.setSamplingRate(2.0)
+        acquisition = Acquisition(magnification=60000, voltage=300,
+                                  sphericalAberration=2.0, amplitudeContrast=0.1)
+        partSet.setAcquisition(acquisition)
+        for i, (micId, defocus) in enumerate(self.PARTICLES):
+            particle = Particle(location=(i + 1, self._tmpFile('particles.mrc')))
+            particle.setMicId(micId)
+            ctf = CTFModel()
+            ctf.setStandardDefocus(defocus, defocus + 100., 45.)
+            particle.setCTF(ctf)
+            partSet.append(particle)
+        partSet.write()
+        return partSet
+
+    def test_constructParamFiles(self):
+        partSet = self._createParticles()
+        prot = ProtFrealign()
+        prot.setWorkingDir(self.tmpDir)
+        prot._createFilenameTemplates()
+        prot._getInputParticles = lambda: partSet
+        prot._micList = [{'_micId': 1}, {'_micId': 2}]
+        prot.numberOfBlocks = 2
+        blockRanges = {1: (1, 2), 2: (3, 5)}
+        prot._initFinalBlockParticles = lambda block, iterN=None: blockRanges[block]
+        ctfFn = prot._getFileName('ctf_particles', iter=1)
+        os.makedirs(os.path.dirname(ctfFn))
+
+        prot.constructParamFilesStep({})
+        # A single file with a line per particle, in micrograph order
+        rows = [line.split(',') for line in open(ctfFn)]
+        self.assertEqual(len(rows), len(self.PARTICLES))
+        for row, (micId, defocus) in izip(rows, self.PARTICLES):
+            self.assertEqual(int(row[2]), micId - 1)
+            self.assertAlmostEqual(float(row[3]), defocus)
+        # The second block gets the lines of the particles 1 to 5
+        lines = list(iterBlockCtfLines(ctfFn, blockRanges[2][1]))
+        self.assertEqual([int(line.split(',')[-1]) for line in lines],
+                         [1, 1, 1, 1, 0])
+
+
+class TestFrealignInitialAngles(TestFrealignHelpers):
+    def test_writeInitialAngles(self):
+        """ Each block file has only the particles of its range, so the
+        block files merge back into the initial parameters.
+        """
+        parData = np.zeros(5, dtype=[(c, np.float64) for c in PAR_ANGLES_COLUMNS])
+        parData['INDEX'] = np.arange(1, 6)
+        parData['PSI'] = np.arange(10, 60, 10)
+        prot = ProtFrealign()
+        prot.setWorkingDir(self.tmpDir)
+        prot._createFilenameTemplates()
+        prot._getInitialParData = lambda: parData
+        prot.numberOfBlocks = 2
+        blockRanges = {1: (1, 2), 2: (3, 5)}
+        prot._initFinalBlockParticles = lambda block, iterN=None: blockRanges[block]
+        blockFiles = [prot._getFileName('input_par_block', block=block,
+                                        iter=1, prevIter=0)
+                      for block in (1, 2)]
+        os.makedirs(os.path.dirname(blockFiles[0]))
+
+        prot.writeInitialAnglesStep()
+        for block, parFn in enumerate(blockFiles, 1):
+            initPart, lastPart = blockRanges[block]
+            self.assertEqual(readParRange(parFn),
+                             (lastPart - initPart + 1, initPart, lastPart))
+        mergedFn = self._tmpFile('merged.par')
+        mergeParFiles(blockFiles, mergedFn)
+        merged = readParArray(mergedFn)
+        self.assertEqual(merged['INDEX'].tolist(), range(1, 6))
+        self.assertTrue(np.allclose(merged['PSI'], parData['PSI']))
+
+
+class TestFrealignTasks(TestFrealignHelpers):
+    def test_taskPool(self):
+        pool = FrealignTaskPool([(1., 'a'), (3., 'b'), (2., 'c')])
+        self.assertEqual([pool.next() for _ in range(4)],
+                         ['b', 'c', 'a', None])
+        self.assertIsNone(FrealignTaskPool([]).next())
+
+    def test_taskPoolThreads(self):
+        # Each task is taken by a single worker
+        pool = FrealignTaskPool([(i, i) for i in range(100)])
+        taken = []
+
+        def worker():
+            for task in iter(pool.next, None):
+                taken.append(task)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(taken), range(100))
+
+    def test_taskTimes(self):
+        times = FrealignTaskTimes(self._tmpFile('times.json'))
+        # Without measures
+        self.assertEqual(times.getRate('refine', 1), 1.)
+
+        times.add('refine', 1, 10., 100)
+        times.add('refine', 1, 30., 100)
+        times.add('refine', 2, 100., 100)
+        times.add('reconstruct', 1, 5., 0)
+        times = FrealignTaskTimes(self._tmpFile('times.json'))
+        self.assertAlmostEqual(times.getRate('refine', 1), 0.2)
+        self.assertAlmostEqual(times.getRate('refine', 2), 1.)
+        # A new key takes the mean of all the measures of the same kind
+        self.assertAlmostEqual(times.getRate('refine', 3), 1.4 / 3)
+        self.assertAlmostEqual(times.getRate('reconstruct', 1), 5.)
+
+    def test_taskTimesLastMeasures(self):
+        times = FrealignTaskTimes(self._tmpFile('times.json'))
+        for seconds in [100.] + [1.] * FrealignTaskTimes.LAST_MEASURES:
+            times.add('refine', 1, seconds, 1)
+        self.assertAlmostEqual(times.getRate('refine', 1), 1.)
+
+
+class TestProgramRunner(TestFrealignHelpers):
+    def test_runProgram(self):
+        logFn = self._tmpFile('cat.log')
+        usage = runProgram('/bin/cat', inputLines=iter(['a\n', 'b\n']),
+                           logFn=logFn, cwd=self.tmpDir)
+        self.assertEqual(usage['exitCode'], 0)
+        self.assertFalse(usage['timedOut'])
+        self.assertEqual(open(logFn).read(), 'a\nb\n')
+        for key in ['wall', 'user', 'sys', 'maxRss']:
+            self.assertTrue(usage[key] >= 0)
+
+    def test_runProgramFailure(self):
+        usage = runProgram('/bin/sh', ['-c', 'exit 3'])
+        self.assertEqual(usage['exitCode'], 3)
+        # The program exits without reading its input
+        usage = runProgram('/bin/sh', ['-c', 'exit 4'],
+                           inputLines=('line %d\n' % i for i in range(100000)))
+        self.assertEqual(usage['exitCode'], 4)
+
+    def test_runProgramTimeout(self):
+        usage = runProgram('/bin/sleep', ['10'], timeout=0.2)
+        self.assertTrue(usage['timedOut'])
+        self.assertEqual(usage['exitCode'], -signal.SIGKILL)
+        self.assertTrue(usage['wall'] < 5)
+
+    def _createRunner(self, mpi=1, **kwargs):
+        tmpFile = self._tmpFile
+        jobs = []
+
+        class Value(object):
+            def __init__(self, value):
+                self.value = value
+
+            def get(self):
+                return self.value
+
+        class Protocol(object):
+            numberOfMpi = Value(mpi)
+
+            def _getExtraPath(self, filename):
+                return tmpFile(filename)
+
+            def _getTmpPath(self):
+                return tmpFile('')
+
+            def useQueue(self):
+                return False
+
+            def info(self, msg):
+                pass
+
+            def runJob(self, program, arguments, **kwargs):
+                jobs.append((program, arguments, kwargs))
+                subprocess.check_call('%s %s' % (program, arguments),
+                                      shell=True, cwd=kwargs.get('cwd'),
+                                      env=kwargs.get('env'))
+
+        runner = ProgramRunner(Protocol(), **kwargs)
+        runner.jobs = jobs
+        return runner
+
+    def test_runnerMetrics(self):
+        runner = self._createRunner()
+        logFn = self._tmpFile('env.log')
+        metrics = runner.run('/bin/sh', ['-c', 'echo $NCPUS $OMP_NUM_THREADS'],
+                             logFn=logFn, numberOfThreads=3, particles=10)
+        self.assertEqual(open(logFn).read(), '3 3\n')
+        self.assertEqual(metrics['particles'], 10)
+        self.assertEqual(runner.getMetrics('sh'), [metrics])
+        self.assertEqual(runner.getMetrics('other'), [])
+
+    def test_runnerRetries(self):
+        # The program fails the first time only
+        flagFn = self._tmpFile('flag')
+        runner = self._createRunner(retries=1)
+        runner.run('/bin/sh', ['-c', 'test -e %s || (touch %s; exit 1)'
+                               % (flagFn, flagFn)])
+        self.assertEqual([(m['attempt'], m['exitCode'])
+                          for m in runner.getMetrics()], [(1, 1), (2, 0)])
+
+    def test_runnerFailure(self):
+        runner = self._createRunner(retries=1)
+        self.assertRaises(Exception, runner.run, '/bin/sh', ['-c', 'exit 2'])
+        self.assertEqual(len(runner.getMetrics()), 2)
+        self.assertRaises(Exception, runner.run, self._tmpFile('missing'))
+        self.assertRaises(Exception, runner.run, '/bin/sleep', ['10'],
+                          timeout=0.2, retries=0)
+        self.assertTrue(runner.getMetrics()[-1]['timedOut'])
+
+    def test_runnerRunJob(self):
+        # With MPI the programs go through the protocol runJob
+        runner = self._createRunner(mpi=2, retries=1)
+        logFn = self._tmpFile('cat.log')
+        metrics = runner.run('/bin/cat', inputLines=lambda: iter(['a\n', 'b\n']),
+                             logFn=logFn, cwd=self.tmpDir, numberOfThreads=3)
+        self.assertEqual(open(logFn).read(), 'a\nb\n')
+        self.assertEqual(metrics['exitCode'], 0)
+        self.assertIsNone(metrics['maxRss'])
+        program, _, kwargs = runner.jobs[0]
+        self.assertEqual(program, '/bin/cat')
+        self.assertEqual((kwargs['numberOfMpi'], kwargs['numberOfThreads']), (1, 3))
+        self.assertEqual(kwargs['env']['NCPUS'], '3')
+        # The input file is removed
+        self.assertEqual([fn for fn in os.listdir(self.tmpDir)
+                          if fn.endswith('.stdin')], [])
+        self.assertRaises(Exception, runner.run, '/bin/sh', ['-c', '"exit 2"'])
+        self.assertEqual([m['exitCode'] for m in runner.getMetrics('sh')],
+                         [None, None])
+
+
+class TestFrealignMemory(BaseTest):
+    # One refinement job and a reconstruction with 8 threads
+    PHASES = [[('refine', 1)], [('reconstruct', 8)]]
+
+    def test_estimateMemory(self):
+        # Padding only changes the refinement
+        self.assertTrue(estimateFrealignMemory(128, 1, 'refine') >
+                        estimateFrealignMemory(128, 0, 'refine'))
+        self.assertEqual(estimateFrealignMemory(128, 1, 'reconstruct'),
+                         estimateFrealignMemory(128, 0, 'reconstruct'))
+        # Each thread has its own volumes in the multi-volume modes
+        self.assertTrue(estimateFrealignMemory(128, 2, 'reconstruct', 4) >
+                        estimateFrealignMemory(128, 2, 'reconstruct', 1))
+        self.assertEqual(estimateFrealignMemory(128, 0, 'reconstruct', 4),
+                         estimateFrealignMemory(128, 0, 'reconstruct', 1))
+
+    def _available(self, memoryMode):
+        """ Memory where the peak of this mode just fits. """
+        return estimatePeakMemory(256, memoryMode, self.PHASES) / MEMORY_SAFETY
+
+    def test_chooseMemoryMode(self):
+        # Unknown memory, the safest mode
+        self.assertEqual(chooseMemoryMode(256, self.PHASES, None)[0], 0)
+        self.assertEqual(chooseMemoryMode(256, self.PHASES,
+                                          self._available(3))[0], 3)
+        # The multi-volume reconstruction does not fit, but padding does
+        mode, peak = chooseMemoryMode(256, self.PHASES, self._available(1))
+        self.assertEqual(mode, 1)
+        self.assertEqual(peak, estimatePeakMemory(256, 1, self.PHASES))
+
+    def test_chooseMemoryModeNotFit(self):
+        # The mode that uses less memory, even if it does not fit
+        mode, peak = chooseMemoryMode(256, self.PHASES, 1.)
+        self.assertEqual(mode, 0)
+        self.assertEqual(peak, estimatePeakMemory(256, 0, self.PHASES))
+
+
+class TestFrealignPlan(BaseTest):
+    def _job(self, kind, cpu, particles=1000, boxSize=100, mode=1, **kwargs):
+        job = {'kind': kind, 'exitCode': 0, 'user': cpu, 'sys': 0.,
+               'particles': particles, 'boxSize': boxSize, 'mode': mode,
+               'angStepSize': 10., 'numberRandomSearch': 0}
+        job.update(kwargs)
+        return job
+
+    def test_searchFactor(self):
+        self.assertEqual(searchFactor(0, 10., 0), 0.)
+        self.assertEqual(searchFactor(1, 10., 0), 1.)
+        # A global search is more expensive with finer steps and
+        # random searches, and the same in the first iteration
+        self.assertTrue(searchFactor(3, 5., 0) > searchFactor(3, 10., 0) > 1.)
+        self.assertEqual(searchFactor(4, 10., 5), searchFactor(3, 10., 0) + 5)
+        self.assertEqual(searchFactor(-3, 10., 0), searchFactor(3, 10., 0))
+
+    def test_costModelDefault(self):
+        model = FrealignCostModel()
+        self.assertFalse(model.isCalibrated())
+        self.assertEqual(model.refineTime(1000, 100, 0, 10., 0, 4), 0.)
+        self.assertTrue(model.refineTime(1000, 100, 3, 10., 0, 4) >
+                        model.refineTime(1000, 100, 1, 10., 0, 4) > 0)
+
+    def test_costModelCalibration(self):
+        # The median of the successful jobs, failed ones are ignored
+        metrics = [self._job('refine', cpu) for cpu in (10., 20., 30.)]
+        metrics.append(self._job('refine', 1000., exitCode=1))
+        metrics.append(self._job('reconstruct', 5.))
+        model = FrealignCostModel(metrics)
+
+        self.assertTrue(model.isCalibrated())
+        self.assertEqual((model.refineJobs, model.reconstructJobs), (3, 1))
+        self.assertAlmostEqual(model.refineCost, 20. / (1000 * 100 ** 2))
+        self.assertAlmostEqual(model.reconstructCost, 5. / (1000 * 100 ** 2))
+        # Twice the particles take twice the time (besides the volumes)
+        self.assertAlmostEqual(model.reconstructTime(2000, 100) -
+                               model.reconstructTime(1000, 100), 5.)
+
+    def test_estimateIterDisk(self):
+        disk = estimateIterDisk(1000, 100)
+        self.assertTrue(estimateIterDisk(1000, 100, writeMatchProj=True) > disk)
+        self.assertEqual(estimateIterDisk(1000, 100, numberOfVolumes=2),
+                         2 * disk)
+        self.assertTrue(estimateIterDisk(1000, 100, cleaned=True) < disk)
+        self.assertEqual(estimateIterDisk(0, 0), 0)
+
+    def test_formatDuration(self):
+        self.assertEqual(formatDuration(0), '0 min')
+        self.assertEqual(formatDuration(59 * 60), '59 min')
+        self.assertEqual(formatDuration(3600 * 2 + 5 * 60), '2h 05min')
+
+
+class TestFrealignCleanup(TestFrealignHelpers):
+    def _createIterDir(self):
+        iterDir = self._tmpFile('iter_002')
+        os.makedirs(os.path.join(iterDir, 'subdir'))
+        for fn in ['volume.mrc', 'weights.mrc', 'match.mrc', 'block_1.log']:
+            with open(os.path.join(iterDir, fn), 'w') as f:
+                f.write('x' * 100)
+        self._writeParFile('iter_002/particles.par', range(1, 101))
+        return iterDir
+
+    def test_compressParFile(self):
+        parFn = self._writeParFile('particles.par', range(1, 11))
+        lines = open(parFn).readlines()
+        compressedFn = compressParFile(parFn)
+        self.assertEqual(compressedFn, parFn + '.gz')
+        self.assertFalse(os.path.exists(parFn))
+        self.assertEqual(findParFile(parFn), compressedFn)
+        # Compressed files are read with the name of the .par file
+        self.assertEqual(openParFile(parFn).readlines(), lines)
+        self.assertEqual(list(readParArray(parFn)['INDEX']), range(1, 11))
+
+    def test_cleanIterDir(self):
+        iterDir = self._createIterDir()
+        parSize = os.path.getsize(os.path.join(iterDir, 'particles.par'))
+        removed, freed = cleanIterDir(iterDir, ['volume.mrc'],
+                                      ['particles.par'], PAR_GZIP_EXT)
+
+        self.assertEqual(sorted(os.listdir(iterDir)),
+                         ['particles.par.gz', 'subdir', 'volume.mrc'])
+        self.assertEqual(removed, 3)
+        compressedSize = os.path.getsize(os.path.join(iterDir,
+                                                      'particles.par.gz'))
+        self.assertEqual(freed, 300 + parSize - compressedSize)
+
+    def test_cleanIterDirTwice(self):
+        # Cleaning again keeps the compressed .par file
+        iterDir = self._createIterDir()
+        cleanIterDir(iterDir, [], ['particles.par'], PAR_GZIP_EXT)
+        self.assertEqual(cleanIterDir(iterDir, [], ['particles.par'],
+                                      PAR_GZIP_EXT), (0, 0))
+        self.assertEqual(sorted(os.listdir(iterDir)),
+                         ['particles.par.gz', 'subdir'])
+
+    def test_iterCleaner(self):
+        messages = []
+        cleaner = FrealignIterCleaner(log=messages.append)
+        self.assertEqual(cleaner.join(), [])
+
+        iterDir = self._createIterDir()
+        cleaner.submit(iterDir, ['volume.mrc'])
+        # A missing directory is skipped, a file can not be cleaned
+        cleaner.submit(self._tmpFile('missing'), [])
+        cleaner.submit(os.path.join(iterDir, 'volume.mrc'), [])
+        errors = cleaner.join()
+
+        self.assertEqual(sorted(os.listdir(iterDir)), ['subdir', 'volume.mrc'])
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(len(errors), 1)
+
+
+class TestFrealignParCompression(TestFrealignHelpers):
+    def setUp(self):
+        TestFrealignHelpers.setUp(self)
+        # Module where the .par file functions look for zstandard
+        self.convertModule = sys.modules[openParFile.__module__]
+        self.zstandard = self.convertModule.zstandard
+
+    def tearDown(self):
+        self.convertModule.zstandard = self.zstandard
+        TestFrealignHelpers.tearDown(self)
+
+    def _getCompressions(self):
+        if isZstdAvailable():
+            return [PAR_GZIP_EXT, PAR_ZSTD_EXT]
+        return [PAR_GZIP_EXT]
+
+    def test_compressedRoundTrip(self):
+        for ext in self._getCompressions():
+            parFn = self._writeParFile('particles%s.par' % ext, range(1, 11))
+            lines = open(parFn).readlines()
+            compressedFn = compressParFile(parFn, ext)
+            self.assertEqual(compressedFn, parFn + ext)
+            self.assertTrue(isCompressedParFile(compressedFn))
+            self.assertEqual(openParFile(compressedFn).readlines(), lines)
+            # An uncompressed copy for the Frealign programs
+            copyFn = uncompressedParFile(parFn, self._tmpFile('scratch'))
+            self.assertEqual(copyFn, self._tmpFile('scratch/particles%s.par' % ext))
+            self.assertEqual(open(copyFn).readlines(), lines)
+
+    def test_copyParFile(self):
+        parFn = self._writeParFile('particles.par', range(1, 11))
+        lines = open(parFn).readlines()
+        ext = PAR_ZSTD_EXT if isZstdAvailable() else PAR_GZIP_EXT
+        compressedFn = self._tmpFile('copy.par' + ext)
+        copyParFile(parFn, compressedFn)
+        copyParFile(compressedFn, self._tmpFile('copy2.par'))
+        self.assertEqual(open(self._tmpFile('copy2.par')).readlines(), lines)
+
+    def test_mergeCompressedParFiles(self):
+        inputFiles = [self._writeParFile('block_1.par', [1, 2]),
+                      compressParFile(self._writeParFile('block_2.par', [3, 4])),
+                      self._writeParFile('block_3.par', [5])]
+        outputFn = self._tmpFile('output.par' + PAR_GZIP_EXT)
+        mergeParFiles(inputFiles, outputFn)
+        self.assertEqual(list(readParArray(outputFn)['INDEX']), range(1, 6))
+
+    def test_zstdMissing(self):
+        self.convertModule.zstandard = None
+        self.assertFalse(isZstdAvailable())
+        parFn = self._writeParFile('particles.par', range(1, 3))
+        self.assertRaises(Exception, openParFile, parFn + PAR_ZSTD_EXT, 'w')
+        self.assertRaises(Exception, compressParFile, parFn, PAR_ZSTD_EXT)
+        # The original file is kept
+        self.assertTrue(os.path.exists(parFn))
+        self.assertFalse(os.path.exists(parFn + PAR_ZSTD_EXT))
+
+
+class TestFrealignGeometry(BaseTest):
+    # PSI, THETA, PHI of some particles, the last ones with THETA = 0
+    ANGLES = [[10., 20., 30.], [-150., 90., 170.], [45., 135., -60.],
+              [0., 0., 0.], [30., 0., 0.]]
+    SHIFTS = [[1.5, -2.], [0., 0.], [-3., 4.25], [1., 1.], [0., -1.]]
+
+    def test_matricesFromGeometry(self):
+        matrices = matricesFromGeometry(self.SHIFTS, self.ANGLES)
+        self.assertEqual(matrices.shape, (len(self.ANGLES), 4, 4))
+        for shifts, angles, matrix in izip(self.SHIFTS, self.ANGLES, matrices):
+            m = matrixFromGeometry(np.array(shifts + [0.]), np.array(angles))
+            self.assertTrue(np.allclose(matrix, m, atol=1e-6))
+        # Shifts with the Z column give the same matrices
+        shifts3 = np.column_stack((self.SHIFTS, np.zeros(len(self.SHIFTS))))
+        self.assertTrue(np.allclose(matricesFromGeometry(shifts3, self.ANGLES),
+                                    matrices))
+
+    def test_geometryFromMatrices(self):
+        matrices = matricesFromGeometry(self.SHIFTS, self.ANGLES)
+        for inverse in [True, False]:
+            shifts, angles = geometryFromMatrices(matrices, inverse)
+            for i, matrix in enumerate(matrices):
+                shifts1, angles1 = geometryFromMatrix(matrix, inverse)
+                self.assertTrue(np.allclose(shifts[i], shifts1, atol=1e-6))
+                self.assertTrue(np.allclose(angles[i], angles1, atol=1e-6))
+
+    def test_geometryRoundTrip(self):
+        matrices = matricesFromGeometry(self.SHIFTS, self.ANGLES)
+        shifts, angles = geometryFromMatrices(matrices)
+        self.assertTrue(np.allclose(shifts[:, :2], self.SHIFTS, atol=1e-6))
+        self.assertTrue(np.allclose(shifts[:, 2], 0., atol=1e-6))
+        # The same matrices, even if the angles of THETA = 0 differ
+        self.assertTrue(np.allclose(matricesFromGeometry(shifts, angles),
+                                    matrices, atol=1e-6))
+
+    def test_geometryFromOneMatrix(self):
+        matrix = matricesFromGeometry(self.SHIFTS[:1], self.ANGLES[:1])[0]
+        shifts, angles = geometryFromMatrices(matrix)
+        self.assertEqual((shifts.shape, angles.shape), ((1, 3), (1, 3)))
+        self.assertTrue(np.allclose(angles[0], self.ANGLES[0], atol=1e-6))
+
+
+class TestFrealignMrcStack(TestFrealignHelpers):
+    def _images(self, n, xdim=6, ydim=4):
+        return np.arange(n * ydim * xdim, dtype=np.float32).reshape(n, ydim, xdim)
+
+    def test_writeMrcStack(self):
+        images = self._images(3)
+        stackFn = self._tmpFile('particles.mrcs')
+        writeMrcStack(iter(images), stackFn, (6, 4, 3), samplingRate=2.)
+
+        self.assertTrue(isMrcStack(stackFn, 3))
+        self.assertFalse(isMrcStack(stackFn, 2))
+        data, samplingRate = readMrcData(stackFn)
+        self.assertTrue(np.array_equal(data, images))
+        self.assertAlmostEqual(samplingRate, 2.)
+        header = readMrcHeader(stackFn)
+        self.assertEqual((header['dmin'], header['dmax']), (0., 71.))
+        self.assertAlmostEqual(header['dmean'], images.mean(), places=4)
+        self.assertAlmostEqual(header['rms'], images.std(), places=3)
+
+    def test_writeMrcStackInvert(self):
+        images = self._images(2)
+        stackFn = self._tmpFile('particles.mrcs')
+        writeMrcStack(images, stackFn, (6, 4, 2), invert=True)
+        self.assertTrue(np.array_equal(readMrcData(stackFn)[0], -images))
+        # The input images are not changed
+        self.assertTrue(np.array_equal(images, self._images(2)))
+
+    def test_writeMrcStackWrongSize(self):
+        stackFn = self._tmpFile('particles.mrcs')
+        self.assertRaises(Exception, writeMrcStack, self._images(2),
+                          stackFn, (6, 4, 3))
+
+    def test_isMrcStack(self):
+        fn = self._tmpFile('particles.spi')
+        writeMrcStack(self._images(1), fn, (6, 4, 1))
+        # Only MRC extensions
+        self.assertFalse(isMrcStack(fn, 1))
+        self.assertFalse(isMrcStack(self._writeParFile('a.par', [1]), 1))
+        self.assertIsNone(readMrcHeader(self._writeParFile('b.mrc', [1])))
+
+
+class TestFrealignStageFile(TestFrealignHelpers):
+    def _writeFile(self, filename, data):
+        filename = self._tmpFile(filename)
+        with open(filename, 'w') as f:
+            f.write(data)
+        return filename
+
+    def test_stageFile(self):
+        src = self._writeFile('volume.mrc', 'abcd')
+        dst = self._tmpFile('staged.mrc')
+        stageFile(src, dst)
+        # A writable copy never shares the data with the source
+        with open(dst, 'w') as f:
+            f.write('efgh')
+        self.assertEqual(open(src).read(), 'abcd')
+
+    def test_stageFileReadOnly(self):
+        src = self._writeFile('volume.mrc', 'abcd')
+        dst = self._tmpFile('staged.mrc')
+        stageFile(src, dst, readOnly=True)
+        os.remove(src)
+        self.assertEqual(open(dst).read(), 'abcd')
+
+    def test_stageFileReplace(self):
+        # An existing file or broken link in dst is replaced
+        src = self._writeFile('volume.mrc', 'abcd')
+        dst = self._writeFile('staged.mrc', 'old')
+        stageFile(src, dst, readOnly=True)
+        self.assertEqual(open(dst).read(), 'abcd')
+        link = self._tmpFile('link.mrc')
+        os.symlink(self._tmpFile('missing.mrc'), link)
+        stageFile(src, link)
+        self.assertFalse(os.path.islink(link))
+        self.assertEqual(open(link).read(), 'abcd')
+
     
 class TestCtffind4(TestBase):
     @classmethod
@@ -322,3 +1358,136 @@ class TestFrealignClassify(TestBase):
         frealign.inputParticles.set(self.protImportPart.outputParticles)
         frealign.input3DReference.set(self.protImportVol.outputVolume)
         self.launchProtocol(frealign)
+
+    def testInsertStepsWithoutInitialAngles(self):
+        """ The steps of the first iteration, without initial angles, must
+        match the arguments of the step functions.
+        """
+        frealign = self.newProtocol(ProtFrealignClassify,
+                                    numberOfIterations=2,
+                                    numberOfClasses=2,
+                                    useInitialAngles=False,
+                                    mode=MOD_REFINEMENT,
+                                    outerRadius=241.,
+                                    numberOfThreads=4)
+        frealign.inputParticles.set(self.protImportPart.outputParticles)
+        frealign.input3DReference.set(self.protImportVol.outputVolume)
+        self.proj.saveProtocol(frealign)
+        frealign._insertAllSteps()
+
+        funcNames = [step.funcName.get() for step in frealign._steps]
+        self.assertIn('refineBlockStep', funcNames)
+        for step in frealign._steps:
+            func = getattr(frealign, step.funcName.get())
+            argSpec = inspect.getargspec(func)
+            # Do not count self
+            nArgs = len(argSpec.args) - 1
+            nDefaults = len(argSpec.defaults or ())
+            self.assertTrue(nArgs - nDefaults <= len(step._args) <= nArgs,
+                            "Wrong arguments for step %s: %s"
+                            % (step.funcName.get(), step._args))
+
+    def testInsertStepsDependencies(self):
+        """ In each iteration, the refinement workers wait for the classes
+        to be initialized, the occupancies are computed twice and each
+        class volume is reconstructed before its parameters are replaced
+        by the ones with the last occupancies.
+        """
+        frealign = self.newProtocol(ProtFrealignClassify,
+                                    numberOfIterations=2,
+                                    numberOfClasses=2,
+                                    useInitialAngles=False,
+                                    mode=MOD_REFINEMENT,
+                                    outerRadius=241.,
+                                    numberOfThreads=4)
+        frealign.inputParticles.set(self.protImportPart.outputParticles)
+        frealign.input3DReference.set(self.protImportVol.outputVolume)
+        self.proj.saveProtocol(frealign)
+        frealign._insertAllSteps()
+
+        # Steps are identified by their name and arguments (but paramsDic)
+        keys = {}
+        for stepId, step in enumerate(frealign._steps, 1):
+            keys[stepId] = (step.funcName.get(),) + tuple(
+                arg for arg in step._args if not isinstance(arg, dict))
+        deps = {}
+        for stepId, step in enumerate(frealign._steps, 1):
+            deps[keys[stepId]] = set(keys[int(p)] for p in step._prerequisites)
+
+        iterN = 2
+        initIter = ('initIterStep', iterN)
+        initClasses = [('initClassIterStep', iterN, ref) for ref in (1, 2)]
+        workers = [key for key in deps
+                   if key[0] == 'refineWorkerStep' and key[1] == iterN]
+        firstOcc = ('calculateOCCStep', iterN, False)
+        lastOcc = ('calculateOCCStep', iterN, True)
+
+        self.assertTrue(workers)
+        for ref, initClass in enumerate(initClasses, 1):
+            self.assertEqual(deps[initClass],
+                             set([initIter, ('finalizeClassIterStep', iterN - 1, ref)]))
+        for worker in workers:
+            self.assertEqual(deps[worker], set([initIter] + initClasses))
+        self.assertEqual(deps[firstOcc], set(workers))
+        self.assertEqual(deps[lastOcc], set([firstOcc]))
+        finals = []
+        for ref in (1, 2):
+            recons = ('reconstructVolumeStep', iterN, ref)
+            final = ('finalizeClassIterStep', iterN, ref)
+            self.assertEqual(deps[recons], set([firstOcc]))
+            self.assertEqual(deps[final], set([recons, lastOcc]))
+            finals.append(final)
+        self.assertTrue(set(finals) <= deps[('endIterStep', iterN)])
+
+    def testFinalizeClassIterStep(self):
+        """ The parameters with the last occupancies end with the same
+        file name of the class parameters as before.
+        """
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        frealign = ProtFrealignClassify()
+        frealign.setWorkingDir(tmpDir)
+        frealign._createFilenameTemplates()
+        os.makedirs(frealign._getExtraPath('iter_002'))
+
+        occParFn = frealign._getFileName('output_par_class_occ', iter=2, ref=1)
+        parFn = frealign._getFileName('output_par_class', iter=2, ref=1)
+        self.assertEqual(os.path.basename(parFn), 'particles_iter_002_class_01.par')
+        with open(parFn, 'w') as f:
+            f.write('previous occupancies')
+        with open(occParFn, 'w') as f:
+            f.write('last occupancies')
+
+        frealign.finalizeClassIterStep(2, 1)
+        self.assertFalse(os.path.exists(occParFn))
+        self.assertEqual(open(parFn).read(), 'last occupancies')
+
+    def testReconstructVolumeStepParams(self):
+        """ The class volumes are reconstructed in parallel steps that
+        receive the same paramsDic, each one must change only its copy.
+        """
+        tmpDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpDir)
+        frealign = ProtFrealignClassify()
+        frealign.setWorkingDir(tmpDir)
+        frealign._createFilenameTemplates()
+        iterDir = frealign._iterWorkingDir(2)
+        os.makedirs(iterDir)
+        frealign._getInputParticles = lambda: self.protImportPart.outputParticles
+        frealign.cpuList = [2, 2]
+        frealign._getNumberOfCpus = lambda: 4
+        jobs = []
+
+        def runFrealign(paramsDic, cwd, iterN, kind, **kwargs):
+            jobs.append(paramsDic)
+            open(os.path.join(cwd, paramsDic['outputParFn']), 'w').close()
+        frealign._runFrealign = runFrealign
+
+        paramsDic = {'imageFn': 'particles.mrc', 'mode': 1}
+        for ref in (1, 2):
+            frealign.reconstructVolumeStep(2, ref, paramsDic)
+        self.assertEqual(paramsDic, {'imageFn': 'particles.mrc', 'mode': 1})
+        self.assertEqual([job['outputParFn'] for job in jobs],
+                         [frealign._getBaseName('output_vol_par_class', iter=2, ref=ref)
+                          for ref in (1, 2)])
+        self.assertEqual([job['mode'] for job in jobs], [0, 0])
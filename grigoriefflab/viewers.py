@@ -26,6 +26,7 @@
 
 import os
 from os.path import exists, relpath
+from itertools import izip
 from pyworkflow.utils import cleanPath, removeExt
 from pyworkflow.viewer import (Viewer, ProtocolViewer,
                                DESKTOP_TKINTER, WEB_DJANGO)
@@ -41,6 +42,8 @@ from pyworkflow.protocol.params import (LabelParam, NumericRangeParam,IntParam,
                                         EnumParam, FloatParam)
 from grigoriefflab.protocols import (
     ProtMagDistEst, ProtFrealign, ProtFrealignClassify, ProtCTFFind)
+from grigoriefflab.convert import (readParArray, readParFscTable, findParFile,
+                                   FSC_RESOLUTION, FSC_FSC, FSC_REC_SSNR)
 
 
 LAST_ITER = 0
@@ -184,8 +187,10 @@ Examples:
 
         for it in self._iterations:
             files = self.protocol._getFileName('match', iter=it)
-            v = self.createDataView(files)
-            views.append(v)
+            # Old iterations may have been cleaned (see doCleanIterations)
+            if exists(files):
+                v = self.createDataView(files)
+                views.append(v)
         return views
     
 #===============================================================================
@@ -267,14 +272,14 @@ Examples:
         else:
             if self.protocol.IS_REFINE:
                 data_angularDist = self.protocol._getFileName("output_par", iter=it)
-                if exists(data_angularDist):
+                if findParFile(data_angularDist):
                     sqliteFn = self.protocol._getFileName('projections', iter=it)
                     self.createAngDistributionSqlite(sqliteFn, nparts, itemDataIterator=self._iterAngles(it, data_angularDist))
                     view = ChimeraClientView(volumes[0], showProjection=True, angularDistFile=sqliteFn, spheresDistance=radius)
             else:
                 for ref3d in self._refsList:
                     data_angularDist = self.protocol._getFileName("output_par_class", iter=it, ref=ref3d)
-                    if exists(data_angularDist):
+                    if findParFile(data_angularDist):
                         sqliteFn = self.protocol._getFileName('projectionsClass', iter=it, ref=ref3d)
                         self.createAngDistributionSqlite(sqliteFn, nparts, itemDataIterator=self._iterAngles(it, data_angularDist))
                         view = ChimeraClientView(volumes[0], showProjection=True, angularDistFile=sqliteFn, spheresDistance=radius)
@@ -287,7 +292,7 @@ Examples:
         
         if self.protocol.IS_REFINE:
             data_angularDist = self.protocol._getFileName("output_par", iter=it)
-            if exists(data_angularDist):
+            if findParFile(data_angularDist):
                 plotter = EmPlotter(x=gridsize[0], y=gridsize[1],
                                     mainTitle="Iteration %d" % it, windowTitle="Angular distribution")
                 title = 'iter %d' % it
@@ -300,7 +305,7 @@ Examples:
         else:
             for ref3d in self._refsList:
                 data_angularDist = self.protocol._getFileName("output_par_class", iter=it, ref=ref3d)
-                if exists(data_angularDist):
+                if findParFile(data_angularDist):
                     plotter = EmPlotter(x=gridsize[0], y=gridsize[1],
                                         mainTitle="Iteration %d" % it, windowTitle="Angular distribution")
                     title = 'class %d' % ref3d
@@ -326,7 +331,7 @@ Examples:
             show = False
             for it in self._iterations:
                 parFn = self.protocol._getFileName('output_vol_par', iter=it)
-                if exists(parFn):
+                if findParFile(parFn):
                     show = True
                     self._plotFSC(a, parFn)
                     legends.append('iter %d' % it)
@@ -346,7 +351,7 @@ Examples:
                 
                 for it in self._iterations:
                     parFn = self.protocol._getFileName('output_vol_par_class', iter=it, ref=ref3d)
-                    if exists(parFn):
+                    if findParFile(parFn):
                         show = True
                         self._plotFSC(a, parFn)
                         legends.append('iter %d' % it)
@@ -361,8 +366,8 @@ Examples:
         return [xplotter]
     
     def _plotFSC(self, a, parFn):
-        resolution_inv = self._getColunmFromFilePar(parFn, 2, invert=True)
-        frc = self._getColunmFromFilePar(parFn, 5)
+        resolution_inv = self._getColunmFromFilePar(parFn, FSC_RESOLUTION, invert=True)
+        frc = self._getColunmFromFilePar(parFn, FSC_FSC)
         self.maxFrc = max(frc)
         self.minInv = min(resolution_inv)
         self.maxInv = max(resolution_inv)
@@ -387,7 +392,7 @@ Examples:
                     fn = self.protocol._getFileName('output_vol_par', iter=it)
                 else:
                     fn = self.protocol._getFileName('output_vol_par_class', iter=it, ref=ref3d)
-                if exists(fn):
+                if findParFile(fn):
                     self._plotSSNR(a, fn)
                 legendName.append('iter %d' % it)
             xplotter.showLegend(legendName)
@@ -396,8 +401,8 @@ Examples:
         return [xplotter]
     
     def _plotSSNR(self, a, parFn):
-        resolution_inv = self._getColunmFromFilePar(parFn, 2, invert=True)
-        frc = self._getColunmFromFilePar(parFn, 8)
+        resolution_inv = self._getColunmFromFilePar(parFn, FSC_RESOLUTION, invert=True)
+        frc = self._getColunmFromFilePar(parFn, FSC_REC_SSNR)
         
         a.plot(resolution_inv, frc)
         a.xaxis.set_major_formatter(self._plotFormatter)               
@@ -490,41 +495,22 @@ Examples:
                 numberOfRef = self.protocol.numberOfClasses.get()
             
             
-            self.protocol._fill3DClasses(clsSet, numberOfRef)
+            self.protocol._fill3DClasses(clsSet, numberOfRef, it)
             clsSet.write()
             clsSet.close()
 
         return dataClasses
     
     def _iterAngles(self, it, dataAngularDist):
-        f = open(dataAngularDist)
-        for line in f:
-            if not line.startswith('C'):
-                angles = map(float, line.split())
-                rot = angles[1]
-                tilt = angles[2]
-                yield rot, tilt
-        
-        f.close()
+        parData = readParArray(dataAngularDist)
+        for rot, tilt in izip(parData['PSI'], parData['THETA']):
+            yield rot, tilt
     
     def _getColunmFromFilePar(self, parFn, col, invert=False):
-        f1 = open(parFn)
-        
-        readLines = False
-        value = []
-        for l in f1:
-            if "C  Average" in l:
-                readLines = False
-            if readLines:
-                valList = l.split()
-                val = float(valList[col])
-                if invert:
-                    val = 1/val
-                value.append(val)
-            if "NO.  RESOL" in l:
-                readLines = True
-        f1.close()
-        return value
+        value = readParFscTable(parFn)[:, col]
+        if invert:
+            value = 1 / value
+        return value.tolist()
 
     def _getVolumeNames(self):
         volumes = []